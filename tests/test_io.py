@@ -1,9 +1,11 @@
 import os
+import tempfile
 import unittest
 
 import anndata
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 import wot.io
 
@@ -137,3 +139,33 @@ class TestIO(unittest.TestCase):
         pd.testing.assert_frame_equal(
             ds.var,
             ds2.var)
+
+    def test_lazy_dataset(self):
+        rng = np.random.RandomState(0)
+        x = rng.poisson(1, size=(40, 6)).astype(np.float32)
+        obs = pd.DataFrame(index=['cell_{}'.format(i) for i in range(40)], data={'day': rng.randint(0, 3, 40) * 1.0})
+        var = pd.DataFrame(index=['gene_{}'.format(i) for i in range(6)])
+        rows = np.array([7, 3, 4, 5, 20])
+        with tempfile.TemporaryDirectory() as d:
+            for sparse in [False, True]:
+                ds = anndata.AnnData(scipy.sparse.csr_matrix(x) if sparse else x, obs, var)
+                ds.write(os.path.join(d, 'test.h5ad'))
+                wot.io.write_day_sorted_dataset(ds, os.path.join(d, 'test.day_sorted'))
+                for path in ['test.h5ad', 'test.day_sorted']:
+                    lazy = wot.io.LazyDataset(os.path.join(d, path))
+                    self.assertEqual(lazy.shape, (40, 6))
+                    subset = lazy.subset(lazy.obs.index.get_indexer(obs.index[rows]), [1, 3])
+                    result = subset[1:]
+                    self.assertEqual(scipy.sparse.issparse(result.X), sparse)
+                    self.assertEqual(list(result.obs.index), list(obs.index[rows[1:]]))
+                    self.assertEqual(list(result.var.index), ['gene_1', 'gene_3'])
+                    np.testing.assert_array_equal(result.X.toarray() if sparse else result.X, x[rows[1:]][:, [1, 3]])
+                    lazy.close()
+            days = wot.io.LazyDataset(os.path.join(d, 'test.day_sorted')).obs['day'].values
+            np.testing.assert_array_equal(days, np.sort(obs['day'].values))
+            for sparse in [False, True]:
+                ds = anndata.AnnData(scipy.sparse.csr_matrix(x[:0]) if sparse else x[:0], obs.iloc[:0], var)
+                wot.io.write_day_sorted_dataset(ds, os.path.join(d, 'empty.day_sorted'))
+                result = wot.io.LazyDataset(os.path.join(d, 'empty.day_sorted'))[:]
+                self.assertEqual(result.shape, (0, 6))
+                self.assertEqual(scipy.sparse.issparse(result.X), sparse)
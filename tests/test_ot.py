@@ -1,11 +1,40 @@
+import argparse
+import os
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
 
+import anndata
+import h5py
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import scipy.stats
 import sklearn.metrics
 
+import wot.commands
+import wot.io
 import wot.ot
+import wot.tmap
+
+
+def make_small_dataset(ncells, ngenes=8, days=(0., 1., 2.)):
+    """
+    Random expression of ncells cells at each of the days, with ids cell_0, cell_1... in day order.
+    ncells can also be a list, with the number of cells at each day.
+    """
+    counts = np.broadcast_to(ncells, len(days))
+    obs = pd.DataFrame(index=['cell_{}'.format(i) for i in range(np.sum(counts))],
+                       data={'day': np.repeat(np.asarray(days, dtype=float), counts)})
+    return anndata.AnnData(np.random.RandomState(0).rand(len(obs), ngenes), obs,
+                           pd.DataFrame(index=['gene_{}'.format(i) for i in range(ngenes)]))
+
+
+def make_small_ot_model(ds, tmap_out, **kwargs):
+    """OTModel with few iterations, so that transport maps are computed quickly"""
+    return wot.ot.OTModel(ds, tmap_out, **{'local_pca': 0, 'scaling_iter': 20, 'growth_iters': 1, **kwargs})
 
 
 class TestOT(unittest.TestCase):
@@ -125,6 +154,572 @@ class TestOT(unittest.TestCase):
                 {trajectory_id[0]: [25450]},
                 index=ids), check_names=False)
 
+    def test_computation_cache_lru(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = wot.ot.ComputationCache(d, max_bytes=2000)
+            keys = [cache.key(np.array(['c1', 'c2']), i) for i in range(3)]
+            self.assertEqual(len(set(keys)), 3)
+            # matrices are hashed by content
+            x = scipy.sparse.csr_matrix(np.eye(3))
+            self.assertEqual(cache.key(x), cache.key(scipy.sparse.csr_matrix(np.eye(3))))
+            self.assertNotEqual(cache.key(x), cache.key(scipy.sparse.csr_matrix(2 * np.eye(3))))
+            cache.put(keys[0], cost=np.zeros(100))
+            cache.put(keys[1], cost=np.ones(100))
+            # touch the first entry so that the second one is the least recently used
+            os.utime(os.path.join(d, keys[1]), (0, 0))
+            np.testing.assert_array_equal(cache.get(keys[0])['cost'], np.zeros(100))
+            cache.put(keys[2], cost=np.ones(100))
+            self.assertIsNone(cache.get(keys[1]))
+            self.assertIsNotNone(cache.get(keys[0]))
+            self.assertIsNotNone(cache.get(keys[2]))
+
+    def test_shared_dataset(self):
+        obs = pd.DataFrame(index=['c1', 'c2', 'c3'], data={'day': [0., 1., 1.], 'batch': ['a', 'b', 'a']})
+        obs['batch'] = obs['batch'].astype('category')
+        ds = anndata.AnnData(scipy.sparse.csr_matrix(np.eye(3)), obs, pd.DataFrame(index=['g1', 'g2', 'g3']))
+        with tempfile.TemporaryDirectory() as d:
+            shared = wot.ot.SharedDataset(ds, directory=d)
+            self.assertEqual(os.path.dirname(shared.directory), d)
+            attached = shared.attach()
+            np.testing.assert_array_equal(attached.X.toarray(), np.eye(3))
+            pd.testing.assert_frame_equal(attached.obs, obs)
+            shared.close()
+            self.assertEqual(os.listdir(d), [])
+
+    def test_scheduler_memory_budget(self):
+        scheduler = wot.ot.TransportMapScheduler(2, max_memory=100, blas_threads=1)
+        tasks = [('a', 60, max, (1, 2)), ('b', 70, max, (3, 4)), ('c', 500, max, (5, 6))]
+        results = dict(scheduler.run(tasks))
+        self.assertEqual(results, {'a': 2, 'b': 4, 'c': 6})
+        self.assertGreater(wot.ot.estimate_transport_map_bytes(100, 200, 10),
+                           wot.ot.estimate_transport_map_bytes(100, 100, 10))
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as d:
+            manifest = wot.ot.TransportMapManifest(os.path.join(d, 'tmaps_manifest.json'))
+            self.assertFalse(manifest.exists())
+            self.assertIsNone(manifest.get('tmaps_0_1.h5ad'))
+            manifest.update('tmaps_0_1.h5ad', {'digest': 'a'})
+            manifest.update('tmaps_1_2.h5ad', {'digest': 'b'})
+            manifest.update('tmaps_0_1.h5ad', {'digest': 'c'})
+            self.assertEqual(manifest.read(), {'tmaps_0_1.h5ad': {'digest': 'c'}, 'tmaps_1_2.h5ad': {'digest': 'b'}})
+            self.assertEqual(sorted(os.listdir(d)), ['tmaps_manifest.json'])
+            # transport maps written before the manifest, without an entry, are trusted
+            ot_model = make_small_ot_model(make_small_dataset(20), os.path.join(d, 'tmaps'))
+            open(os.path.join(d, 'tmaps_0.0_1.0.h5ad'), 'w').close()
+            self.assertTrue(ot_model.is_transport_map_current(0., 1.))
+            ot_model.manifest.update('tmaps_0.0_1.0.h5ad', {'digest': 'a'})
+            self.assertFalse(ot_model.is_transport_map_current(0., 1.))
+
+    def test_checkpoint_resume(self):
+        class InterruptingCheckpoint(wot.ot.SolverCheckpoint):
+            def save(self, **state):
+                super().save(**state)
+                if state['growth_iter'] == 1 and state['iteration'] == 70:
+                    raise KeyboardInterrupt()
+
+        rng = np.random.RandomState(0)
+        C = sklearn.metrics.pairwise.pairwise_distances(rng.rand(20, 5), rng.rand(30, 5), metric='sqeuclidean')
+        params = dict(lambda1=1, lambda2=50, epsilon=0.05, scaling_iter=100, g=np.ones(20), tau=10000,
+                      epsilon0=1, growth_iters=3, inner_iter_max=10)
+        expected = wot.ot.transport_stable_learn_growth(C, **params)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'checkpoint.npz')
+            with self.assertRaises(KeyboardInterrupt):
+                wot.ot.transport_stable_learn_growth(C, checkpoint=InterruptingCheckpoint(path, interval=0,
+                                                                                          digest='a'), **params)
+            self.assertTrue(os.path.isfile(path))
+            self.assertIsNone(wot.ot.SolverCheckpoint(path, digest='b').load(C.shape))
+            resumed = wot.ot.transport_stable_learn_growth(C, checkpoint=wot.ot.SolverCheckpoint(path, digest='a'),
+                                                           **params)
+        np.testing.assert_allclose(resumed, expected)
+
+    def test_downsample_counts(self):
+        rng = np.random.RandomState(0)
+        x = rng.poisson(2, size=(200, 100)).astype(np.float32)
+        x[:10] = 0
+        x[:10, 0] = 5
+        original = x.copy()
+        for matrix in [x, scipy.sparse.csr_matrix(x)]:
+            downsampled = wot.downsample_counts(matrix, 50, seed=1)
+            self.assertEqual(downsampled.dtype, x.dtype)
+            dense = downsampled.toarray() if scipy.sparse.issparse(downsampled) else downsampled
+            np.testing.assert_array_equal(dense[:10], x[:10])
+            self.assertTrue(np.all(dense <= x))
+            self.assertAlmostEqual(dense[10:].sum(axis=1).mean(), 50, delta=2)
+            repeated = wot.downsample_counts(matrix, 50, seed=1)
+            np.testing.assert_array_equal(dense, repeated.toarray() if scipy.sparse.issparse(repeated) else repeated)
+        np.testing.assert_array_equal(x, original)
+
+    def test_row_index(self):
+        rng = np.random.RandomState(0)
+        obs = pd.DataFrame(index=['cell_{}'.format(i) for i in range(60)],
+                           data={'day': rng.randint(0, 3, 60).astype(float), 'covariate': rng.randint(0, 2, 60)})
+        ds = anndata.AnnData(rng.rand(60, 5), obs, pd.DataFrame(index=['gene_{}'.format(i) for i in range(5)]))
+        ot_model = wot.ot.OTModel(ds, None, local_pca=0, gene_filter='gene_[0-3]', cell_day_filter='0,2')
+        self.assertEqual(ot_model.timepoints, [0, 2])
+        self.assertEqual(list(ot_model.matrix.var.index), ['gene_0', 'gene_1', 'gene_2', 'gene_3'])
+        for covariate in [None, (0, 1)]:
+            p0, p1 = ot_model.get_pair_datasets(0, 2, covariate)
+            p0_query = obs['day'] == 0
+            p1_query = obs['day'] == 2
+            if covariate is not None:
+                p0_query &= obs['covariate'] == covariate[0]
+                p1_query &= obs['covariate'] == covariate[1]
+            self.assertEqual(set(p0.obs.index), set(obs.index[p0_query]))
+            self.assertEqual(set(p1.obs.index), set(obs.index[p1_query]))
+            np.testing.assert_array_equal(p1.X, ds[p1.obs.index, :4].X)
+            self.assertEqual(ot_model.get_cell_counts(0, 2, covariate), (p0_query.sum(), p1_query.sum()))
+
+    def test_transport_map_writer(self):
+        written = []
+        with wot.ot.TransportMapWriter() as writer:
+            for i in range(5):
+                writer.submit(written.append, i)
+        self.assertEqual(written, [0, 1, 2, 3, 4])
+
+        def fail(i):
+            raise ValueError(i)
+
+        with self.assertRaises(ValueError):
+            with wot.ot.TransportMapWriter() as writer:
+                writer.submit(fail, 0)
+                writer.submit(written.append, 5)
+        self.assertEqual(written[-1], 4)
+
+    def test_lease(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, '.tmaps_0_1.lease')
+            lease = wot.ot.Lease(path, timeout=60)
+            self.assertTrue(lease.acquire())
+            self.assertFalse(wot.ot.Lease(path, timeout=60).acquire())
+            lease.release()
+            self.assertFalse(os.path.exists(path))
+            # abandoned by a crashed worker
+            with open(path, 'w'):
+                pass
+            os.utime(path, (0, 0))
+            other = wot.ot.Lease(path, timeout=60)
+            self.assertTrue(other.acquire())
+            self.assertFalse(other.is_expired())
+            other.release()
+            self.assertEqual(os.listdir(d), [])
+
+    def test_iter_transport_maps(self):
+        ds = make_small_dataset(20, 5)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+            self.assertEqual(sorted(tmaps), [(0, 1), (1, 2)])
+            self.assertTrue(os.path.isfile(os.path.join(d, 'tmaps_1.0_2.0.h5ad')))
+            # the hidden files the transport maps were written to are renamed
+            self.assertEqual([name for name in os.listdir(d) if name.startswith('.tmaps_')], [])
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        self.assertEqual(list(tmap_model.meta.index), list(ds.obs.index))
+        np.testing.assert_array_equal(tmap_model.get_transport_map(1, 2).X, tmaps[(1, 2)].X)
+
+    def test_batch_transport_maps(self):
+        ds = make_small_dataset(20, 5, days=[0., 1.])
+        with tempfile.TemporaryDirectory() as d:
+            batch = []
+            for name in ['a', 'b']:
+                ds.write(os.path.join(d, name + '.h5ad'))
+                ds.obs.rename_axis('id').to_csv(os.path.join(d, name + '_days.txt'), sep='\t')
+                batch.append([os.path.join(d, name + '.h5ad'), os.path.join(d, name + '_days.txt'),
+                              os.path.join(d, name + '_tmaps')])
+            batch[0] += [None, '1G']
+            batch[1] += ['0.1', None]
+            pd.DataFrame(batch, columns=['matrix', 'cell_days', 'out', 'epsilon', 'max_pair_bytes']).to_csv(
+                os.path.join(d, 'batch.txt'), sep='\t', index=False)
+            experiments = wot.commands.read_batch(os.path.join(d, 'batch.txt'))
+            self.assertEqual([e['overrides'] for e in experiments], [{'max_pair_bytes': 1 << 30}, {'epsilon': 0.1}])
+            self.assertTrue(wot.commands.optimal_transport_batch.supports_lazy_loading(batch[0][0]))
+            self.assertFalse(wot.commands.optimal_transport_batch.supports_lazy_loading(batch[0][1]))
+            wot.commands.optimal_transport_batch.main(['--batch', os.path.join(d, 'batch.txt'), '--max_threads', '2',
+                                                       '--local_pca', '0', '--scaling_iter', '20'])
+            for name in ['a', 'b']:
+                self.assertTrue(os.path.isfile(os.path.join(d, name + '_tmaps_0.0_1.0.h5ad')))
+            manifest = wot.ot.TransportMapManifest(os.path.join(d, 'b_tmaps_manifest.json'))
+            self.assertEqual(manifest.get('b_tmaps_0.0_1.0.h5ad')['ot_config']['epsilon'], 0.1)
+
+    def test_ncells_seed(self):
+        ds = make_small_dataset(20, 5)
+        with tempfile.TemporaryDirectory() as d:
+            ids = []
+            for i in range(2):
+                # cells are sampled with the seed, whatever the state of the global random number generator
+                np.random.rand()
+                ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'), ncells=5, seed=0)
+                ids.append(list(ot_model.matrix.obs.index))
+            self.assertEqual(len(ids[0]), 15)
+            self.assertEqual(ids[0], ids[1])
+
+    def test_max_pair_bytes(self):
+        ds = make_small_dataset(50, 5)
+        ds.obs['covariate'] = np.tile([0, 0, 1], 50)
+        budget = wot.ot.estimate_transport_map_bytes(30, 30, 5)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'),
+                                      max_pair_bytes=budget, seed=0)
+            for x in ot_model.get_day_pairs():
+                n0, n1 = ot_model.get_cell_counts(*x)
+                self.assertLessEqual(wot.ot.estimate_transport_map_bytes(n0, n1, 5), budget)
+                self.assertGreater(n0, 25)
+            # stratified by covariate and nested
+            sample = ot_model.get_day_sample(1, 0.3)
+            self.assertEqual(list(ot_model.matrix.obs['covariate'].values[sample]).count(1), 5)
+            self.assertTrue(set(sample) <= set(ot_model.get_day_sample(1, 0.6)))
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+        # a day is sampled identically in both of its transport maps
+        self.assertEqual(list(tmaps[(0, 1)].var.index), list(tmaps[(1, 2)].obs.index))
+        np.testing.assert_array_equal(tmaps[(0, 1)].var['sample_index'], tmaps[(1, 2)].obs['sample_index'])
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        population = tmap_model.population_from_ids(tmaps[(0, 1)].obs.index[:2], at_time=0)[0]
+        self.assertEqual(len(tmap_model.push_forward(population, to_time=2).p), tmaps[(1, 2)].shape[1])
+
+    def test_factored_transport_map(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'), local_pca=3, scaling_iter=50, growth_iters=2,
+                                      factored=True)
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+            written = wot.io.read_dataset(os.path.join(d, 'tmaps_0.0_1.0.h5ad'))
+            self.assertEqual(written.X.nnz, 0)
+            tmap = wot.tmap.FactoredTransportMap(written, tile_size=50)
+            np.testing.assert_allclose(tmap.X, tmaps[(0, 1)].X, rtol=1e-8)
+            p = np.random.RandomState(0).rand(2, 20)
+            np.testing.assert_allclose(tmap.push_forward(p), p @ tmaps[(0, 1)].X, rtol=1e-8)
+            np.testing.assert_allclose(tmap.pull_back(p), (tmaps[(0, 1)].X @ p.T).T, rtol=1e-8)
+            tmap_model = wot.tmap.TransportMapModel(
+                {(0., 1.): os.path.join(d, 'tmaps_0.0_1.0.h5ad'), (1., 2.): os.path.join(d, 'tmaps_1.0_2.0.h5ad')},
+                ot_model.matrix.obs)
+            population = wot.Population(0., np.ones(20) / 20)
+            expected = wot.tmap.TransportMapModel.from_transport_maps(tmaps).push_forward(population, to_time=2)
+            np.testing.assert_allclose(tmap_model.push_forward(population, to_time=2).p, expected.p, rtol=1e-8)
+
+    def test_extend_transport_map(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'), local_pca=3, scaling_iter=500, growth_iters=1,
+                                           extensible=True)
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+            written = wot.io.read_dataset(os.path.join(d, 'tmaps_0.0_1.0.h5ad'))
+            self.assertIn('X_ot', written.obsm)
+            self.assertIn('ot', written.uns)
+        # copies of existing cells are placed where the solver placed them
+        new_cells = anndata.AnnData(ds.X[20:23], pd.DataFrame(index=['new_0', 'new_1', 'new_2']), ds.var)
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        extended = tmap_model.extend(new_cells, 1, growth_rates=np.ones(3))
+        self.assertEqual(sorted(extended), [(0, 1), (1, 2)])
+        tmap = tmap_model.get_transport_map(1, 2)
+        self.assertEqual(tmap.shape, (23, 20))
+        np.testing.assert_allclose(tmap.X[20:], tmaps[(1, 2)].X[:3], rtol=1e-3)
+        self.assertEqual(tmap_model.get_transport_map(0, 1).shape, (20, 23))
+        self.assertEqual(list(tmap_model.meta.index[40:43]), ['new_0', 'new_1', 'new_2'])
+        population = tmap_model.population_from_ids(['new_0'], at_time=1)[0]
+        self.assertEqual(len(tmap_model.pull_back(population).p), 20)
+
+    def test_extend_transport_maps_command(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            make_small_ot_model(ds, os.path.join(d, 'tmaps'), local_pca=3, extensible=True).compute_all_transport_maps()
+            new_cells = anndata.AnnData(ds.X[20:23], pd.DataFrame(index=['new_0', 'new_1', 'new_2']), ds.var)
+            new_cells.write(os.path.join(d, 'new.h5ad'))
+            pd.DataFrame(index=pd.Index(new_cells.obs.index, name='id'), data={'day': [2., 2., 2.]}).to_csv(
+                os.path.join(d, 'new_days.txt'), sep='\t')
+            # the transport map from day 0 to 1 has no new cells and is left in place
+            wot.commands.extend_transport_maps.main(['--tmap', os.path.join(d, 'tmaps'),
+                                                     '--matrix', os.path.join(d, 'new.h5ad'),
+                                                     '--cell_days', os.path.join(d, 'new_days.txt'),
+                                                     '--out', os.path.join(d, 'tmaps')])
+            self.assertEqual(wot.io.read_dataset(os.path.join(d, 'tmaps_0.0_1.0.h5ad')).shape, (20, 20))
+            self.assertEqual(wot.io.read_dataset(os.path.join(d, 'tmaps_1.0_2.0.h5ad')).shape, (20, 23))
+
+    def test_transport_map_cache(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            ot_model.compute_all_transport_maps()
+            written = wot.io.read_dataset(os.path.join(d, 'tmaps_0.0_1.0.h5ad'))
+            # potentials and coordinates are only stored on request
+            self.assertNotIn('X_ot', written.obsm)
+            self.assertNotIn('ot', written.uns)
+            tmap_bytes = wot.tmap.get_transport_map_bytes(written)
+            # room for a single transport map
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'), cache=tmap_bytes,
+                                                                 prefetch=False)
+            population = wot.Population(0., np.ones(20) / 20)
+            tmap_model.push_forward(population, to_time=2)
+            tmap_model.push_forward(population, to_time=1)
+            self.assertEqual((tmap_model.cache.hits, tmap_model.cache.misses), (0, 3))
+            tmap_model.get_transport_map(0, 1)
+            self.assertEqual((tmap_model.cache.hits, tmap_model.cache.misses), (1, 3))
+            self.assertEqual(len(tmap_model.cache), 1)
+            self.assertLessEqual(tmap_model.cache.nbytes, tmap_bytes)
+            np.testing.assert_allclose(tmap_model.get_transport_map(0, 2).X,
+                                       tmap_model.get_transport_map(0, 1).X @ tmap_model.get_transport_map(1, 2).X)
+            uncached = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'))
+            uncached.get_transport_map(0, 1)
+            uncached.get_transport_map(0, 1)
+            self.assertEqual((uncached.cache.hits, uncached.cache.misses, len(uncached.cache)), (0, 2, 0))
+
+    def test_legacy_trajectory_cache(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            make_small_ot_model(ds, os.path.join(d, 'tmaps')).compute_all_transport_maps()
+            tmap_bytes = wot.tmap.get_transport_map_bytes(wot.io.read_dataset(os.path.join(d, 'tmaps_0.0_1.0.h5ad')))
+            time_to_cell_sets = {1.: [{'name': 'a', 'set': {'cell_20', 'cell_21'}}]}
+            results = []
+            for cache in [True, False, tmap_bytes]:
+                transport_maps = [{'t1': t, 't2': t + 1, 'path': os.path.join(d, 'tmaps_{}_{}.h5ad'.format(t, t + 1))}
+                                  for t in [0., 1.]]
+                results.append(wot.tmap.Trajectory.trajectory_for_cell_sets(transport_maps, time_to_cell_sets,
+                                                                             cache_transport_maps=cache))
+                # only True keeps the transport maps with their paths
+                self.assertEqual(all('ds' in tmap_dict for tmap_dict in transport_maps), cache is True)
+            for result in results[1:]:
+                self.assertEqual(len(result), len(results[0]))
+                for trajectory, expected in zip(result, results[0]):
+                    np.testing.assert_allclose(trajectory['p'], expected['p'])
+
+    def test_prefetch_transport_maps(self):
+        ds = make_small_dataset(20, days=[0., 1., 2., 3.])
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            ot_model.compute_all_transport_maps()
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'), cache=True)
+            self.assertTrue(tmap_model.prefetch)
+            uncached = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'))
+            self.assertFalse(uncached.prefetch)
+            population = wot.Population(0., np.ones(20) / 20)
+            np.testing.assert_allclose(tmap_model.push_forward(population, to_time=3).p,
+                                       uncached.push_forward(population, to_time=3).p)
+            # the maps from 1 to 2 and from 2 to 3 were read while the previous ones were applied
+            self.assertEqual((tmap_model.prefetch_hits, tmap_model.cache.misses, len(tmap_model.cache)), (2, 1, 3))
+            population = wot.Population(3., np.ones(20) / 20)
+            np.testing.assert_allclose(tmap_model.pull_back(population, to_time=0).p,
+                                       uncached.pull_back(population, to_time=0).p)
+            self.assertEqual(tmap_model.cache.hits, 3)
+            tmap_model.close()
+            path = os.path.join(d, 'tmaps_0.0_1.0.h5ad')
+            tmap_bytes = wot.tmap.get_transport_map_bytes(wot.io.read_dataset(path))
+            self.assertEqual(wot.tmap.estimate_transport_map_file_bytes(path), tmap_bytes)
+            # prefetched transport maps are counted against the cache budget, room for one here
+            bounded = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'), cache=tmap_bytes,
+                                                                prefetch=True)
+            bounded.get_transport_map(0., 1.)
+            bounded.prefetch_transport_map(1., 2.)
+            self.assertEqual(bounded.cache.stats()['reserved'], tmap_bytes)
+            self.assertEqual(len(bounded.cache), 0)
+            bounded.prefetch_transport_map(2., 3.)
+            self.assertEqual(bounded.cache.stats()['reserved'], tmap_bytes)
+            bounded.get_transport_map(1., 2.)
+            self.assertEqual((bounded.prefetch_hits, bounded.cache.stats()['reserved']), (1, 0))
+            self.assertLessEqual(bounded.cache.nbytes, tmap_bytes)
+            bounded.close()
+
+    def test_transport_map_catalog(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            ot_model.compute_all_transport_maps()
+            catalog = wot.tmap.TransportMapCatalog(os.path.join(d, 'tmaps'))
+            # written as the transport maps were computed
+            self.assertTrue(catalog.read())
+            self.assertTrue(catalog.is_current())
+            self.assertEqual(catalog.entries['tmaps_0.0_1.0.h5ad']['key'], (0, 1))
+            self.assertEqual(catalog.entries['tmaps_0.0_1.0.h5ad']['shape'], (20, 20))
+            np.testing.assert_array_equal(catalog.ids[2], ds.obs.index[40:])
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'))
+            self.assertEqual(tmap_model.timepoints, [0, 1, 2])
+            self.assertEqual(tmap_model.day_pairs, {(0, 1), (1, 2)})
+            pd.testing.assert_frame_equal(tmap_model.meta, ds.obs, check_names=False)
+            os.utime(os.path.join(d, 'tmaps_0.0_1.0.h5ad'), ns=(0, 0))
+            self.assertFalse(catalog.is_current())
+            self.assertTrue(catalog.load().is_current())
+            # removed transport maps are noticed, and the catalog is rebuilt from the files
+            os.remove(os.path.join(d, 'tmaps_1.0_2.0.h5ad'))
+            self.assertFalse(catalog.is_current())
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'))
+            self.assertEqual(tmap_model.timepoints, [0, 1])
+            self.assertEqual(list(tmap_model.meta.index), list(ds.obs.index[:40]))
+            self.assertEqual(sorted(catalog.load().entries), ['tmaps_0.0_1.0.h5ad'])
+            self.assertEqual(wot.tmap.read_transport_map_header(os.path.join(d, 'tmaps_0.0_1.0.h5ad'), obs_ids=False)[:3],
+                             ((20, 20), 'float64', None))
+
+    def test_partial_transport_map_reads(self):
+        ds = make_small_dataset(30)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+            with h5py.File(os.path.join(d, 'tmaps_0.0_1.0.h5ad'), 'r') as f:
+                self.assertEqual(f['X'].chunks, (30, 30))
+            expected = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'))
+            population = tmap_model.population_from_ids(['cell_3', 'cell_17'], at_time=0)[0]
+            np.testing.assert_allclose(tmap_model.push_forward(population).p, expected.push_forward(population).p)
+            population = tmap_model.population_from_ids(['cell_65'], at_time=2)[0]
+            np.testing.assert_allclose(tmap_model.pull_back(population).p, expected.pull_back(population).p)
+            # only the rows and columns of the cells were read
+            self.assertEqual(tmap_model.cache.misses, 0)
+            np.testing.assert_allclose(tmap_model.pull_back(population, to_time=0).p,
+                                       expected.pull_back(population, to_time=0).p)
+            self.assertEqual(tmap_model.cache.misses, 1)
+
+    def test_chain_transport_maps(self):
+        split, cost = wot.tmap.matrix_chain_order([10, 100, 5, 50])
+        self.assertEqual((split[(0, 3)], split[(0, 2)], cost), (2, 1, 10 * 100 * 5 + 10 * 5 * 50))
+        self.assertEqual(wot.tmap.matrix_chain_order([10, 100, 5, 50], known={(0, 2)})[1], 10 * 5 * 50)
+        ds = make_small_dataset([10, 30, 5, 20], days=[0., 1., 2., 3.])
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'), cache=True)
+            expected = tmaps[(0, 1)].X @ tmaps[(1, 2)].X @ tmaps[(2, 3)].X
+            np.testing.assert_allclose(tmap_model.get_transport_map(0, 3).X, expected)
+            # (0, 1) and (1, 2) are multiplied first, through the 5 cells of day 2
+            self.assertIn(((0, 1), (1, 2)), tmap_model.cache)
+            self.assertNotIn(((1, 2), (2, 3)), tmap_model.cache)
+            hits = tmap_model.cache.hits
+            np.testing.assert_allclose(tmap_model.get_transport_map(0, 2).X, tmaps[(0, 1)].X @ tmaps[(1, 2)].X)
+            self.assertEqual(tmap_model.cache.hits, hits + 1)
+            population = wot.Population(0., np.ones(10) / 10)
+            np.testing.assert_allclose(tmap_model.push_forward(population, to_time=3, normalize=False).p,
+                                       population.p @ expected)
+            self.assertEqual(tmap_model.cache.hits, hits + 2)
+
+    def test_propagation_engine(self):
+        ds = make_small_dataset(20, days=[0., 1., 2., 3.])
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): ot_model.compute_transport_map(t0, t1) for t0, t1 in ot_model.get_day_pairs()}
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        populations = tmap_model.population_from_cell_sets({'a': {'cell_20', 'cell_21'}, 'b': {'cell_30'}}, at_time=1)
+        cell_sets = anndata.AnnData(np.random.RandomState(0).randint(2, size=(80, 3)).astype(float), ds.obs,
+                                    pd.DataFrame(index=['s1', 's2', 's3']))
+        engine = wot.tmap.PropagationEngine(tmap_model)
+        engine.add_reducer('trajectory', wot.tmap.trajectory_reducer())
+        engine.add_reducer('census', wot.tmap.census_reducer(tmap_model, cell_sets))
+        engine.add_reducer('trends', wot.tmap.trends_reducer(tmap_model, ds))
+        timepoints, results = engine.run(*populations.values())
+        self.assertEqual(timepoints, [0, 1, 2, 3])
+        trajectory_ds = tmap_model.compute_trajectories(populations)
+        np.testing.assert_allclose(np.concatenate(results['trajectory']), trajectory_ds.X)
+        ancestors = tmap_model.pull_back(*populations.values(), to_time=0, as_list=True)
+        np.testing.assert_allclose(results['trajectory'][0].T, [pop.p for pop in ancestors])
+        np.testing.assert_allclose(results['census'][0], tmap_model.population_census(cell_sets, *ancestors))
+        trajectory_ds.obs['day'] = ds.obs['day'].values
+        (mean, variance), _ = wot.tmap.compute_trajectory_trends_from_trajectory(trajectory_ds, ds)
+        np.testing.assert_allclose(np.array([m[0] for m, v in results['trends']]), mean.X)
+        np.testing.assert_allclose(np.array([v[0] for m, v in results['trends']]), variance.X, atol=1e-12)
+        _, means, variances = wot.tmap.compute_trajectory_trends(tmap_model, *populations.values(), ds=ds)
+        np.testing.assert_allclose(means[0], mean.X)
+
+    def test_fate_matrix(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): ot_model.compute_transport_map(t0, t1) for t0, t1 in ot_model.get_day_pairs()}
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        cell_sets = {'a': ['cell_{}'.format(i) for i in range(40, 45)], 'b': ['cell_{}'.format(i) for i in range(50, 60)]}
+        fates = tmap_model.compute_fate_matrix(cell_sets, 2, normalize=False)
+        self.assertEqual(fates.shape, (60, 2))
+        np.testing.assert_array_equal(fates.X[40:, 0], np.arange(40, 60) < 45)
+        # the descendants of a cell, pushed forward on their own
+        population = tmap_model.population_from_ids(['cell_7'], at_time=0)[0]
+        descendants = tmap_model.push_forward(population, to_time=2).p
+        np.testing.assert_allclose(fates.X[7], [descendants[:5].sum(), descendants[10:].sum()])
+        normalized = tmap_model.compute_fate_matrix(cell_sets, 2)
+        np.testing.assert_allclose(normalized.X[:40].sum(axis=1), 1)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'fates.h5ad')
+            self.assertIsNone(tmap_model.compute_fate_matrix(cell_sets, 2, out=path))
+            written = anndata.read_h5ad(path)
+            np.testing.assert_allclose(written.X, normalized.X)
+            self.assertEqual(list(written.obs.index), list(ds.obs.index))
+        # days without cells in meta are skipped
+        days = tmap_model.meta['day'].values
+        partial = wot.tmap.TransportMapModel(tmaps, tmap_model.meta[days > 0], timepoints=[0., 1., 2.])
+        np.testing.assert_allclose(partial.compute_fate_matrix(cell_sets, 2, normalize=False).X, fates.X[20:])
+
+    def test_sparse_population(self):
+        population = wot.Population(1, indices=[4, 1], weights=[0.75, 0.25], size=6)
+        self.assertTrue(population.is_sparse)
+        np.testing.assert_array_equal(population.p, [0, 0.25, 0, 0, 0.75, 0])
+        stacked = wot.Population.stack([population, wot.Population(1, indices=[2], size=6)])
+        self.assertTrue(scipy.sparse.isspmatrix_csr(stacked))
+        np.testing.assert_array_equal(stacked.toarray()[1], [0, 0, 1, 0, 0, 0])
+        self.assertIsInstance(wot.Population.stack([population, wot.Population(1, np.ones(6))]), np.ndarray)
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            tmaps = {(t0, t1): ot_model.compute_transport_map(t0, t1) for t0, t1 in ot_model.get_day_pairs()}
+        tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        populations = tmap_model.population_from_ids(['cell_21', 'cell_22'], ['cell_30'], at_time=1)
+        self.assertTrue(all(pop.is_sparse for pop in populations))
+        dense = [wot.Population(pop.time, pop.p) for pop in populations]
+        for sparse_result, dense_result in zip(tmap_model.push_forward(*populations, as_list=True),
+                                               tmap_model.push_forward(*dense, as_list=True)):
+            np.testing.assert_allclose(sparse_result.p, dense_result.p)
+        for sparse_result, dense_result in zip(tmap_model.pull_back(*populations, as_list=True),
+                                               tmap_model.pull_back(*dense, as_list=True)):
+            np.testing.assert_allclose(sparse_result.p, dense_result.p)
+        # populations spread over every cell after a step and are stored densely
+        self.assertFalse(tmap_model.push_forward(populations[0]).is_sparse)
+        self.assertTrue(wot.Population.from_matrix(1, np.eye(20)[:2])[0].is_sparse)
+
+    def test_transport_map_server(self):
+        ds = make_small_dataset(20)
+        with tempfile.TemporaryDirectory() as d:
+            ot_model = make_small_ot_model(ds, os.path.join(d, 'tmaps'))
+            ot_model.compute_all_transport_maps()
+            with open(os.path.join(d, 'sets.gmt'), 'w') as f:
+                f.write('a\ta\tcell_20\tcell_21\n')
+            tmap_model = wot.tmap.TransportMapModel.from_directory(os.path.join(d, 'tmaps'), cache=True)
+            server = wot.commands.TransportMapServer(tmap_model, os.path.join(d, 'tmaps'), ('127.0.0.1', 0))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                address = '{}:{}'.format(*server.server_address[:2])
+                argv = ['--tmap', os.path.join(d, 'tmaps'), '--cell_set', os.path.join(d, 'sets.gmt'), '--time', '1',
+                        '--out', os.path.join(d, 'served'), '--server', address, '--server_token', server.token]
+                wot.commands.trajectory.main(argv)
+                reads = (tmap_model.cache.misses, tmap_model.prefetch_hits)
+                hits = tmap_model.cache.hits
+                wot.commands.trajectory.main(argv)
+                wot.commands.trajectory.main(['--tmap', os.path.join(d, 'tmaps'), '--cell_set',
+                                              os.path.join(d, 'sets.gmt'), '--time', '1', '--out',
+                                              os.path.join(d, 'local')])
+                served = pd.read_csv(os.path.join(d, 'served.txt'), sep='\t', index_col=0)
+                pd.testing.assert_frame_equal(served, pd.read_csv(os.path.join(d, 'local.txt'), sep='\t', index_col=0))
+                # the second request found the transport maps in memory
+                self.assertEqual(server.requests, 2)
+                self.assertEqual((tmap_model.cache.misses, tmap_model.prefetch_hits), reads)
+                self.assertGreater(tmap_model.cache.hits, hits)
+                with self.assertRaises(ValueError):
+                    wot.commands.send_to_server(address, 'trajectory', argparse.Namespace(tmap=os.path.join(d, 'b'),
+                                                                                          server_token=server.token))
+                with self.assertRaises(ValueError):
+                    wot.commands.send_to_server(address, 'transition_table',
+                                                argparse.Namespace(server_token=server.token))
+                with self.assertRaises(ValueError):
+                    wot.commands.send_to_server(address, 'trajectory', argparse.Namespace(server_token='wrong'))
+                # requests that a web page could send are rejected
+                url = 'http://{}/trajectory'.format(address)
+                for headers, status in [({'Content-Type': 'text/plain', 'X-Wot-Token': server.token}, 415),
+                                        ({'Content-Type': 'application/json'}, 403),
+                                        ({'Content-Type': 'application/json', 'X-Wot-Token': server.token,
+                                          'Host': 'example.com:{}'.format(server.server_address[1])}, 403)]:
+                    with self.assertRaises(urllib.error.HTTPError) as e:
+                        urllib.request.urlopen(urllib.request.Request(url, data=b'{}', headers=headers))
+                    self.assertEqual(e.exception.code, status)
+                    e.exception.close()
+                self.assertEqual(server.requests, 2)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
 
 if __name__ == '__main__':
     unittest.main()
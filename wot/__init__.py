@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+__version__ = '0.3.8'
+
 import wot.io
 import wot.simulate
 import wot.tmap
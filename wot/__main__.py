@@ -7,9 +7,9 @@ from wot.commands import *
 
 
 def main():
-    command_list = [convert_matrix, cells_by_gene_set, census, force_layout,
+    command_list = [convert_matrix, cells_by_gene_set, census, extend_transport_maps, fates, force_layout,
                     gene_set_scores, grn, local_enrichment, optimal_transport,
-                    optimal_transport_validation, trajectory,
+                    optimal_transport_batch, optimal_transport_validation, serve, trajectory,
                     trajectory_trends, transition_table]
     parser = argparse.ArgumentParser(description='Run a wot command')
     command_list_strings = list(map(lambda x: x.__name__[len('wot.commands.'):], command_list))
@@ -2,12 +2,16 @@
 from .cells_by_gene_set import *
 from .census import *
 from .convert_matrix import *
+from .extend_transport_maps import *
+from .fates import *
 from .force_layout import *
 from .gene_set_scores import *
 from .grn import *
 from .local_enrichment import *
 from .optimal_transport import *
+from .optimal_transport_batch import *
 from .optimal_transport_validation import *
+from .serve import *
 from .trajectory import *
 from .trajectory_trends import *
 from .transition_table import *
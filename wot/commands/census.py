@@ -7,7 +7,9 @@ import anndata
 import pandas as pd
 
 import wot
+import wot.commands
 import wot.io
+import wot.tmap
 
 
 def main(argv):
@@ -17,10 +19,19 @@ def main(argv):
     parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
     parser.add_argument('--time', help='The starting timepoint at which to consider the cell sets', required=True)
     parser.add_argument('--out', help='Output files prefix', default='census')
+    wot.commands.add_tmap_cache_arguments(parser)
+    wot.commands.add_server_arguments(parser)
 
     args = parser.parse_args(argv)
+    if args.server is not None:
+        wot.commands.send_to_server(args.server, 'census', args, paths=('cell_set', 'out'))
+        return
 
-    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=args.tmap_cache_size or False)
+    run(tmap_model, args)
+
+
+def run(tmap_model, args):
     cell_sets_matrix = wot.io.read_sets(args.cell_set)
     cell_sets = wot.io.convert_binary_dataset_to_dict(cell_sets_matrix)
     populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.time)
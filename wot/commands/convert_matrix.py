@@ -11,7 +11,10 @@ import wot.io
 def main(argv):
     parser = argparse.ArgumentParser(description='Convert matrix data formats')
 
-    parser.add_argument('--format', help=wot.commands.FORMAT_HELP, choices=wot.commands.FORMAT_CHOICES)
+    parser.add_argument('--format', help=wot.commands.FORMAT_HELP + '. day_sorted writes a directory with the cells '
+                                                               'sorted by day, for lazy loading. '
+                                                               'Days must be joined with --obs',
+                        choices=wot.commands.FORMAT_CHOICES + ['day_sorted'])
     parser.add_argument('matrix', help='File(s) to convert', nargs='+')
     parser.add_argument('--obs', help='Row metadata to join with ids in matrix', action='append')
     parser.add_argument('--var', help='Column metadata to join with ids in matrix', action='append')
@@ -27,9 +30,15 @@ def main(argv):
             var.append(pd.read_table(path, index_col='id', engine='python', sep=None))
     for f in files:
         name = wot.io.get_filename_and_extension(f)[0]
-        ds = wot.io.read_dataset(f)
+        day_sorted = args.format == 'day_sorted'
+        # h5ad and loom matrices are converted one day at a time
+        lazy = day_sorted and wot.io.get_filename_and_extension(f)[1] in ('h5ad', 'loom')
+        ds = wot.io.LazyDataset(f) if lazy else wot.io.read_dataset(f)
         for df in obs:
             ds.obs = ds.obs.join(df)
         for df in var:
             ds.var = ds.var.join(df)
-        wot.io.write_dataset(ds, name, output_format=args.format)
+        if day_sorted:
+            wot.io.write_day_sorted_dataset(ds, name + '.day_sorted')
+        else:
+            wot.io.write_dataset(ds, name, output_format=args.format)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shutil
+
+import numpy as np
+
+import wot.commands
+import wot.io
+import wot.ot
+import wot.tmap
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Place new cells in existing transport maps, without computing them again')
+    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    parser.add_argument('--matrix', help='A matrix with the new cells on rows, with at least the genes used to '
+                                         'compute the transport maps', required=True)
+    parser.add_argument('--cell_days', help=wot.commands.CELL_DAYS_HELP, required=True)
+    parser.add_argument('--cell_growth_rates',
+                        help='File with "id" and "cell_growth_rate" headers corresponding to cell id and growth rate '
+                             'per day of the new cells. Defaults to the average growth of the transport maps')
+    parser.add_argument('--out', help='Prefix for the extended transport maps', required=True)
+    parser.add_argument('--factored', action='store_true',
+                        help='Only store the dual potentials and local PCA coordinates of the extended transport maps')
+    args = parser.parse_args(argv)
+
+    ds = wot.io.read_dataset(args.matrix)
+    # the days file takes precedence over days stored with the matrix
+    ds.obs = ds.obs.drop(columns=['day'], errors='ignore')
+    wot.io.add_row_metadata_to_dataset(dataset=ds, days_path=args.cell_days, growth_rates_path=args.cell_growth_rates)
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    days = ds.obs['day'].values
+    for day in sorted(set(days[~np.isnan(days)])):
+        cells = ds[days == day]
+        growth_rates = cells.obs['cell_growth_rate'].values if args.cell_growth_rates is not None else None
+        extended = tmap_model.extend(cells, day, growth_rates=growth_rates)
+        wot.io.verbose("Placed {} cells at day {} in {} transport maps".format(cells.shape[0], day, len(extended)))
+
+    out_dir, out_prefix = os.path.split(args.out)
+    for t0, t1 in sorted(tmap_model.day_pairs):
+        path = os.path.join(out_dir, '{}_{}_{}.h5ad'.format(out_prefix or 'tmaps', t0, t1))
+        tmap = tmap_model.tmaps[(t0, t1)]
+        if isinstance(tmap, wot.tmap.FactoredTransportMap):
+            wot.io.write_dataset(tmap.to_anndata(factored=args.factored), path, output_format='h5ad',
+                                 chunks=wot.ot.OTModel.TMAP_CHUNKS)
+        elif not isinstance(tmap, str):
+            wot.io.write_dataset(tmap, path, output_format='h5ad', chunks=wot.ot.OTModel.TMAP_CHUNKS)
+        elif not (os.path.exists(path) and os.path.samefile(tmap, path)):
+            # transport maps without new cells are copied as they are
+            shutil.copyfile(tmap, path)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import wot.commands
+import wot.io
+import wot.tmap
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        'Compute the probability of each cell to have descendants in each cell set at the given time')
+    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
+    parser.add_argument('--time', help='Timepoint of the cell sets', required=True, type=float)
+    parser.add_argument('--out', help='Output file name', default='fates')
+    parser.add_argument('--format', help=wot.commands.FORMAT_HELP, default='h5ad',
+                        choices=wot.commands.FORMAT_CHOICES)
+    parser.add_argument('--no_normalize', action='store_true',
+                        help='Do not condition the probabilities of each cell on ending in one of the cell sets')
+    wot.commands.add_tmap_cache_arguments(parser)
+    wot.commands.add_server_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.server is not None:
+        wot.commands.send_to_server(args.server, 'fates', args, paths=('cell_set', 'out'))
+        return
+
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=args.tmap_cache_size or False)
+    run(tmap_model, args)
+
+
+def run(tmap_model, args):
+    cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
+    if args.format == 'h5ad':
+        # written one timepoint at a time
+        tmap_model.compute_fate_matrix(cell_sets, args.time, out=wot.io.check_file_extension(args.out, 'h5ad'),
+                                       normalize=not args.no_normalize)
+    else:
+        fates = tmap_model.compute_fate_matrix(cell_sets, args.time, normalize=not args.no_normalize)
+        wot.io.write_dataset(fates, args.out, output_format=args.format)
@@ -14,17 +14,27 @@ def main(argv):
     wot.commands.add_ot_parameters_arguments(parser)
     parser.add_argument('--out', default='./tmaps',
                         help='Prefix for output file names')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the predicted size, peak memory and running time of each transport map, '
+                             'and settings that fit --max_memory, without computing them')
+    parser.add_argument('--worker', action='store_true',
+                        help='Compute transport maps cooperatively with other workers using the same --out, '
+                             'e.g. on several hosts sharing a filesystem')
+    parser.add_argument('--lease_timeout', type=float, default=600,
+                        help='Seconds after which the day pair of an unresponsive worker is computed by another')
     # parser.add_argument('--format', default='loom', help='Transport map file format.',
     #                     choices=wot.commands.FORMAT_CHOICES)
     args = parser.parse_args(argv)
     ot_model = wot.ot.initialize_ot_model(args.matrix, args.cell_days,
                                           tmap_out=args.out,
+                                          lazy=args.lazy,
                                           local_pca=args.local_pca,
                                           growth_iters=args.growth_iters,
                                           epsilon=args.epsilon,
                                           lambda1=args.lambda1,
                                           lambda2=args.lambda2,
                                           max_threads=args.max_threads,
+                                          max_memory=args.max_memory,
                                           epsilon0=args.epsilon0,
                                           tau=args.tau,
                                           day_pairs=args.config,
@@ -37,7 +47,25 @@ def main(argv):
                                           scaling_iter=args.scaling_iter,
                                           inner_iter_max=args.inner_iter_max,
                                           force=args.force,
+                                          cache=args.cache,
+                                          cache_max_bytes=args.cache_size,
+                                          checkpoint_interval=args.checkpoint_interval,
+                                          extensible=args.extensible,
+                                          factored=args.factored,
                                           ncells=args.ncells,
-                                          ncounts=args.ncounts
+                                          max_pair_bytes=args.max_pair_bytes,
+                                          ncounts=args.ncounts,
+                                          seed=args.seed
                                           )
-    ot_model.compute_all_transport_maps()
+    if args.plan:
+        plan, suggestions = ot_model.plan()
+        print(plan.to_string(index=False, formatters={'peak_bytes': wot.commands.format_bytes,
+                                                      'seconds': '{:.1f}'.format}))
+        print('Total: {:.1f}s'.format(plan['seconds'].sum()))
+        for suggestion in suggestions:
+            print(suggestion)
+        return
+    if args.worker:
+        ot_model.run_worker(lease_timeout=args.lease_timeout)
+    else:
+        ot_model.compute_all_transport_maps()
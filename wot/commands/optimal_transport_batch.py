@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+
+import pandas as pd
+
+import wot.commands
+import wot.io
+import wot.ot
+
+BATCH_REQUIRED_COLUMNS = ['matrix', 'cell_days', 'out']
+# sizes, given as on the command line (e.g. 8G)
+BATCH_BYTES_COLUMNS = ['max_pair_bytes', 'cache_max_bytes']
+
+
+def parse_batch_value(value):
+    """Converts a batch file entry to a bool, int, float or str"""
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_batch(path):
+    """
+    Reads a batch file describing one experiment per line.
+
+    Parameters
+    ----------
+    path : str
+        Path to a tab or comma separated file with columns "matrix", "cell_days" and "out".
+        Other columns override parameters of wot.ot.initialize_ot_model for their experiment (e.g. epsilon,
+        lambda1, ncells or day_pairs). Empty entries keep the value given on the command line. Sizes such as
+        max_pair_bytes can be given with a unit, e.g. 8G.
+
+    Returns
+    -------
+    experiments : list of dict
+        The matrix, cell_days, out and overrides of each experiment.
+    """
+    df = pd.read_table(path, sep=None, engine='python', dtype=str)
+    missing = [c for c in BATCH_REQUIRED_COLUMNS if c not in df.columns]
+    if len(missing) > 0:
+        raise ValueError("Batch file {} is missing columns {}".format(path, missing))
+    experiments = []
+    for _, row in df.iterrows():
+        overrides = {c: wot.commands.parse_bytes(row[c]) if c in BATCH_BYTES_COLUMNS else parse_batch_value(row[c])
+                     for c in df.columns if c not in BATCH_REQUIRED_COLUMNS and not pd.isnull(row[c])}
+        experiments.append({'matrix': row['matrix'], 'cell_days': row['cell_days'], 'out': row['out'],
+                            'overrides': overrides})
+    return experiments
+
+
+def supports_lazy_loading(path):
+    """Whether a matrix can be read with wot.io.LazyDataset"""
+    return os.path.isdir(path) or wot.io.get_filename_and_extension(path)[1] in ('h5ad', 'loom')
+
+
+def compute_transport_map(ot_model, *x):
+    """Computes and saves a transport map, without sending it back to the batch process"""
+    ot_model.compute_transport_map(*x)
+
+
+def compute_batch_transport_maps(ot_models, max_threads=1, max_memory=None):
+    """
+    Computes the transport maps of several OTModels with a single scheduler.
+
+    The day pairs of all models are pooled, so that experiments with few day pairs do not leave
+    workers idle, and the largest transport maps of all experiments are started first.
+
+    Parameters
+    ----------
+    ot_models : list of wot.ot.OTModel
+        The models, each writing to its own transport map prefix.
+    max_threads : int, optional, default : 1
+        Number of worker processes.
+    max_memory : int, optional
+        Memory budget in bytes for all running transport maps. Unbounded if None.
+    """
+    tasks = []
+    for i, ot_model in enumerate(ot_models):
+        day_pairs = [x for x in ot_model.get_day_pairs()
+                     if ot_model.force or not ot_model.is_transport_map_current(*x)]
+        wot.io.verbose("Experiment {}: {} transport maps to compute".format(ot_model.tmap_prefix, len(day_pairs)))
+        tasks += [((i, *x), ot_model.estimate_transport_map_bytes(*x), compute_transport_map, (ot_model, *x))
+                  for x in day_pairs]
+    if len(tasks) == 0:
+        print('No day pairs')
+        return
+    try:
+        for ot_model in ot_models:
+            # workers attach to the shared matrices rather than receiving a copy with every task
+            if not ot_model.lazy:
+                ot_model.shared_matrix = wot.ot.SharedDataset(ot_model.matrix, directory=ot_model.tmap_dir)
+        scheduler = wot.ot.TransportMapScheduler(max_threads, max_memory=max_memory)
+        for (i, *x), _ in scheduler.run(tasks):
+            wot.io.verbose("Completed {} {}".format(ot_models[i].tmap_prefix, tuple(x)))
+    finally:
+        for ot_model in ot_models:
+            if ot_model.shared_matrix is not None:
+                ot_model.shared_matrix.close()
+            ot_model.shared_matrix = None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser('Compute transport maps of many experiments with the same worker pool')
+    parser.add_argument('--batch', required=True,
+                        help='Tab or comma separated file with one experiment per line and columns "matrix", '
+                             '"cell_days" and "out" (prefix for output file names). Other columns, named as the '
+                             'keywords of wot.ot.initialize_ot_model (e.g. epsilon, ncells, day_pairs), '
+                             'override the parameters below for their experiment. Matrices are read lazily '
+                             'when their format allows it, so that only the day pairs being computed are in memory, '
+                             'unless the batch file sets lazy to false')
+    parser.add_argument('--config', help=wot.commands.CONFIG_HELP)
+    wot.commands.add_ot_parameters_arguments(parser)
+    args = parser.parse_args(argv)
+    # experiments are all opened before the first transport map is computed
+    parameters = dict(lazy=True,
+                      local_pca=args.local_pca,
+                      growth_iters=args.growth_iters,
+                      epsilon=args.epsilon,
+                      lambda1=args.lambda1,
+                      lambda2=args.lambda2,
+                      epsilon0=args.epsilon0,
+                      tau=args.tau,
+                      day_pairs=args.config,
+                      cell_day_filter=args.cell_day_filter,
+                      cell_growth_rates=args.cell_growth_rates,
+                      gene_filter=args.gene_filter,
+                      cell_filter=args.cell_filter,
+                      sampling_bias=args.sampling_bias,
+                      scaling_iter=args.scaling_iter,
+                      inner_iter_max=args.inner_iter_max,
+                      force=args.force,
+                      cache=args.cache,
+                      cache_max_bytes=args.cache_size,
+                      checkpoint_interval=args.checkpoint_interval,
+                      extensible=args.extensible,
+                      factored=args.factored,
+                      ncells=args.ncells,
+                      max_pair_bytes=args.max_pair_bytes,
+                      ncounts=args.ncounts,
+                      seed=args.seed,
+                      covariate=None)
+    experiments = read_batch(args.batch)
+    ot_models = []
+    for experiment in experiments:
+        unknown = [k for k in experiment['overrides'] if k not in parameters]
+        if len(unknown) > 0:
+            raise ValueError("Unknown parameters in batch file: {}".format(unknown))
+        # cell_day_filter is a comma separated string, whatever its number of days
+        if 'cell_day_filter' in experiment['overrides']:
+            experiment['overrides']['cell_day_filter'] = str(experiment['overrides']['cell_day_filter'])
+        if not supports_lazy_loading(experiment['matrix']):
+            experiment['overrides']['lazy'] = False
+        ot_models.append(wot.ot.initialize_ot_model(experiment['matrix'], experiment['cell_days'],
+                                                    tmap_out=experiment['out'], max_threads=1,
+                                                    **{**parameters, **experiment['overrides']}))
+    max_threads = args.max_threads if args.max_threads > 0 else wot.ot.get_usable_cores()
+    compute_batch_transport_maps(ot_models, max_threads=max_threads, max_memory=args.max_memory)
@@ -57,6 +57,7 @@ def compute_validation_summary(ot_model, interp_pattern=(0.5, 1), save_interpola
     if 'covariate' not in ot_model.matrix.obs.columns:
         print('Warning-no covariate specified.')
         wot.add_cell_metadata(ot_model.matrix, 'covariate', 0)
+        ot_model.index_rows()
 
     ot_model.compute_all_transport_maps(with_covariates=True)
     if compute_full_distances:
@@ -189,12 +190,14 @@ def main(argv):
     args = parser.parse_args(argv)
     ot_model = wot.ot.initialize_ot_model(args.matrix, args.cell_days,
                                           tmap_out=args.out,
+                                          lazy=args.lazy,
                                           local_pca=args.local_pca,
                                           growth_iters=args.growth_iters,
                                           epsilon=args.epsilon,
                                           lambda1=args.lambda1,
                                           lambda2=args.lambda2,
                                           max_threads=args.max_threads,
+                                          max_memory=args.max_memory,
                                           epsilon0=args.epsilon0,
                                           tau=args.tau,
                                           day_pairs=args.config,
@@ -206,8 +209,13 @@ def main(argv):
                                           scaling_iter=args.scaling_iter,
                                           inner_iter_max=args.inner_iter_max,
                                           force=args.force,
+                                          cache=args.cache,
+                                          cache_max_bytes=args.cache_size,
+                                          checkpoint_interval=args.checkpoint_interval,
                                           ncells=args.ncells,
+                                          max_pair_bytes=args.max_pair_bytes,
                                           ncounts=args.ncounts,
+                                          seed=args.seed,
                                           covariate=args.covariate
                                           )
     summary = compute_validation_summary(ot_model,
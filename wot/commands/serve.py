@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import hmac
+import http.server
+import json
+import os
+import secrets
+import threading
+import time
+
+import wot.commands
+import wot.io
+import wot.tmap
+
+
+class TransportMapServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server running commands against transport maps kept in memory between requests.
+
+    Commands are requested with a POST to /<command> whose JSON body holds the command line arguments
+    of the command, by name (e.g. {"cell_set": "/data/sets.gmt", "time": "7", "out": "/data/traj"}).
+    Outputs are written by the server, so paths must be absolute. Commands run one at a time,
+    since they share the transport map cache. GET /status returns the cache statistics.
+
+    Since commands read and write files, requests must carry the token of the server in an X-Wot-Token header
+    and name the server or localhost in their Host header, and commands must be sent as application/json,
+    so that web pages cannot send them (e.g. through DNS rebinding).
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The transport maps commands are run against, with a cache. Partial reads are disabled.
+    tmap_out : str
+        Path and prefix of the transport maps. Requests for other transport maps are rejected.
+    address : (str, int), optional, default : ('127.0.0.1', 8765)
+        Host and port to listen on.
+    token : str, optional
+        Token that requests must carry. Generated if None.
+    """
+
+    # commands that can be run, with the name of the wot.commands module providing run(tmap_model, args)
+    COMMANDS = ['census', 'fates', 'trajectory', 'trajectory_trends']
+
+    daemon_threads = True
+
+    def __init__(self, tmap_model, tmap_out, address=('127.0.0.1', 8765), token=None):
+        super().__init__(address, TransportMapRequestHandler)
+        self.token = token or secrets.token_urlsafe(32)
+        self.hosts = {'localhost', '127.0.0.1', '::1', address[0].lower()}
+        self.tmap_model = tmap_model
+        # transport maps are read whole rather than by rows or columns, to stay in memory for the next requests
+        tmap_model.partial_read_fraction = 0
+        self.tmap_out = os.path.abspath(tmap_out)
+        self.lock = threading.Lock()
+        self.requests = 0
+        # matrices read by trajectory_trends, by path and modification time
+        self.matrices = {}
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def get_matrix(self, path):
+        key = (path, os.path.getmtime(path))
+        if key not in self.matrices:
+            self.matrices = {key: wot.io.read_dataset(path)}
+        return self.matrices[key]
+
+    def run_command(self, command, params):
+        """
+        Runs a command.
+
+        Parameters
+        ----------
+        command : str
+            Name of the command, in COMMANDS.
+        params : dict
+            Arguments of the command.
+
+        Returns
+        -------
+        response : dict
+            The command and the seconds it took.
+        """
+        if command not in TransportMapServer.COMMANDS:
+            raise ValueError('Unknown command {}. Available commands : {}'.format(command,
+                                                                                  TransportMapServer.COMMANDS))
+        tmap = params.pop('tmap', None)
+        if tmap is not None and os.path.abspath(tmap) != self.tmap_out:
+            raise ValueError('Server has transport maps {}, not {}'.format(self.tmap_out, tmap))
+        args = argparse.Namespace(**params)
+        start = time.time()
+        with self.lock:
+            self.requests += 1
+            if command == 'trajectory_trends':
+                wot.commands.trajectory_trends.run(self.tmap_model, args, matrix=self.get_matrix(args.matrix))
+            else:
+                getattr(wot.commands, command).run(self.tmap_model, args)
+        wot.io.verbose('{} done in {:.1f}s'.format(command, time.time() - start))
+        return {'command': command, 'seconds': time.time() - start}
+
+    def get_status(self):
+        return {'tmap': self.tmap_out, 'timepoints': list(self.tmap_model.timepoints), 'requests': self.requests,
+                'cache': self.tmap_model.cache.stats(), 'prefetch_hits': self.tmap_model.prefetch_hits}
+
+
+class TransportMapRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def check_request(self):
+        """Returns the error of a request that does not name the server or lacks its token, or None"""
+        host = self.headers.get('Host', '')
+        hostname = host[1:host.find(']')] if host.startswith('[') else host.rsplit(':', 1)[0]
+        if hostname.lower() not in self.server.hosts:
+            return 'Host {} not allowed'.format(host)
+        token = self.headers.get(wot.commands.SERVER_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            return 'Missing or invalid token'
+        return None
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        error = self.check_request()
+        if error is not None:
+            self.send_json(403, {'error': error})
+            return
+        if self.path.strip('/') != 'status':
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+        self.send_json(200, self.server.get_status())
+
+    def do_POST(self):
+        error = self.check_request()
+        if error is not None:
+            self.send_json(403, {'error': error})
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            self.send_json(415, {'error': 'Commands must be sent as application/json'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+            self.send_json(200, self.server.run_command(self.path.strip('/'), params))
+        except (ValueError, KeyError, AttributeError, OSError) as e:
+            self.send_json(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+        except Exception as e:
+            self.send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        wot.io.verbose(self.address_string(), format % args)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        'Keep transport maps in memory and run trajectory, census, fates and trajectory_trends commands sent to '
+        'this process with --server')
+    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    parser.add_argument('--host', help='Host to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8765)
+    parser.add_argument('--token',
+                        help='Token that commands must be sent with. Defaults to the {} environment variable, '
+                             'or a random token'.format(wot.commands.SERVER_TOKEN_VARIABLE))
+    parser.add_argument('--tmap_cache_size', type=wot.commands.parse_bytes,
+                        help='Memory for transport maps kept in memory (e.g. 16G). Unbounded by default')
+    args = parser.parse_args(argv)
+
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=args.tmap_cache_size or True)
+    server = TransportMapServer(tmap_model, args.tmap, (args.host, args.port),
+                                token=args.token or os.environ.get(wot.commands.SERVER_TOKEN_VARIABLE))
+    print('Serving {} on {}'.format(args.tmap, server.url))
+    print('Send commands with --server {}:{} --server_token {}'.format(*server.server_address[:2], server.token))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        tmap_model.close()
@@ -3,7 +3,9 @@
 
 import argparse
 
+import wot.commands
 import wot.io
+import wot.tmap
 
 
 def main(argv):
@@ -12,8 +14,17 @@ def main(argv):
     parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
     parser.add_argument('--time', help='Timepoint to consider', required=True)
     parser.add_argument('--out', help='Output file name', default='trajectory')
+    wot.commands.add_tmap_cache_arguments(parser)
+    wot.commands.add_server_arguments(parser)
     args = parser.parse_args(argv)
-    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    if args.server is not None:
+        wot.commands.send_to_server(args.server, 'trajectory', args, paths=('cell_set', 'out'))
+        return
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=args.tmap_cache_size or False)
+    run(tmap_model, args)
+
+
+def run(tmap_model, args):
     cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
     populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.time)
     trajectories = tmap_model.compute_trajectories(populations)
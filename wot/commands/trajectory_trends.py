@@ -3,6 +3,10 @@
 
 import argparse
 
+import anndata
+import pandas as pd
+
+import wot.commands
 import wot.io
 import wot.tmap
 
@@ -11,13 +15,27 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Generate mean expression profiles for ' \
                                                  'ancestors and descendants of each trajectory')
     parser.add_argument('--matrix', help=wot.commands.MATRIX_HELP, required=True)
-    parser.add_argument('--trajectory', help='Trajectory dataset as produced by the trajectory tool', required=True)
+    parser.add_argument('--trajectory', help='Trajectory dataset as produced by the trajectory tool')
     parser.add_argument('--out', help='Prefix for output file names', default='trends')
-    parser.add_argument('--cell_days', help=wot.commands.CELL_DAYS_HELP, required=True)
+    parser.add_argument('--cell_days', help=wot.commands.CELL_DAYS_HELP + '. Required with --trajectory')
+    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP + '. To compute the trends of cell sets instead of '
+                                                               'a trajectory dataset')
+    parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP + ' Required with --tmap')
+    parser.add_argument('--time', help='Timepoint of the cell sets. Required with --tmap')
+    wot.commands.add_tmap_cache_arguments(parser)
+    wot.commands.add_server_arguments(parser)
     args = parser.parse_args(argv)
-    # tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
-    # cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
-    # populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.time)
+    if args.tmap is not None:
+        if args.cell_set is None or args.time is None:
+            parser.error('--cell_set and --time are required with --tmap')
+        if args.server is not None:
+            wot.commands.send_to_server(args.server, 'trajectory_trends', args, paths=('matrix', 'cell_set', 'out'))
+            return
+        tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=args.tmap_cache_size or False)
+        run(tmap_model, args)
+        return
+    if args.trajectory is None or args.cell_days is None:
+        parser.error('--trajectory and --cell_days, or --tmap, are required')
 
     trajectory_ds = wot.io.read_dataset(args.trajectory)
     wot.io.add_row_metadata_to_dataset(dataset=trajectory_ds, days_path=args.cell_days)
@@ -32,3 +50,18 @@ def main(argv):
         basename = args.out + '_' + trajectory_name
         wot.io.write_dataset(mean, basename + '.mean')
         wot.io.write_dataset(variance, basename + '.variance')
+
+
+def run(tmap_model, args, matrix=None):
+    if matrix is None:
+        matrix = wot.io.read_dataset(args.matrix)
+    cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
+    populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.time)
+    timepoints, means, variances = wot.tmap.compute_trajectory_trends(tmap_model, *populations.values(), ds=matrix)
+    if len(populations) == 1:
+        means, variances = [means], [variances]
+    obs = pd.DataFrame(index=timepoints)
+    for name, mean, variance in zip(populations.keys(), means, variances):
+        basename = args.out + '_' + name
+        wot.io.write_dataset(anndata.AnnData(mean, obs, matrix.var), basename + '.mean')
+        wot.io.write_dataset(anndata.AnnData(variance, obs, matrix.var), basename + '.variance')
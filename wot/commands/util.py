@@ -1,3 +1,8 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
 CELL_SET_HELP = 'gmt, gmx, or grp file of cell sets.'
 CELL_DAYS_HELP = 'File with headers "id" and "day" corresponding to cell id and days'
 TMAP_HELP = 'Directory of transport maps as produced by optimal transport'
@@ -5,6 +10,80 @@ MATRIX_HELP = 'A matrix with cells on rows and features, such as genes or pathwa
 CONFIG_HELP = 'Optional detailed configuration file to specify time-dependant OT parameters'
 FORMAT_HELP = 'Output file format'
 FORMAT_CHOICES = ['gct', 'h5ad', 'loom', 'txt']
+SERVER_TOKEN_VARIABLE = 'WOT_SERVER_TOKEN'
+SERVER_TOKEN_HEADER = 'X-Wot-Token'
+
+
+def parse_bytes(value):
+    """Parses a size such as 512M or 16G into a number of bytes, for use as an argparse type"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = str(value).strip().upper().rstrip('B')
+    if len(value) > 0 and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def format_bytes(nbytes):
+    """Formats a number of bytes as a size such as 1.5G"""
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(nbytes) < 1024:
+            return '{:.1f}{}'.format(nbytes, unit)
+        nbytes /= 1024
+    return '{:.1f}T'.format(nbytes)
+
+
+def add_tmap_cache_arguments(parser):
+    parser.add_argument('--tmap_cache_size', type=parse_bytes,
+                        help='Memory for transport maps kept in memory and read ahead of use (e.g. 4G). '
+                             'Transport maps are read when needed by default')
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--server',
+                        help='Address of a wot serve process (e.g. localhost:8765) to run the command in, '
+                             'with the transport maps it keeps in memory')
+    parser.add_argument('--server_token',
+                        help='Token printed by wot serve. Defaults to the {} environment variable'.format(
+                            SERVER_TOKEN_VARIABLE))
+
+
+def send_to_server(server, command, args, paths=()):
+    """
+    Runs a command in a wot serve process, see wot.commands.TransportMapServer.
+
+    Parameters
+    ----------
+    server : str
+        Address of the server, e.g. localhost:8765.
+    command : str
+        Name of the command.
+    args : argparse.Namespace
+        Arguments of the command. The token of the server is args.server_token if set,
+        or the WOT_SERVER_TOKEN environment variable.
+    paths : list of str, optional
+        Arguments that are paths, resolved first since the server may run in another directory.
+
+    Returns
+    -------
+    response : dict
+        The response of the server.
+    """
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('server', 'server_token', 'tmap_cache_size')}
+    token = getattr(args, 'server_token', None) or os.environ.get(SERVER_TOKEN_VARIABLE)
+    if token is None:
+        raise ValueError('No token for server {}. Set --server_token or {}'.format(server, SERVER_TOKEN_VARIABLE))
+    for key in ('tmap',) + tuple(paths):
+        if params.get(key) is not None:
+            params[key] = os.path.abspath(params[key])
+    url = (server if '://' in server else 'http://' + server).rstrip('/') + '/' + command
+    request = urllib.request.Request(url, data=json.dumps(params).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json', SERVER_TOKEN_HEADER: token})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise ValueError('{} failed on {} : {}'.format(command, server, json.load(e).get('error', e.reason)))
 
 
 def add_model_arguments(parser):
@@ -48,12 +127,35 @@ def add_ot_parameters_arguments(parser):
                              'fidelity of the constraints on q')
     parser.add_argument('--max_threads', type=int, default=1,
                         help='Maximal number of threads to use when parallelizing tmap computation')
+    parser.add_argument('--max_memory', type=parse_bytes,
+                        help='Memory budget (e.g. 64G) when computing transport maps in parallel')
     parser.add_argument('--epsilon0', type=float, default=1,
                         help='Warm starting value for epsilon')
     parser.add_argument('--tau', type=float, default=10000)
     parser.add_argument('--ncells', type=int, help='Number of cells to downsample from each timepoint and covariate')
     parser.add_argument('--ncounts', help='Sample ncounts from each cell', type=int)
+    parser.add_argument('--seed', type=int, help='Seed of the random number generator used to sample counts and cells')
+    parser.add_argument('--max_pair_bytes', type=parse_bytes,
+                        help='Memory budget for each transport map (e.g. 8G). Days of the day pairs above it are '
+                             'subsampled, stratified by covariate')
     parser.add_argument('--force', help='Overwrite existing transport maps if they exist', type=bool, default=False)
+    parser.add_argument('--cache', action='store_true',
+                        help='Cache PCA coordinates and cost matrices next to the transport maps, '
+                             'to speed up recomputation with different OT parameters')
+    parser.add_argument('--cache_size', type=parse_bytes,
+                        help='Maximum size of the cache (e.g. 20G). Least recently used entries are evicted')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Only read the cells of the day pair being computed from the matrix. '
+                             'Supported for h5ad, loom and day-sorted matrices (see convert_matrix)')
+    parser.add_argument('--extensible', action='store_true',
+                        help='Also store the dual potentials and local PCA coordinates with transport maps, '
+                             'so that new cells can be placed in them with extend_transport_maps')
+    parser.add_argument('--factored', action='store_true',
+                        help='Only store the dual potentials and local PCA coordinates of transport maps, '
+                             'from which they are evaluated when used')
+    parser.add_argument('--checkpoint_interval', type=float, default=600,
+                        help='Seconds between saves of the solver state, to resume interrupted transport maps.'
+                             ' Set to 0 to disable')
     # parser.add_argument('--max_iter', type=int, default=1e7,
     #                     help='Maximum number of scaling iterations. Abort if convergence was not reached')
     # parser.add_argument('--batch_size', type=int, default=50,
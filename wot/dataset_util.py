@@ -82,6 +82,44 @@ def mean_and_variance(x):
         return x.mean(axis=0), x.var(axis=0)
 
 
+def downsample_counts(x, ncounts, seed=None):
+    """
+    Downsamples each cell with more than ncounts total counts to about ncounts counts.
+
+    Every count of such a cell is kept independently with probability ncounts / total (binomial thinning),
+    in a single vectorized pass over the non-zero values. Cells with at most ncounts counts are unchanged.
+
+    Parameters
+    ----------
+    x : ndarray or scipy.sparse.spmatrix
+        The counts matrix, cells on rows. Values are rounded to integer counts.
+    ncounts : int
+        Target number of counts per cell.
+    seed : int or numpy.random.RandomState, optional
+        Seed of the random number generator.
+
+    Returns
+    -------
+    x : ndarray or scipy.sparse.csr_matrix
+        The downsampled matrix, with the dtype of the input. The input is not modified.
+    """
+    random_state = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    totals = np.asarray(x.sum(axis=1)).ravel().astype(np.float64)
+    keep = np.ones(len(totals))
+    downsampled = totals > ncounts
+    keep[downsampled] = ncounts / totals[downsampled]
+    if scipy.sparse.issparse(x):
+        x = x.tocsr(copy=True)
+        rows = np.repeat(np.arange(x.shape[0]), np.diff(x.indptr))
+        selected = downsampled[rows]
+        x.data[selected] = random_state.binomial(np.rint(x.data[selected]).astype(np.int64), keep[rows[selected]])
+        x.eliminate_zeros()
+        return x
+    x = np.array(x)
+    x[downsampled] = random_state.binomial(np.rint(x[downsampled]).astype(np.int64), keep[downsampled][:, None])
+    return x
+
+
 def extract_cells_at_indices(ds, indices):
     return anndata.AnnData(ds.X[indices], ds.obs.iloc[indices].copy(), ds.var.copy())
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 from .io import *
+from .lazy_dataset import *
 from .read_gct import *
 from .performance import *
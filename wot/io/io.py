@@ -525,27 +525,8 @@ def read_dataset(path):
             x = scipy.sparse.vstack(sparse_arrays)
         else:
             x = x[()]
-        row_meta = {}
-        row_attrs = f['/row_attrs']
-        for key in row_attrs:
-            values = row_attrs[key][()]
-            if values.dtype.kind == 'S':
-                values = values.astype(str)
-            row_meta[key] = values
-        row_meta = pd.DataFrame(data=row_meta)
-        if row_meta.get('id') is not None:
-            row_meta.set_index('id', inplace=True)
-
-        col_meta = {}
-        col_attrs = f['/col_attrs']
-        for key in col_attrs:
-            values = col_attrs[key][()]
-            if values.dtype.kind == 'S':
-                values = values.astype(str)
-            col_meta[key] = values
-        col_meta = pd.DataFrame(data=col_meta)
-        if col_meta.get('id') is not None:
-            col_meta.set_index('id', inplace=True)
+        row_meta = read_loom_attrs(f['/row_attrs'])
+        col_meta = read_loom_attrs(f['/col_attrs'])
         f.close()
         return anndata.AnnData(X=x, obs=row_meta, var=col_meta)
     elif ext == 'h5ad':
@@ -732,7 +713,22 @@ def write_dataset_json(ds, path):
         fout.write(json.dumps(idx).encode('utf-8'))
 
 
-def write_dataset(ds, path, output_format='txt'):
+def write_dataset(ds, path, output_format='txt', chunks=None):
+    """
+    Writes a dataset.
+
+    Parameters
+    ----------
+    ds : anndata.AnnData
+        The dataset.
+    path : str
+        Path to write to. The extension of output_format is added if missing.
+    output_format : str, optional, default : 'txt'
+        One of txt, gct, csv, json, npy, h5ad or loom.
+    chunks : (int, int), optional
+        Shape of the chunks of a dense matrix written to h5ad, so that blocks of rows or columns can be read
+        without reading the whole matrix, see read_h5_submatrix. Contiguous if None.
+    """
     path = check_file_extension(path, output_format)
     if output_format == 'json':
         return write_dataset_json(ds, path)
@@ -780,7 +776,14 @@ def write_dataset(ds, path, output_format='txt'):
     elif output_format == 'npy':
         np.save(path, ds.X)
     elif output_format == 'h5ad':
-        ds.write(path)
+        if chunks is None or scipy.sparse.issparse(ds.X) or ds.X is None or 0 in ds.shape:
+            ds.write(path)
+        else:
+            # anndata has no chunking per element: X is written on its own
+            create_h5ad(path, anndata.AnnData(obs=ds.obs, var=ds.var, uns=dict(ds.uns), obsm=ds.obsm, varm=ds.varm),
+                        chunks=chunks, dtype=ds.X.dtype)
+            with h5py.File(path, 'a') as f:
+                f['X'][()] = np.asarray(ds.X)
     elif output_format == 'loom':
         f = h5py.File(path, 'w')
         x = ds.X
@@ -847,6 +850,93 @@ def write_dataset_metadata(meta_data, path, metadata_name=None):
         meta_data.to_csv(path, index_label='id', sep='\t', doublequote=False)
 
 
+def create_h5ad(path, ds, chunks=None, dtype=np.float64):
+    """
+    Writes the metadata of a dataset to an h5ad file, with an uninitialized dense matrix to be written by blocks.
+
+    Parameters
+    ----------
+    path : str
+        Path to the h5ad file.
+    ds : anndata.AnnData
+        The dataset, without matrix. Its shape is given by obs and var.
+    chunks : (int, int), optional
+        Shape of the chunks of the matrix. Contiguous if None.
+    dtype : numpy.dtype, optional, default : float64
+        Type of the entries of the matrix.
+
+    Examples
+    --------
+    >>> create_h5ad(path, anndata.AnnData(obs=obs, var=var))
+    >>> with h5py.File(path, 'a') as f:
+    >>>     f['X'][0:10] = block
+    """
+    ds.write(path)
+    with h5py.File(path, 'a') as f:
+        if 'X' in f:
+            del f['X']
+        dset = f.create_dataset('X', shape=ds.shape, dtype=dtype,
+                                chunks=tuple(min(c, n) for c, n in zip(chunks, ds.shape)) if chunks else None)
+        dset.attrs['encoding-type'] = 'array'
+        dset.attrs['encoding-version'] = '0.2.0'
+
+
+def read_h5_submatrix(path, rows=None, columns=None):
+    """
+    Reads some rows or columns of the dense matrix of an h5ad or loom file, without reading the others.
+
+    Parameters
+    ----------
+    path : str
+        Path to the h5ad or loom file.
+    rows : ndarray, optional
+        Sorted indices of the rows to read. All rows if None.
+    columns : ndarray, optional
+        Sorted indices of the columns to read. All columns if None.
+
+    Returns
+    -------
+    x : ndarray
+        The selected entries, or None if the file has no dense matrix (e.g. a sparse h5ad matrix).
+    """
+    with h5py.File(path, 'r') as f:
+        dset = f.get('/matrix' if path.lower().endswith('.loom') else '/X')
+        if not isinstance(dset, h5py.Dataset) or len(dset.shape) != 2:
+            return None
+        x = dset
+        if rows is not None:
+            x = x[np.asarray(rows), :]
+            if columns is not None:
+                x = x[:, np.asarray(columns)]
+        elif columns is not None:
+            x = x[:, np.asarray(columns)]
+        else:
+            x = x[()]
+        return x
+
+
+def read_h5ad_index(group):
+    """Reads the ids of the obs or var group of an h5ad file, as written by any version of anndata"""
+    dataset = group[group.attrs.get('_index', 'index')]
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return dataset.asstr()[()]
+    return dataset[()].astype(str)
+
+
+def read_loom_attrs(attrs):
+    """Reads the row or column attributes group of a loom file, indexed by 'id' if present"""
+    meta = {}
+    for key in attrs:
+        values = attrs[key][()]
+        if values.dtype.kind == 'S':
+            values = values.astype(str)
+        meta[key] = values
+    meta = pd.DataFrame(data=meta)
+    if meta.get('id') is not None:
+        meta.set_index('id', inplace=True)
+    return meta
+
+
 def save_loom_attrs(f, is_columns, metadata, length):
     attrs_path = '/col_attrs' if is_columns else '/row_attrs'
     f.create_group(attrs_path)
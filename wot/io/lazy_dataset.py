@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import wot.io
+
+DAY_SORTED_FORMAT = 'wot_day_sorted'
+
+
+def get_row_runs(rows):
+    """Splits sorted row indices into the (start, stop) ranges of consecutive rows"""
+    if len(rows) == 0:
+        return []
+    boundaries = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.concatenate(([0], boundaries))]
+    stops = rows[np.concatenate((boundaries - 1, [len(rows) - 1]))] + 1
+    return list(zip(starts, stops))
+
+
+class LazyDataset:
+    """
+    An expression matrix whose rows are only read from disk when requested.
+
+    Supports h5ad files (opened backed), loom files (rows read with h5py) and the day-sorted layout
+    written by write_day_sorted_dataset, in which the cells of each day are contiguous on disk.
+    Only obs and var are held in memory. Indexing rows, as with anndata.AnnData, reads them into an AnnData.
+
+    Parameters
+    ----------
+    path : str
+        Path to an h5ad or loom file, or to a day-sorted directory.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        if os.path.isdir(self.path):
+            self.kind = DAY_SORTED_FORMAT
+        else:
+            self.kind = wot.io.get_filename_and_extension(self.path)[1]
+            if self.kind not in ('h5ad', 'loom'):
+                raise ValueError("Lazy loading is not supported for {}".format(self.path))
+        self.rows = None
+        self.columns = None
+        self._file = None
+        if self.kind == 'h5ad':
+            backed = self._open()
+            self.obs = backed.obs
+            self.var = backed.var
+        elif self.kind == 'loom':
+            f = self._open()
+            self.obs = wot.io.read_loom_attrs(f['/row_attrs'])
+            self.var = wot.io.read_loom_attrs(f['/col_attrs'])
+        else:
+            self.obs = pd.read_table(os.path.join(self.path, 'obs.txt'), index_col='id', sep='\t', dtype={'id': str})
+            self.var = pd.read_table(os.path.join(self.path, 'var.txt'), index_col='id', sep='\t', dtype={'id': str})
+
+    @property
+    def shape(self):
+        return self.obs.shape[0], self.var.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # file handles are reopened by each process
+        state['_file'] = None
+        return state
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            if len(index) != 2 or index[1] != slice(None):
+                raise ValueError("Only rows can be selected from a lazy dataset")
+            index = index[0]
+        return self.read(index)
+
+    def _open(self):
+        if self._file is None:
+            if self.kind == 'h5ad':
+                self._file = anndata.read_h5ad(self.path, backed='r')
+            elif self.kind == 'loom':
+                self._file = h5py.File(self.path, 'r')
+            else:
+                with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                    meta = json.load(f)
+                shape = tuple(meta['shape'])
+                dtype = np.dtype(meta['dtype'])
+                if meta['sparse']:
+                    nnz = meta['nnz']
+                    self._file = {
+                        'data': _memmap(os.path.join(self.path, 'X_data.bin'), dtype, (nnz,)),
+                        'indices': _memmap(os.path.join(self.path, 'X_indices.bin'), np.int64, (nnz,)),
+                        'indptr': _memmap(os.path.join(self.path, 'X_indptr.bin'), np.int64, (shape[0] + 1,)),
+                        'shape': shape}
+                else:
+                    self._file = {'X': _memmap(os.path.join(self.path, 'X.bin'), dtype, shape)}
+        return self._file
+
+    def _read_range(self, start, stop):
+        """Reads the rows start to stop of the file"""
+        f = self._open()
+        if self.kind == 'h5ad':
+            return f.X[start:stop]
+        if self.kind == 'loom':
+            x = f['/matrix'][start:stop]
+            return scipy.sparse.csr_matrix(x) if f['/matrix'].attrs.get('sparse') else x
+        if 'X' in f:
+            return np.array(f['X'][start:stop])
+        indptr = f['indptr']
+        data_start, data_stop = indptr[start], indptr[stop]
+        return scipy.sparse.csr_matrix((np.array(f['data'][data_start:data_stop]),
+                                        np.array(f['indices'][data_start:data_stop]),
+                                        np.array(indptr[start:stop + 1]) - data_start),
+                                       shape=(stop - start, f['shape'][1]))
+
+    def _get_rows(self, index):
+        """Converts a row selection (slice, boolean mask or indices) of this dataset to integer positions"""
+        if isinstance(index, pd.Series):
+            index = index.values
+        if isinstance(index, slice):
+            return np.arange(self.shape[0])[index]
+        index = np.asarray(index)
+        if index.dtype == bool:
+            return np.flatnonzero(index)
+        return index.astype(np.int64)
+
+    def subset(self, rows=None, columns=None):
+        """
+        Selects rows and columns, without reading anything.
+
+        Parameters
+        ----------
+        rows : slice, boolean mask or ndarray of int, optional
+            The rows to keep, in order. All rows if None.
+        columns : slice, boolean mask or ndarray of int, optional
+            The columns to keep. All columns if None.
+
+        Returns
+        -------
+        ds : wot.io.LazyDataset
+            The selected rows and columns of this dataset.
+        """
+        ds = LazyDataset.__new__(LazyDataset)
+        ds.__dict__.update(self.__dict__)
+        if rows is not None:
+            rows = self._get_rows(rows)
+            ds.rows = self.rows[rows] if self.rows is not None else rows
+            ds.obs = self.obs.iloc[rows]
+        if columns is not None:
+            columns = np.arange(self.shape[1])[columns]
+            ds.columns = self.columns[columns] if self.columns is not None else columns
+            ds.var = self.var.iloc[columns]
+        return ds
+
+    def read(self, rows=None):
+        """
+        Reads rows into memory.
+
+        Consecutive rows of the file are read as one block, so that reading a day of a day-sorted
+        dataset is a single contiguous read.
+
+        Parameters
+        ----------
+        rows : slice, boolean mask or ndarray of int, optional
+            The rows to read, in order. All rows if None.
+
+        Returns
+        -------
+        ds : anndata.AnnData
+            The rows, with their obs and the var of this dataset.
+        """
+        rows = self._get_rows(slice(None) if rows is None else rows)
+        file_rows = self.rows[rows] if self.rows is not None else rows
+        order = np.argsort(file_rows, kind='stable')
+        blocks = [self._read_range(start, stop) for start, stop in get_row_runs(file_rows[order])]
+        if len(blocks) == 0:
+            x = self._read_range(0, 0)
+        elif scipy.sparse.issparse(blocks[0]):
+            x = scipy.sparse.vstack(blocks, format='csr')
+        else:
+            x = np.vstack(blocks)
+        if not np.array_equal(order, np.arange(len(order))):
+            x = x[np.argsort(order)]
+        if self.columns is not None:
+            x = x[:, self.columns]
+        return anndata.AnnData(x, self.obs.iloc[rows].copy(), self.var.copy())
+
+    def close(self):
+        """Closes the underlying file. It is reopened by the next read."""
+        if self.kind == 'loom' and self._file is not None:
+            self._file.close()
+        elif self.kind == 'h5ad' and self._file is not None:
+            self._file.file.close()
+        self._file = None
+
+
+def _memmap(path, dtype, shape):
+    # empty files cannot be memory mapped
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def write_day_sorted_dataset(ds, path):
+    """
+    Writes a dataset in the day-sorted layout read by wot.io.LazyDataset.
+
+    Cells are sorted by day, then covariate, so that the cells of a day (and covariate) can be read
+    as one contiguous block. The matrix is written one day at a time, so that converting a
+    wot.io.LazyDataset never needs more memory than its largest day.
+
+    Parameters
+    ----------
+    ds : anndata.AnnData or wot.io.LazyDataset
+        The dataset to write. Must have the row meta data field 'day'.
+    path : str
+        The directory to write to.
+    """
+    import wot.ot
+    if 'day' not in ds.obs.columns:
+        raise ValueError("Days information not available for matrix")
+    order = wot.ot.OTModel.get_row_order(ds.obs)
+    days = ds.obs['day'].values[order]
+    boundaries = np.flatnonzero(days[1:] != days[:-1]) + 1 if len(days) > 0 else []
+    starts = np.concatenate(([0], boundaries)).astype(int)
+    stops = np.concatenate((boundaries, [len(days)])).astype(int)
+    os.makedirs(path, exist_ok=True)
+    meta = {'format': DAY_SORTED_FORMAT, 'shape': [int(ds.shape[0]), int(ds.shape[1])]}
+    nnz = 0
+    # the layout is taken from an empty selection, so that it is recorded even for a dataset without rows
+    x = ds.read(order[:0]).X if isinstance(ds, LazyDataset) else ds.X[order[:0]]
+    meta['sparse'] = scipy.sparse.issparse(x)
+    meta['dtype'] = np.dtype(x.dtype).str
+    names = ['X_data', 'X_indices', 'X_indptr'] if meta['sparse'] else ['X']
+    files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name in names}
+    try:
+        if meta['sparse']:
+            np.zeros(1, dtype=np.int64).tofile(files['X_indptr'])
+        for start, stop in zip(starts, stops):
+            rows = order[start:stop]
+            x = ds.read(rows).X if isinstance(ds, LazyDataset) else ds.X[rows]
+            if meta['sparse']:
+                x = scipy.sparse.csr_matrix(x)
+                x.data.astype(meta['dtype']).tofile(files['X_data'])
+                x.indices.astype(np.int64).tofile(files['X_indices'])
+                (x.indptr[1:].astype(np.int64) + nnz).tofile(files['X_indptr'])
+                nnz += x.nnz
+            else:
+                np.ascontiguousarray(x, dtype=meta['dtype']).tofile(files['X'])
+    finally:
+        for f in files.values():
+            f.close()
+    meta['nnz'] = int(nnz)
+    wot.io.write_dataset_metadata(ds.obs.iloc[order], os.path.join(path, 'obs.txt'))
+    wot.io.write_dataset_metadata(ds.var, os.path.join(path, 'var.txt'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
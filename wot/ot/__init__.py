@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+from .cache import *
+from .checkpoint import *
+from .lease import *
+from .manifest import *
 from .optimal_transport import *
 from .optimal_transport_helper import *
+from .scheduler import *
+from .shared_dataset import *
 from .util import *
+from .writer import *
 from .initializer import *
 from .ot_model import *
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+import wot.io
+
+
+def compute_digest(*args):
+    """
+    Computes a stable hexadecimal digest of the arguments.
+
+    Parameters
+    ----------
+    *args : str, number, dict, list, ndarray or scipy.sparse.spmatrix
+        The values to hash. Arrays are hashed by content, dicts by sorted keys.
+
+    Returns
+    -------
+    digest : str
+        The SHA-1 digest of all arguments, in order.
+    """
+    h = hashlib.sha1()
+
+    def update(x):
+        if scipy.sparse.issparse(x):
+            x = scipy.sparse.csr_matrix(x)
+            h.update(b'csr')
+            h.update(str(x.shape).encode('utf-8'))
+            for a in (x.data, x.indices, x.indptr):
+                update(np.asarray(a))
+        elif isinstance(x, np.ndarray):
+            if x.dtype.kind in ('O', 'U', 'S'):
+                x = np.asarray(x, dtype=str)
+                h.update(b'str')
+                h.update('\t'.join(x.ravel()).encode('utf-8'))
+            else:
+                h.update(str(x.dtype).encode('utf-8'))
+                h.update(str(x.shape).encode('utf-8'))
+                h.update(np.ascontiguousarray(x).tobytes())
+        elif isinstance(x, dict):
+            h.update(json.dumps(x, sort_keys=True, default=str).encode('utf-8'))
+        elif isinstance(x, (list, tuple)):
+            h.update(b'[')
+            for e in x:
+                update(e)
+            h.update(b']')
+        else:
+            h.update(repr(x).encode('utf-8'))
+        h.update(b'\0')
+
+    for arg in args:
+        update(arg)
+    return h.hexdigest()
+
+
+class ComputationCache:
+    """
+    Content-addressed on-disk cache for the arrays needed to compute a transport map.
+
+    Each entry is a directory of `.npy` files (PCA coordinates, eigenvalues, cost matrix) named
+    after a digest of everything they depend on. Hits are memory-mapped rather than read.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the cache directory. Created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of the cache. Least recently used entries are evicted beyond that.
+        If None, the cache is unbounded.
+    salt : dict, optional
+        Additional settings that entries depend on (e.g. preprocessing), mixed into every key.
+    """
+
+    def __init__(self, directory, max_bytes=None, salt=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.salt = salt if salt is not None else {}
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *args):
+        """Returns the cache key for the given inputs"""
+        return compute_digest(self.salt, *args)
+
+    def get(self, key):
+        """
+        Loads an entry from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, as returned by ComputationCache.key
+
+        Returns
+        -------
+        entry : dict of str: numpy.memmap or None
+            The read-only memory-mapped arrays of the entry, or None if not in the cache.
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            entry = {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode='r')
+                     for f in os.listdir(path) if f.endswith('.npy')}
+            # the modification time of the entry records its last use, for LRU eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            # evicted concurrently or partially removed
+            return None
+        wot.io.verbose("Cache hit for", key)
+        return entry
+
+    def put(self, key, **arrays):
+        """
+        Stores arrays in the cache, evicting the least recently used entries if needed.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, as returned by ComputationCache.key
+        **arrays : ndarray
+            The arrays to store, by name.
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            return
+        nbytes = sum(np.asarray(a).nbytes for a in arrays.values())
+        if self.max_bytes is not None:
+            if nbytes > self.max_bytes:
+                wot.io.verbose("Not caching", key, ": entry is larger than the cache")
+                return
+            self.evict(self.max_bytes - nbytes)
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp_')
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(array))
+            # directory renames are atomic: concurrent writers of the same entry cannot corrupt it
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def entries(self):
+        """
+        Lists the entries of the cache.
+
+        Returns
+        -------
+        entries : list of (str, float, int)
+            Key, last access time and size in bytes of each entry, least recently used first.
+        """
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                result.append((name, os.path.getmtime(path), size))
+            except OSError:
+                pass
+        return sorted(result, key=lambda e: e[1])
+
+    def evict(self, max_bytes):
+        """Removes least recently used entries until the cache holds at most max_bytes"""
+        entries = self.entries()
+        total = sum(e[2] for e in entries)
+        for name, _, size in entries:
+            if total <= max_bytes:
+                break
+            wot.io.verbose("Evicting", name, "from cache")
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import numpy as np
+
+import wot.io
+
+
+class SolverCheckpoint:
+    """
+    Periodically saves the state of the OT solver so that an interrupted computation can be resumed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the checkpoint file.
+    interval : float, optional, default : 600
+        Minimum number of seconds between two saves.
+    digest : str, optional
+        Digest of the inputs of the computation. A checkpoint saved for other inputs is ignored.
+    """
+
+    def __init__(self, path, interval=600, digest=None):
+        self.path = path
+        self.interval = interval
+        self.digest = digest if digest is not None else ''
+        self.last_save = time.time()
+
+    def is_due(self):
+        """Whether the interval since the last save has elapsed"""
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, **state):
+        """
+        Saves the solver state, replacing the previous checkpoint atomically.
+
+        Parameters
+        ----------
+        **state : ndarray or number
+            The solver state, by name.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, digest=np.array(self.digest), **state)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+        wot.io.verbose("Saved checkpoint", self.path)
+
+    def load(self, shape):
+        """
+        Loads the solver state.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of the cost matrix. A checkpoint saved for another shape is ignored.
+
+        Returns
+        -------
+        state : dict of str: ndarray or None
+            The saved state, or None if there is no usable checkpoint.
+        """
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with np.load(self.path) as f:
+                state = {key: f[key] for key in f.files}
+        except (OSError, ValueError) as e:
+            print("Warning : ignoring unreadable checkpoint {}: {}".format(self.path, e))
+            return None
+        if str(state.pop('digest')) != self.digest or state['u'].shape[0] != shape[0] or \
+                state['v'].shape[0] != shape[1]:
+            wot.io.verbose("Ignoring checkpoint for other inputs", self.path)
+            return None
+        return state
+
+    def remove(self):
+        """Removes the checkpoint file"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
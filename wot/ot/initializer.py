@@ -19,6 +19,8 @@ def initialize_ot_model(matrix, days, tmap_out=None, **kwargs):
         Path to the transport maps directory for the OTModel.
     tmap_prefix : str, optional
         Prefix for transport maps cached by the OTModel.
+    lazy : bool, optional, default : False
+        Read the matrix lazily, see wot.io.LazyDataset. Supported for h5ad, loom and day-sorted matrices.
     **kwargs : dict
         Other keywords arguments, will be passed to OT configuration.
 
@@ -35,7 +37,9 @@ def initialize_ot_model(matrix, days, tmap_out=None, **kwargs):
     >>> # Tweaking unbalanced parameters
     >>> initialize_ot_model('matrix.txt', 'days.txt', lambda1=50, lambda2=80, epsilon=.01)
     """
-    ds = wot.io.read_dataset(matrix)
+    ds = wot.io.LazyDataset(matrix) if kwargs.pop('lazy', False) else wot.io.read_dataset(matrix)
+    # the days file takes precedence over days stored with the matrix, as in day-sorted matrices
+    ds.obs = ds.obs.drop(columns=['day'], errors='ignore')
     wot.io.add_row_metadata_to_dataset(dataset=ds, days_path=days,
                                        growth_rates_path=kwargs.pop('cell_growth_rates', None),
                                        sampling_bias_path=kwargs.pop('sampling_bias', None),
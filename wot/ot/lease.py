@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import wot.io
+
+
+class Lease:
+    """
+    Exclusive claim on a task by one worker, held by a lease file on a shared filesystem.
+
+    The holder renews the lease by touching the file from a heartbeat thread. A lease that has
+    not been renewed for longer than timeout is considered abandoned (e.g. its host crashed)
+    and can be acquired by another worker.
+
+    Parameters
+    ----------
+    path : str
+        Path to the lease file.
+    timeout : float, optional, default : 600
+        Seconds without heartbeat after which the lease expires.
+        Must be well above the clock differences between hosts.
+    """
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.timeout = timeout
+        self._stop = None
+        self._thread = None
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+        return True
+
+    def is_expired(self):
+        """Whether the lease file exists and has not been renewed within timeout"""
+        try:
+            return time.time() - os.path.getmtime(self.path) > self.timeout
+        except OSError:
+            return False
+
+    def acquire(self):
+        """
+        Tries to acquire the lease, breaking it if it expired.
+
+        Returns
+        -------
+        acquired : bool
+            Whether this worker now holds the lease.
+        """
+        if not self._create():
+            if not self.is_expired():
+                return False
+            # renames are atomic: only one worker can take the expired lease away
+            expired_path = '{}.{}.expired'.format(self.path, uuid.uuid4().hex)
+            try:
+                os.rename(self.path, expired_path)
+            except OSError:
+                return False
+            if time.time() - os.path.getmtime(expired_path) <= self.timeout:
+                # renewed or acquired by another worker in the meantime: give it back
+                try:
+                    os.link(expired_path, self.path)
+                except OSError:
+                    pass
+                os.remove(expired_path)
+                return False
+            os.remove(expired_path)
+            wot.io.verbose("Breaking expired lease", self.path)
+            if not self._create():
+                return False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name='wot-lease-heartbeat', daemon=True)
+        self._thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                print("Warning : lost lease {}".format(self.path))
+                return
+
+    def release(self):
+        """Stops renewing the lease and removes its file"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
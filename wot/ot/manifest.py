@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+import time
+
+import wot.io
+
+
+class FileLock:
+    """
+    Inter-process lock based on the atomic creation of a lock file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the lock file.
+    timeout : float, optional, default : 60
+        Age in seconds after which a lock file is considered abandoned and broken.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.timeout:
+                        wot.io.verbose("Breaking abandoned lock", self.path)
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class TransportMapManifest:
+    """
+    Records the digest of the inputs that produced each transport map in a JSON file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        """Whether the manifest file exists"""
+        return os.path.isfile(self.path)
+
+    def read(self):
+        """
+        Reads the manifest.
+
+        Returns
+        -------
+        entries : dict of str: dict
+            Maps transport map file names to their entries.
+        """
+        if not self.exists():
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def get(self, name):
+        """Returns the entry for the given transport map file name, or None"""
+        return self.read().get(name)
+
+    def update(self, name, entry):
+        """
+        Sets the entry of a transport map. Safe to call from concurrent processes.
+
+        Parameters
+        ----------
+        name : str
+            The transport map file name.
+        entry : dict
+            The entry to record. Must be JSON serializable.
+        """
+        with FileLock(self.path + '.lock'):
+            entries = self.read()
+            entries[name] = entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.manifest_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True, default=str)
+            os.replace(tmp_path, self.path)
@@ -11,7 +11,8 @@ import wot
 
 
 def transport_stable_learn_growth(C, lambda1, lambda2, epsilon, scaling_iter, g, pp=None, qq=None, tau=None,
-                                  epsilon0=None, growth_iters=3, inner_iter_max=None):
+                                  epsilon0=None, growth_iters=3, inner_iter_max=None, checkpoint=None,
+                                  return_potentials=False):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
@@ -22,18 +23,32 @@ def transport_stable_learn_growth(C, lambda1, lambda2, epsilon, scaling_iter, g,
         epsilon: entropy parameter
         scaling_iter: number of scaling iterations
         g: growth value for input cells
+        checkpoint: optional wot.ot.SolverCheckpoint to periodically save the solver state to, and resume from
+        return_potentials: whether to also return the dual potentials f, g and the final epsilon,
+            such that Tmap = exp((f[:, None] - C + g[None, :]) / epsilon)
     """
-    for i in range(growth_iters):
-        if i == 0:
+    state = checkpoint.load(C.shape) if checkpoint is not None else None
+    first_growth_iter = 0
+    if state is not None:
+        first_growth_iter = int(state['growth_iter'])
+        wot.io.verbose("Resuming from growth iteration {}, iteration {}".format(first_growth_iter,
+                                                                                int(state['iteration'])))
+    for i in range(first_growth_iter, growth_iters):
+        if state is not None and i == first_growth_iter:
+            rowSums = state['g']
+        elif i == 0:
             rowSums = g
         else:
             rowSums = Tmap.sum(axis=1) / Tmap.shape[1]
 
-        Tmap = transport_stablev2(C=C, lambda1=lambda1, lambda2=lambda2, epsilon=epsilon,
-                                  scaling_iter=scaling_iter, g=rowSums, tau=tau,
-                                  epsilon0=epsilon0, pp=pp, qq=qq, numInnerItermax=inner_iter_max,
-                                  extra_iter=1000)
-    return Tmap
+        result = transport_stablev2(C=C, lambda1=lambda1, lambda2=lambda2, epsilon=epsilon,
+                                    scaling_iter=scaling_iter, g=rowSums, tau=tau,
+                                    epsilon0=epsilon0, pp=pp, qq=qq, numInnerItermax=inner_iter_max,
+                                    extra_iter=1000, checkpoint=checkpoint, growth_iter=i,
+                                    state=state if i == first_growth_iter else None,
+                                    return_potentials=return_potentials)
+        Tmap = result[0] if return_potentials else result
+    return result
 
 
 def transport_stablev_learn_growth_duality_gap(C, g, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0,
@@ -224,7 +239,7 @@ def transport_stablev1(C, g, pp, qq, lambda1, lambda2, epsilon, batch_size, tole
 
 
 def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, numInnerItermax, tau,
-                       epsilon0, extra_iter):
+                       epsilon0, extra_iter, checkpoint=None, growth_iter=0, state=None, return_potentials=False):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
@@ -235,6 +250,11 @@ def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, nu
         epsilon: entropy parameter
         scaling_iter: number of scaling iterations
         g: growth value for input cells
+        checkpoint: optional wot.ot.SolverCheckpoint to periodically save the solver state to
+        growth_iter: growth iteration recorded in checkpoints
+        state: solver state loaded from a checkpoint, to resume from
+        return_potentials: whether to also return the dual potentials f, g and the final epsilon,
+            such that the transport map is exp((f[:, None] - C + g[None, :]) / epsilon)
     """
 
     warm_start = tau is not None
@@ -262,15 +282,31 @@ def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, nu
 
     u = np.zeros(len(p))
     v = np.zeros(len(q))
+    a = np.ones(len(p))
     b = np.ones(len(q))
-    K = np.exp(-C / epsilon_i)
+    epsilon_index = 0
+    iterations_since_epsilon_adjusted = 0
+    first_iteration = 0
+    if state is not None:
+        u, v, a, b = state['u'], state['v'], state['a'], state['b']
+        epsilon_index = int(state['epsilon_index'])
+        iterations_since_epsilon_adjusted = int(state['iterations_since_epsilon_adjusted'])
+        first_iteration = int(state['iteration'])
+        if warm_start:
+            epsilon_i = get_reg(epsilon_index)
+    # u and v are only updated along with K, so K can be rebuilt from them
+    K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
 
     alpha1 = lambda1 / (lambda1 + epsilon_i)
     alpha2 = lambda2 / (lambda2 + epsilon_i)
-    epsilon_index = 0
-    iterations_since_epsilon_adjusted = 0
 
-    for i in range(scaling_iter):
+    def save_checkpoint(iteration):
+        if checkpoint is not None and checkpoint.is_due():
+            checkpoint.save(growth_iter=growth_iter, iteration=iteration, g=g, u=u, v=v, a=a, b=b,
+                            epsilon_index=epsilon_index,
+                            iterations_since_epsilon_adjusted=iterations_since_epsilon_adjusted)
+
+    for i in range(min(first_iteration, scaling_iter), scaling_iter):
         # scaling iteration
         a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
         b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
@@ -295,11 +331,15 @@ def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, g, pp, qq, nu
             K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
             a = np.ones(len(p))
             b = np.ones(len(q))
+        save_checkpoint(i + 1)
 
-    for i in range(extra_iter):
+    for i in range(max(first_iteration - scaling_iter, 0), extra_iter):
         a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
         b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+        save_checkpoint(scaling_iter + i + 1)
 
+    if return_potentials:
+        return (K.T * a).T * b, u + epsilon_i * np.log(a), v + epsilon_i * np.log(b), epsilon_i
     return (K.T * a).T * b
 
 
@@ -512,6 +552,42 @@ def compute_pca(m1, m2, n_components):
     return pca_1, pca_2, pca, mean_shift
 
 
+def compute_pca_loadings(m1, m2, pca_1, pca_2, mean_shift, singular_values):
+    """
+    Computes the gene loadings of the local PCA computed by compute_pca.
+
+    The coordinates of a cell x are then ((x - mean_shift) - mean(x - mean_shift)) @ loadings / singular_values,
+    which is how new cells are projected. See pca_project
+
+    Parameters
+    ----------
+    m1, m2 : ndarray or scipy.sparse.spmatrix
+        The matrices passed to compute_pca.
+    pca_1, pca_2, mean_shift, singular_values : ndarray
+        The coordinates and mean returned by compute_pca, and the singular values of its PCA.
+
+    Returns
+    -------
+    loadings : ndarray
+        The loadings, of shape (n_genes, n_components).
+    """
+    x = scipy.sparse.vstack((m1, m2)) if scipy.sparse.issparse(m1) or scipy.sparse.issparse(m2) else np.vstack((m1, m2))
+    coordinates = np.vstack((pca_1, pca_2))
+    # each cell was also centered over genes by the PCA, computed without densifying x
+    row_means = np.asarray(x.mean(axis=1)).ravel() - mean_shift.mean()
+    loadings = np.asarray(x.T @ coordinates) - np.outer(mean_shift, coordinates.sum(axis=0)) \
+               - np.outer(np.ones(x.shape[1]), row_means @ coordinates)
+    return loadings / singular_values
+
+
+def pca_project(x, mean_shift, loadings, singular_values):
+    """Projects cells in the local PCA coordinates, see compute_pca_loadings"""
+    x = x.toarray() if scipy.sparse.issparse(x) else np.asarray(x)
+    x = x - mean_shift
+    x = x - x.mean(axis=1, keepdims=True)
+    return x @ loadings / singular_values
+
+
 def get_pca(dim, *args):
     """
     Get a PCA projector for the arguments.
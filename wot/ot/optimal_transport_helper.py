@@ -32,15 +32,7 @@ class OptimalTransportHelper:
         ds = wot.io.filter_ds_from_command_line(ds, args)
 
         if args.ncounts is not None:
-            for i in range(ds.X.shape[0]):
-                p = ds.X[i]
-                if scipy.sparse.isspmatrix(p):
-                    p = p.toarray()
-                p = p.astype('float64')
-                counts_p = p.sum()
-                if counts_p > args.ncounts:
-                    p /= counts_p
-                    ds.X[i] = np.random.multinomial(args.ncounts, p, size=1)[0]
+            ds = anndata.AnnData(wot.downsample_counts(ds.X, args.ncounts, seed=args.seed), ds.obs, ds.var)
 
         days_data_frame = wot.io.read_days_data_frame(args.cell_days)
         day_pairs = None
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import tempfile
+import time
 
 import anndata
 import itertools
@@ -11,6 +13,7 @@ import sklearn
 
 import wot.io
 import wot.ot
+import wot.tmap
 
 
 class OTModel:
@@ -19,8 +22,9 @@ class OTModel:
 
     Parameters
     ----------
-    matrix : anndata.AnnData
+    matrix : anndata.AnnData or wot.io.LazyDataset
         The gene expression matrix for this OTModel. Matrix must have the row meta data field 'day'.
+        With a wot.io.LazyDataset, only the cells of the day pair being computed are read in memory.
     transport_maps_directory : str
         Path to the transport map directory, where transport maps are written.
     transport_maps_prefix : str, optional
@@ -32,15 +36,42 @@ class OTModel:
         The default prefix for transport maps is 'tmaps'
     max_threads : int, optional
         Maximum number of threads to use when computing transport maps
+    max_memory : int, optional
+        Memory budget in bytes when computing transport maps in parallel.
+        Day pairs are only started while their estimated footprint fits in the budget.
+    cache : bool, optional, default : False
+        Whether to cache PCA coordinates and cost matrices in a directory next to the transport maps,
+        so that they are not recomputed when only OT parameters change.
+    cache_max_bytes : int, optional
+        Maximum size of the cache directory. Unbounded if None.
+    ncounts : int, optional
+        Number of counts to downsample each cell to. See wot.downsample_counts
+    seed : int, optional
+        Seed of the random number generator used to downsample counts and cells.
+    max_pair_bytes : int, optional
+        Memory budget in bytes for each transport map. Days of the day pairs whose estimated footprint
+        exceeds it are subsampled, stratified by covariate, see get_sample_fractions. The position of the
+        sampled cells within their day is stored as 'sample_index' in the obs and var of the transport maps.
+    extensible : bool, optional, default : False
+        Also store the dual potentials, the local PCA coordinates and the cost parameters with the transport maps,
+        so that new cells can be placed in them, see wot.tmap.TransportMapModel.extend.
+    factored : bool, optional, default : False
+        Write transport maps in the factored format: only the dual potentials, the local PCA coordinates
+        and the cost parameters, from which wot.tmap.FactoredTransportMap evaluates the transport map.
+        Factored transport maps are always extensible.
+    checkpoint_interval : float, optional, default : 600
+        Seconds between saves of the solver state, so that an interrupted transport map resumes
+        where it stopped instead of starting over. 0 or None to disable checkpoints.
     **kwargs : dict
         Dictionnary of parameters. Will be inserted as is into OT configuration.
     """
 
-    def __init__(self, matrix, tmap_out, max_threads=None, **kwargs):
+    def __init__(self, matrix, tmap_out, max_threads=None, max_memory=None, **kwargs):
         tmap_dir, tmap_prefix = os.path.split(tmap_out) if tmap_out is not None else (None, None)
         self.matrix = matrix
         self.tmap_dir = tmap_dir or '.'
         self.tmap_prefix = tmap_prefix or "tmaps"
+        self.max_memory = max_memory
         self.day_pairs = wot.ot.parse_configuration(kwargs.pop('day_pairs', None))
 
         cell_filter = kwargs.pop('cell_filter', None)
@@ -48,8 +79,28 @@ class OTModel:
         day_filter = kwargs.pop('cell_day_filter', None)
         ncounts = kwargs.pop('ncounts', None)
         ncells = kwargs.pop('ncells', None)
+        seed = kwargs.pop('seed', None)
+        self.max_pair_bytes = kwargs.pop('max_pair_bytes', None)
         self.force = kwargs.pop('force', False)
+        self.filters = {'cell_filter': cell_filter, 'gene_filter': gene_filter, 'cell_day_filter': day_filter,
+                        'ncells': ncells, 'ncounts': ncounts, 'seed': seed, 'max_pair_bytes': self.max_pair_bytes}
+        self.manifest = wot.ot.TransportMapManifest(
+            os.path.join(self.tmap_dir, self.tmap_prefix + '_manifest.json'))
         self.output_file_format = kwargs.pop('output_file_format', 'h5ad')
+        self.factored = kwargs.pop('factored', False)
+        if self.factored and self.output_file_format != 'h5ad':
+            raise ValueError("Factored transport maps can only be written as h5ad")
+        self.extensible = kwargs.pop('extensible', False) or self.factored
+        # part of the digest, so that transport maps are rewritten when the format changes
+        self.filters['factored'] = self.factored
+        self.filters['extensible'] = self.extensible
+        use_cache = kwargs.pop('cache', False)
+        cache_max_bytes = kwargs.pop('cache_max_bytes', None)
+        self.checkpoint_interval = kwargs.pop('checkpoint_interval', 600)
+        # filters only select row and column indices, the matrix is copied once at the end
+        obs = self.matrix.obs
+        rows = np.arange(self.matrix.shape[0])
+        columns = None
         if gene_filter is not None:
             if os.path.isfile(gene_filter):
                 gene_ids = pd.read_table(gene_filter, index_col=0, header=None) \
@@ -58,9 +109,7 @@ class OTModel:
                 import re
                 expr = re.compile(gene_filter)
                 gene_ids = [e for e in self.matrix.var.index.values if expr.match(e)]
-            col_indices = self.matrix.var.index.isin(gene_ids)
-            self.matrix = anndata.AnnData(self.matrix.X[:, col_indices],
-                                          self.matrix.obs, self.matrix.var[col_indices].copy(False))
+            columns = np.where(self.matrix.var.index.isin(gene_ids))[0]
             wot.io.verbose('Successfuly applied gene_filter: "{}"'.format(gene_filter))
         if cell_filter is not None:
             if os.path.isfile(cell_filter):
@@ -69,59 +118,74 @@ class OTModel:
             else:
                 import re
                 expr = re.compile(cell_filter)
-                cell_ids = [e for e in self.matrix.obs.index.values if expr.match(e)]
-            row_indices = self.matrix.obs.index.isin(cell_ids)
-            self.matrix = anndata.AnnData(self.matrix.X[row_indices, :],
-                                          self.matrix.obs[row_indices].copy(False), self.matrix.var)
+                cell_ids = [e for e in obs.index.values[rows] if expr.match(e)]
+            rows = rows[obs.index[rows].isin(cell_ids)]
 
             wot.io.verbose('Successfuly applied cell_filter: "{}"'.format(cell_filter))
         if day_filter is not None:
-            days = day_filter.split(',')
-            row_indices = self.matrix.obs['day'].isin(days)
-            self.matrix = anndata.AnnData(self.matrix.X[row_indices, :],
-                                          self.matrix.obs[row_indices].copy(False), self.matrix.var)
+            days = [float(day) for day in day_filter.split(',')]
+            rows = rows[obs['day'].iloc[rows].isin(days).values]
 
             wot.io.verbose('Successfuly applied day_filter: "{}"'.format(day_filter))
-        self.timepoints = sorted(set(self.matrix.obs['day']))
-        cvs = sorted(set(self.matrix.obs['covariate'])) if 'covariate' in self.matrix.obs else [None]
+        self.timepoints = sorted(set(obs['day'].values[rows]))
+        cvs = sorted(set(obs['covariate'].values[rows])) if 'covariate' in obs else [None]
+        self.seed = seed if seed is not None else np.random.randint(2 ** 31)
         if ncells is not None:
+            rng = np.random.RandomState(self.seed)
             index_list = []
+            row_days = obs['day'].values[rows]
             for day in self.timepoints:
-                day_query = self.matrix.obs['day'] == day
+                day_query = row_days == day
                 for cv in cvs:
                     if cv is None:
-                        indices = np.where(day_query)[0]
+                        indices = rows[day_query]
                     else:
-                        indices = np.where(day_query & (self.matrix.obs['covariate'] == cv))[0]
+                        indices = rows[day_query & (obs['covariate'].values[rows] == cv)]
                     if len(indices) > ncells:
-                        np.random.shuffle(indices)
+                        rng.shuffle(indices)
                         indices = indices[0:ncells]
                     index_list.append(indices)
-            row_indices = np.concatenate(index_list)
-            self.matrix = anndata.AnnData(self.matrix.X[row_indices, :],
-                                          self.matrix.obs.iloc[row_indices].copy(False), self.matrix.var)
-        if ncounts is not None:
-            for i in range(self.matrix.X.shape[0]):
-                p = self.matrix.X[i]
-                if scipy.sparse.isspmatrix(p):
-                    p = p.toarray()
-                p = p.astype('float64')
-                total = p.sum()
-                if total > ncounts:
-                    p /= total
-                    self.matrix.X[i] = np.random.multinomial(ncounts, p, size=1)[0]
-
-        if self.matrix.X.shape[0] is 0:
+            rows = np.concatenate(index_list)
+        rows = rows[OTModel.get_row_order(obs.iloc[rows])]
+        self.lazy = isinstance(self.matrix, wot.io.LazyDataset)
+        if self.lazy:
+            self.matrix = self.matrix.subset(rows, columns)
+        elif columns is not None or not np.array_equal(rows, np.arange(self.matrix.shape[0])):
+            x = self.matrix.X
+            if columns is None:
+                x = x[rows]
+            elif scipy.sparse.issparse(x):
+                x = x[rows][:, columns]
+            else:
+                x = x[np.ix_(rows, columns)]
+            self.matrix = anndata.AnnData(x, obs.iloc[rows].copy(),
+                                          self.matrix.var.iloc[columns].copy() if columns is not None
+                                          else self.matrix.var)
+        # lazy datasets are downsampled when read
+        self.lazy_ncounts = ncounts if self.lazy else None
+        if ncounts is not None and not self.lazy:
+            self.matrix = anndata.AnnData(wot.downsample_counts(self.matrix.X, ncounts, seed=seed),
+                                          self.matrix.obs, self.matrix.var)
+
+        self.row_ranges = None
+        self.index_rows()
+        self.shared_matrix = None
+        self.writer = None
+        self.cache = None
+        if use_cache and ncounts is not None and seed is None:
+            # every run downsamples differently, cached cost matrices would not match
+            print("Warning : cache disabled, ncounts requires a seed to be cached")
+        elif use_cache:
+            self.cache = wot.ot.ComputationCache(os.path.join(self.tmap_dir, self.tmap_prefix + '_cache'),
+                                                 max_bytes=cache_max_bytes, salt={'ncounts': ncounts, 'seed': seed})
+
+        if self.matrix.shape[0] == 0:
             print('No cells in matrix')
             exit(1)
         wot.io.verbose(len(self.timepoints), "timepoints loaded :", self.timepoints)
 
         if max_threads is None or max_threads == 0:
-            try:
-                max_usable_cores = len(os.sched_getaffinity(0))
-            except Exception:
-                import multiprocessing
-                max_usable_cores = multiprocessing.cpu_count()
+            max_usable_cores = wot.ot.get_usable_cores()
             if kwargs.pop('fast', False):
                 wot.io.verbose("Fast mode. Using all but one core")
                 self.max_threads = max_usable_cores - 1
@@ -140,9 +204,9 @@ class OTModel:
         for k in kwargs.keys():
             self.ot_config[k] = kwargs[k]
         local_pca = self.ot_config['local_pca']
-        if local_pca > self.matrix.X.shape[1]:
+        if local_pca > self.matrix.shape[1]:
             print("Warning : local_pca set to {}, above gene count of {}. Disabling PCA" \
-                  .format(local_pca, self.matrix.X.shape[1]))
+                  .format(local_pca, self.matrix.shape[1]))
             self.ot_config['local_pca'] = 0
         if 'day' not in self.matrix.obs.columns:
             raise ValueError("Days information not available for matrix")
@@ -151,6 +215,19 @@ class OTModel:
             faulty = list(self.matrix.obs.index[query])
             raise ValueError("Days information missing for cells : {}".format(faulty))
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared_matrix is not None:
+            # workers attach to the shared matrix rather than receiving a copy
+            state['matrix'] = None
+        state['writer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.matrix is None:
+            self.matrix = self.shared_matrix.attach()
+
     def get_covariate_pairs(self):
         """Get all covariate pairs in the dataset"""
         if 'covariate' not in self.matrix.obs.columns:
@@ -159,33 +236,172 @@ class OTModel:
         covariate = sorted(set(self.matrix.obs['covariate']))
         return product(covariate, covariate)
 
-    def compute_all_transport_maps(self, with_covariates=False):
+    def get_day_pairs(self, with_covariates=False):
         """
-        Computes all required transport maps.
+        Lists the transport maps to compute.
 
         Parameters
         ----------
-        force : bool, optional, default : False
-            Force recomputation of each transport map, after config update for instance.
         with_covariates : bool, optional, default : False
-            Compute all covariate-restricted transport maps as well
+            List all covariate-restricted transport maps as well
 
         Returns
         -------
-        None
-            Only computes and saves all transport maps, does not return them.
+        day_pairs : list of (float, float) or (float, float, (int, int))
+            The configured day pairs, or all consecutive timepoints if none were configured
         """
         t = self.timepoints
         day_pairs = self.day_pairs
 
         if day_pairs is None or len(day_pairs) == 0:
             day_pairs = [(t[i], t[i + 1]) for i in range(len(t) - 1)]
+        else:
+            day_pairs = list(day_pairs)
 
         if with_covariates:
             covariate_day_pairs = [(*d, c) for d, c in itertools.product(day_pairs, self.get_covariate_pairs())]
             # if type(day_pairs) is dict:
             #     day_pairs = list(day_pairs.keys())
             day_pairs = covariate_day_pairs
+        return day_pairs
+
+    def plan(self, max_memory=None, with_covariates=False):
+        """
+        Predicts the size, peak memory and running time of each transport map, without computing them.
+
+        Only the number of cells per day (and covariate) and the configuration are used.
+        Running times are extrapolated from a small calibration run on the current machine.
+
+        Parameters
+        ----------
+        max_memory : int, optional
+            Memory budget in bytes. Defaults to the budget of the OTModel, if any.
+        with_covariates : bool, optional, default : False
+            Plan all covariate-restricted transport maps as well
+
+        Returns
+        -------
+        plan : pandas.DataFrame
+            One row per day pair with columns t0, t1, covariate, n0, n1, size, peak_bytes and seconds.
+        suggestions : list of str
+            Settings that would make the computation fit in max_memory.
+        """
+        if max_memory is None:
+            max_memory = self.max_memory
+        n_features = self.matrix.shape[1]
+        local_pca = self.ot_config['local_pca']
+        solver_seconds = wot.ot.calibrate_solver()
+        pca_seconds = wot.ot.calibrate_pca(n_features, local_pca) if local_pca > 0 else 0
+        rows = []
+        for x in self.get_day_pairs(with_covariates):
+            config = {**self.ot_config, **(self.day_pairs.get((x[0], x[1]), {}) if self.day_pairs else {})}
+            n0, n1 = self.get_cell_counts(*x)
+            iterations = config['growth_iters'] * (config['scaling_iter'] + 1000)
+            rows.append({'t0': x[0], 't1': x[1], 'covariate': x[2] if len(x) > 2 else None, 'n0': n0, 'n1': n1,
+                         'size': n0 * n1,
+                         'peak_bytes': wot.ot.estimate_transport_map_bytes(n0, n1, n_features),
+                         'seconds': solver_seconds * n0 * n1 * iterations + pca_seconds * (n0 + n1)})
+        plan = pd.DataFrame(rows, columns=['t0', 't1', 'covariate', 'n0', 'n1', 'size', 'peak_bytes', 'seconds'])
+        suggestions = []
+        if max_memory is not None and len(plan) > 0:
+            largest = plan['peak_bytes'].max()
+            if largest > max_memory:
+                ncells = self.suggest_ncells(max_memory, with_covariates)
+                if ncells is None:
+                    suggestions.append('No value of ncells fits the memory budget')
+                else:
+                    suggestions.append('Use ncells={} to fit the largest day pair in the memory budget'.format(ncells))
+                suggestions.append('Use max_pair_bytes={} to only subsample the day pairs above the memory budget'
+                                   .format(max_memory))
+            else:
+                max_threads = int(min(max_memory // largest, wot.ot.get_usable_cores(), len(plan)))
+                suggestions.append('Up to max_threads={} day pairs fit in the memory budget at once'.format(max_threads))
+        return plan, suggestions
+
+    def suggest_ncells(self, max_memory, with_covariates=False):
+        """
+        Finds the largest ncells for which every transport map fits in max_memory.
+
+        Returns
+        -------
+        ncells : int or None
+            The number of cells to downsample from each timepoint and covariate, None if even 1 does not fit.
+        """
+        obs = self.matrix.obs
+        n_features = self.matrix.shape[1]
+        group_by = ['day', 'covariate'] if 'covariate' in obs.columns else ['day']
+        sizes = obs.groupby(group_by).size()
+        day_pairs = self.get_day_pairs(with_covariates)
+
+        def count(day, covariate, ncells):
+            if covariate is None:
+                s = sizes[day] if len(group_by) == 1 else sizes.loc[day]
+            else:
+                s = sizes.loc[(day, covariate)]
+            return int(np.minimum(s, ncells).sum())
+
+        def fits(ncells):
+            for x in day_pairs:
+                cv = x[2] if len(x) > 2 else (None, None)
+                n0 = count(float(x[0]), cv[0], ncells)
+                n1 = count(float(x[1]), cv[1], ncells)
+                if wot.ot.estimate_transport_map_bytes(n0, n1, n_features) > max_memory:
+                    return False
+            return True
+
+        low, high = 0, int(sizes.max())
+        while low < high:
+            mid = (low + high + 1) // 2
+            if fits(mid):
+                low = mid
+            else:
+                high = mid - 1
+        return low if low > 0 else None
+
+    def compute_all_transport_maps(self, with_covariates=False):
+        """
+        Computes all required transport maps.
+
+        Parameters
+        ----------
+        force : bool, optional, default : False
+            Force recomputation of each transport map, after config update for instance.
+        with_covariates : bool, optional, default : False
+            Compute all covariate-restricted transport maps as well
+
+        Returns
+        -------
+        None
+            Only computes and saves all transport maps, does not return them.
+        """
+        for _ in self.iter_transport_maps(with_covariates):
+            pass
+
+    def iter_transport_maps(self, with_covariates=False):
+        """
+        Computes and saves all required transport maps, yielding each one as soon as it is computed.
+
+        Transport maps are yielded in completion order when computed in parallel. All transport maps are
+        written once the iteration completes, and must not be modified before.
+        See TransportMapModel.from_transport_maps to use them directly.
+
+        Parameters
+        ----------
+        with_covariates : bool, optional, default : False
+            Compute all covariate-restricted transport maps as well
+
+        Yields
+        ------
+        t0, t1, tmap : float, float, anndata.AnnData
+            Each transport map with its day pair.
+            Covariate-restricted transport maps are yielded as t0, t1, covariate, tmap.
+
+        Examples
+        --------
+        >>> tmaps = {(t0, t1): tmap for t0, t1, tmap in ot_model.iter_transport_maps()}
+        >>> tmap_model = wot.tmap.TransportMapModel.from_transport_maps(tmaps)
+        """
+        day_pairs = self.get_day_pairs(with_covariates)
 
         # if not force:
         #     if with_covariates:
@@ -201,15 +417,81 @@ class OTModel:
             return
 
         if m > 1:
-            from joblib import Parallel, delayed
-            Parallel(n_jobs=m)(delayed(self.compute_transport_map)(*x) for x in day_pairs)
+            # Share the matrix through memory-mapped files so that it is not pickled into every worker.
+            # Lazy datasets only pickle their metadata, and workers read their rows from disk.
+            if not self.lazy:
+                self.shared_matrix = wot.ot.SharedDataset(self.matrix, directory=self.tmap_dir)
+            try:
+                scheduler = wot.ot.TransportMapScheduler(m, max_memory=self.max_memory)
+                tasks = [(x, self.estimate_transport_map_bytes(*x), self.compute_transport_map, x) for x in day_pairs]
+                for x, tmap in scheduler.run(tasks):
+                    yield (*x, tmap)
+            finally:
+                if self.shared_matrix is not None:
+                    self.shared_matrix.close()
+                self.shared_matrix = None
         else:
-            for x in day_pairs:
-                self.compute_transport_map(*x)
+            # transport maps are written in the background while the next one is computed
+            with wot.ot.TransportMapWriter() as writer:
+                self.writer = writer
+                try:
+                    for x in day_pairs:
+                        yield (*x, self.compute_transport_map(*x))
+                finally:
+                    self.writer = None
+
+    def run_worker(self, with_covariates=False, lease_timeout=600, poll_interval=10):
+        """
+        Computes transport maps cooperatively with other workers sharing the transport map directory.
 
-    def compute_transport_map(self, t0, t1, covariate=None):
+        Each worker claims the day pairs that are neither computed nor claimed, with a lease file next
+        to the transport maps. Pairs whose worker stopped renewing its lease, e.g. after a crash, are
+        claimed again, and resume from the solver checkpoint. Run one worker per host, on any number
+        of hosts pointed at the same directory. Returns once all transport maps are computed.
+
+        Parameters
+        ----------
+        with_covariates : bool, optional, default : False
+            Compute all covariate-restricted transport maps as well
+        lease_timeout : float, optional, default : 600
+            Seconds without heartbeat after which the pair of a worker is claimed by another.
+        poll_interval : float, optional, default : 10
+            Seconds to wait before checking again the pairs claimed by other workers.
+
+        Raises
+        ------
+        ValueError
+            If the OTModel was initialized with force, as workers could not tell which maps are done.
         """
-        Computes the transport map from time t0 to time t1
+        if self.force:
+            raise ValueError("force is not supported by workers")
+        pending = self.get_day_pairs(with_covariates)
+        while len(pending) > 0:
+            claimed = False
+            for x in list(pending):
+                if self.is_transport_map_current(*x):
+                    pending.remove(x)
+                    continue
+                # hidden, so that it is never mistaken for a transport map
+                lease = wot.ot.Lease(os.path.join(self.tmap_dir, '.' + self.get_transport_map_name(*x) + '.lease'),
+                                     timeout=lease_timeout)
+                if not lease.acquire():
+                    continue
+                claimed = True
+                try:
+                    # another worker may have completed it before the lease was acquired
+                    if not self.is_transport_map_current(*x):
+                        self.compute_transport_map(*x)
+                finally:
+                    lease.release()
+                pending.remove(x)
+            if len(pending) > 0 and not claimed:
+                wot.io.verbose(len(pending), "transport map(s) computed by other workers. Waiting")
+                time.sleep(poll_interval)
+
+    def get_cell_counts(self, t0, t1, covariate=None):
+        """
+        Counts the cells involved in the transport map from t0 to t1
 
         Parameters
         ----------
@@ -222,43 +504,346 @@ class OTModel:
 
         Returns
         -------
-        anndata.AnnData
-            The transport map from t0 to t1
+        n0, n1 : int
+            The number of cells at t0 and t1
+        """
+        return tuple(indices.stop - indices.start if isinstance(indices, slice) else len(indices)
+                     for indices in self.get_pair_indices(t0, t1, covariate))
+
+    def get_pair_indices(self, t0, t1, covariate=None):
+        """
+        Returns the rows of the cells at t0 and t1. See get_cell_counts
+
+        Returns
+        -------
+        p0_indices, p1_indices : slice or ndarray of int
+            The row slices of the cells, or the sorted rows of the cells sampled to fit in max_pair_bytes.
+        """
+        if covariate is None:
+            keys = [float(t0), float(t1)]
+        else:
+            keys = [(float(t0), covariate[0]), (float(t1), covariate[1])]
+        fractions = self.get_sample_fractions()
+        result = []
+        for t, key in zip((float(t0), float(t1)), keys):
+            start, stop = self.row_ranges.get(key, (0, 0))
+            if t in fractions:
+                rows = self.get_day_sample(t, fractions[t])
+                result.append(rows[(rows >= start) & (rows < stop)])
+            else:
+                result.append(slice(start, stop))
+        return tuple(result)
+
+    @staticmethod
+    def get_sample_size(n, fraction):
+        """Number of cells sampled from n cells for the given fraction, at least one"""
+        return min(n, max(1, int(round(n * fraction)))) if n > 0 else 0
+
+    def get_sample_fractions(self):
+        """
+        Finds the fraction of the cells of each day to sample so that every transport map fits in max_pair_bytes.
+
+        For each day pair, the largest fraction of the cells of both days whose estimated footprint fits
+        the budget is found. Each day then takes the smallest fraction of the day pairs it belongs to,
+        so that it is sampled identically in all its transport maps and these can still be chained.
+
+        Returns
+        -------
+        fractions : dict of float: float
+            The fraction of the cells to sample at each day. Days that are not subsampled are omitted.
 
         Raises
         ------
         ValueError
-            If the OTModel was initialized with day_pairs and the given pair is not present.
+            If not even one cell of each day of a pair fits in max_pair_bytes.
         """
-        path = self.tmap_prefix
-        wot.io.verbose("Computing tmap ({},{})".format(t0, t1))
+        fractions = {}
+        if self.max_pair_bytes is None:
+            return fractions
+        n_features = self.matrix.shape[1]
+        for x in self.get_day_pairs():
+            t0, t1 = float(x[0]), float(x[1])
+            n0, n1 = [stop - start for start, stop in [self.row_ranges.get(t, (0, 0)) for t in (t0, t1)]]
+
+            def fits(fraction):
+                return wot.ot.estimate_transport_map_bytes(OTModel.get_sample_size(n0, fraction),
+                                                           OTModel.get_sample_size(n1, fraction),
+                                                           n_features) <= self.max_pair_bytes
+
+            if fits(1):
+                continue
+            if not fits(0):
+                raise ValueError("Day pair ({}, {}) does not fit in max_pair_bytes={}".format(t0, t1,
+                                                                                             self.max_pair_bytes))
+            low, high = 0, 1
+            for _ in range(40):
+                mid = (low + high) / 2
+                if fits(mid):
+                    low = mid
+                else:
+                    high = mid
+            for t in (t0, t1):
+                fractions[t] = min(fractions.get(t, 1), low)
+        return fractions
+
+    def get_day_sample(self, day, fraction):
+        """
+        Samples a fraction of the cells of a day, stratified by covariate.
+
+        Each covariate contributes in proportion to its number of cells. Cells are taken in the order of
+        a permutation seeded by the day, so that a smaller fraction samples a subset of a larger one.
+
+        Returns
+        -------
+        rows : ndarray of int
+            The sorted rows of the sampled cells.
+        """
+        day = float(day)
+        start, stop = self.row_ranges.get(day, (0, 0))
+        if 'covariate' in self.matrix.obs.columns:
+            groups = sorted(r for key, r in self.row_ranges.items() if isinstance(key, tuple) and key[0] == day)
+        else:
+            groups = [(start, stop)]
+        sizes = np.array([group_stop - group_start for group_start, group_stop in groups])
+        total = OTModel.get_sample_size(stop - start, fraction)
+        # largest remainder allocation of the sample to the covariates
+        quotas = sizes * total / max(sizes.sum(), 1)
+        counts = np.floor(quotas).astype(int)
+        counts[np.argsort(counts - quotas, kind='stable')[:total - counts.sum()]] += 1
+        rng = np.random.RandomState([self.seed, self.timepoints.index(day)])
+        rows = [group_start + np.sort(rng.permutation(group_stop - group_start)[:n])
+                for (group_start, group_stop), n in zip(groups, counts)]
+        return np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=int)
+
+    def get_pair_datasets(self, t0, t1, covariate=None):
+        """
+        Returns the cells at t0 and t1, as views of the matrix, or read from disk for lazy datasets.
+        See get_cell_counts
+
+        Returns
+        -------
+        p0, p1 : anndata.AnnData
+            The cells at t0 and t1
+        """
+        datasets = []
+        for indices in self.get_pair_indices(t0, t1, covariate):
+            ds = self.matrix[indices]
+            if self.lazy_ncounts is not None:
+                # seeded by position so that a block of cells is sampled identically in every pair
+                start = indices.start if isinstance(indices, slice) else (indices[0] if len(indices) > 0 else 0)
+                ds = anndata.AnnData(wot.downsample_counts(ds.X, self.lazy_ncounts,
+                                                           seed=[self.seed, start]), ds.obs, ds.var)
+            datasets.append(ds)
+        return tuple(datasets)
+
+    @staticmethod
+    def get_row_order(obs):
+        """Returns the stable order of the rows of obs by day, then covariate"""
+        keys = [obs['day'].values]
+        if 'covariate' in obs.columns:
+            keys.insert(0, pd.factorize(obs['covariate'].values, sort=True)[0])
+        return np.lexsort(keys)
+
+    def index_rows(self):
+        """
+        Indexes the contiguous range of rows of each day and (day, covariate) of the matrix.
+
+        Rows are sorted by day and covariate first if needed. Call it again after changing
+        the days or covariates of the matrix.
+        """
+        order = OTModel.get_row_order(self.matrix.obs)
+        if self.lazy:
+            self.matrix = self.matrix.subset(order)
+        elif not np.array_equal(order, np.arange(len(order))):
+            self.matrix = anndata.AnnData(self.matrix.X[order], self.matrix.obs.iloc[order].copy(), self.matrix.var)
+
+        def get_ranges(values, offset):
+            boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+            starts = np.concatenate(([0], boundaries))
+            stops = np.concatenate((boundaries, [len(values)]))
+            return [(values[start], int(start + offset), int(stop + offset)) for start, stop in zip(starts, stops)]
+
+        days = self.matrix.obs['day'].values
+        covariates = self.matrix.obs['covariate'].values if 'covariate' in self.matrix.obs.columns else None
+        self.row_ranges = {}
+        if len(days) == 0:
+            return
+        for day, start, stop in get_ranges(days, 0):
+            self.row_ranges[float(day)] = (start, stop)
+            if covariates is not None:
+                for cv, cv_start, cv_stop in get_ranges(covariates[start:stop], start):
+                    self.row_ranges[(float(day), cv)] = (cv_start, cv_stop)
+
+    def compute_transport_map_digest(self, t0, t1, covariate=None, local_config=None):
+        """
+        Computes a digest of all the inputs of a transport map.
+
+        The digest covers the cells and their metadata, the genes, the filters,
+        the OT configuration with its per-pair overrides and the wot version.
+
+        Returns
+        -------
+        digest : str
+            Changes whenever the transport map from t0 to t1 would change
+        """
+        p0_indices, p1_indices = self.get_pair_indices(t0, t1, covariate)
+        obs = self.matrix.obs
+        obs_columns = [c for c in ['cell_growth_rate', 'pp'] if c in obs.columns]
+        return wot.ot.compute_digest(obs.index.values[p0_indices], obs.index.values[p1_indices],
+                                     [obs[c].values[p0_indices] for c in obs_columns],
+                                     [obs[c].values[p1_indices] for c in obs_columns],
+                                     self.matrix.var.index.values, self.filters, self.ot_config,
+                                     local_config or {}, covariate, wot.__version__)
+
+    def estimate_transport_map_bytes(self, t0, t1, covariate=None):
+        """Estimates the peak memory needed to compute the transport map from t0 to t1. See get_cell_counts"""
+        n0, n1 = self.get_cell_counts(t0, t1, covariate)
+        return wot.ot.estimate_transport_map_bytes(n0, n1, self.matrix.shape[1])
+
+    def get_local_config(self, t0, t1):
+        """Returns the configuration specific to the day pair, from day_pairs"""
         # If day_pairs is not None, its configuration takes precedence
         if self.day_pairs is not None:
             if (t0, t1) not in self.day_pairs:
                 raise ValueError("Transport map ({},{}) is not present in day_pairs".format(t0, t1))
-            local_config = self.day_pairs[(t0, t1)]
-        else:
-            local_config = {}
+            return self.day_pairs[(t0, t1)]
+        return {}
 
+    def get_transport_map_name(self, t0, t1, covariate=None):
+        """Returns the name of the transport map from t0 to t1, without extension"""
         if covariate is None:
-            path += "_{}_{}".format(t0, t1)
-        else:
-            path += "_{}_{}_cv{}_cv{}".format(t0, t1, *covariate)
-        output_file = os.path.join(self.tmap_dir, path)
-        output_file = wot.io.check_file_extension(output_file, self.output_file_format)
+            return self.tmap_prefix + "_{}_{}".format(t0, t1)
+        return self.tmap_prefix + "_{}_{}_cv{}_cv{}".format(t0, t1, *covariate)
+
+    def get_transport_map_path(self, t0, t1, covariate=None):
+        """Returns the path of the transport map from t0 to t1"""
+        output_file = os.path.join(self.tmap_dir, self.get_transport_map_name(t0, t1, covariate))
+        return wot.io.check_file_extension(output_file, self.output_file_format)
+
+    def is_transport_map_current(self, t0, t1, covariate=None, digest=None):
+        """
+        Whether the transport map from t0 to t1 exists and was computed from the current inputs.
+
+        Maps without a manifest entry, written before manifests existed, are trusted.
+        """
+        output_file = self.get_transport_map_path(t0, t1, covariate)
+        if not os.path.exists(output_file):
+            return False
+        entry = self.manifest.get(os.path.basename(output_file))
+        if entry is None:
+            return True
+        if digest is None:
+            digest = self.compute_transport_map_digest(t0, t1, covariate, self.get_local_config(t0, t1))
+        return entry['digest'] == digest
+
+    def compute_transport_map(self, t0, t1, covariate=None):
+        """
+        Computes the transport map from time t0 to time t1
+
+        Parameters
+        ----------
+        t0 : float
+            Source timepoint for the transport map
+        t1 : float
+            Destination timepoint for the transport map
+        covariate : None or (int, int)
+            The covariate restriction on cells from t0 and t1. None to skip
+
+        Returns
+        -------
+        anndata.AnnData
+            The transport map from t0 to t1
+
+        Raises
+        ------
+        ValueError
+            If the OTModel was initialized with day_pairs and the given pair is not present.
+        """
+        wot.io.verbose("Computing tmap ({},{})".format(t0, t1))
+        local_config = self.get_local_config(t0, t1)
+        path = self.get_transport_map_name(t0, t1, covariate)
+        output_file = self.get_transport_map_path(t0, t1, covariate)
+        digest = self.compute_transport_map_digest(t0, t1, covariate, local_config)
         if os.path.exists(output_file) and not self.force:
-            wot.io.verbose('Found existing tmap at ' + output_file + '. Use --force to overwrite.')
-            return wot.io.read_dataset(output_file)
+            if self.is_transport_map_current(t0, t1, covariate, digest):
+                wot.io.verbose('Found existing tmap at ' + output_file + '. Use --force to overwrite.')
+                return wot.io.read_dataset(output_file)
+            wot.io.verbose('Inputs of ' + output_file + ' changed. Recomputing')
 
         config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
-        tmap = OTModel.compute_single_transport_map(self.matrix, config)
-        wot.io.write_dataset(tmap, output_file, output_format=self.output_file_format)
-        wot.io.verbose("Created tmap ({}, {}) : {}".format(t0, t1, path))
+        checkpoint = None
+        if self.checkpoint_interval:
+            # hidden, so that it is never mistaken for a transport map
+            checkpoint = wot.ot.SolverCheckpoint(os.path.join(self.tmap_dir, '.' + path + '.checkpoint.npz'),
+                                                 interval=self.checkpoint_interval, digest=digest)
+            config['checkpoint'] = checkpoint
+        p0, p1 = self.get_pair_datasets(t0, t1, covariate)
+        tmap = OTModel.compute_pair_transport_map(p0, p1, config, cache=self.cache, extensible=self.extensible)
+        if self.max_pair_bytes is not None:
+            # position of the sampled cells among all the cells of their day
+            for meta, t, indices in zip((tmap.obs, tmap.var), (t0, t1), self.get_pair_indices(t0, t1, covariate)):
+                meta['sample_index'] = np.arange(self.matrix.shape[0])[indices] - self.row_ranges[float(t)][0]
+        args = (tmap, output_file, {'digest': digest, 'ot_config': {**self.ot_config, **local_config},
+                                    'filters': self.filters, 'wot_version': wot.__version__}, checkpoint)
+        if self.writer is not None:
+            self.writer.submit(self.save_transport_map, *args)
+        else:
+            self.save_transport_map(*args)
         return tmap
 
-    @staticmethod
-    def compute_default_cost_matrix(a, b, eigenvals=None):
+    def save_transport_map(self, tmap, output_file, entry, checkpoint=None):
+        """
+        Writes a transport map and flushes it to disk, then records it in the manifest.
+
+        Parameters
+        ----------
+        tmap : anndata.AnnData
+            The transport map.
+        output_file : str
+            Path to write the transport map to.
+        entry : dict
+            The manifest entry of the transport map.
+        checkpoint : wot.ot.SolverCheckpoint, optional
+            The checkpoint of the solver, removed once the transport map is on disk.
+        """
+        # written under a hidden name first, so that an interrupted write never leaves a truncated transport map,
+        # unique so that hosts computing the same transport map (see run_worker) do not mix their writes
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(output_file) or '.',
+                                        prefix='.' + os.path.basename(output_file) + '.',
+                                        suffix='.' + self.output_file_format)
+        os.close(fd)
+        if self.factored:
+            tmap = wot.tmap.FactoredTransportMap.factor(tmap)
+        try:
+            wot.io.write_dataset(tmap, tmp_file, output_format=self.output_file_format, chunks=OTModel.TMAP_CHUNKS)
+            # the manifest must only reference transport maps that are on disk
+            with open(tmp_file, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_file, output_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        if checkpoint is not None:
+            checkpoint.remove()
+        self.manifest.update(os.path.basename(output_file), entry)
+        for with_covariates in (False, True):
+            # only the catalog matching the name of the transport map records it
+            wot.tmap.TransportMapCatalog(os.path.join(self.tmap_dir, self.tmap_prefix),
+                                         with_covariates=with_covariates).add(output_file, tmap)
+        wot.io.verbose("Created tmap", output_file)
+
+    # Transport maps are written by square tiles, so that the rows or columns of a few cells are read cheaply
+    TMAP_CHUNKS = (64, 64)
+
+    # Settings used by compute_default_cost_matrix, part of the cache keys
+    COST_SETTINGS = {'metric': 'sqeuclidean', 'scaling': 'eigenvals', 'normalization': 'median'}
 
+    @staticmethod
+    def compute_default_cost_matrix(a, b, eigenvals=None, return_scale=False):
+        """
+        Computes the squared euclidean distances between a and b, divided by their median (the cost scale).
+        Returns the cost scale as well if return_scale.
+        """
         if eigenvals is not None:
             a = a.dot(eigenvals)
             b = b.dot(eigenvals)
@@ -266,11 +851,12 @@ class OTModel:
         cost_matrix = sklearn.metrics.pairwise.pairwise_distances(a.toarray() if scipy.sparse.isspmatrix(a) else a,
                                                                   b.toarray() if scipy.sparse.isspmatrix(b) else b,
                                                                   metric='sqeuclidean')
-        cost_matrix = cost_matrix / np.median(cost_matrix)
-        return cost_matrix
+        cost_scale = np.median(cost_matrix)
+        cost_matrix = cost_matrix / cost_scale
+        return (cost_matrix, cost_scale) if return_scale else cost_matrix
 
     @staticmethod
-    def compute_single_transport_map(ds, config):
+    def compute_single_transport_map(ds, config, cache=None):
         """
         Computes a single transport map
 
@@ -283,13 +869,16 @@ class OTModel:
             Configuration to use for all parameters for the couplings :
             - t0, t1
             - lambda1, lambda2, epsilon, g
+        cache : wot.ot.ComputationCache, optional
+            Cache for the PCA coordinates and cost matrix. Entries are keyed by the cell ids,
+            the genes and the PCA and cost settings, and memory-mapped when found.
         """
-        t0 = config.pop('t0', None)
-        t1 = config.pop('t1', None)
+        t0 = config.get('t0')
+        t1 = config.get('t1')
         if t0 is None or t1 is None:
             raise ValueError("config must have both t0 and t1, indicating target timepoints")
 
-        covariate = config.pop('covariate', None)
+        covariate = config.get('covariate')
         if covariate is None:
             p0_indices = ds.obs['day'] == float(t0)
             p1_indices = ds.obs['day'] == float(t1)
@@ -297,8 +886,35 @@ class OTModel:
             p0_indices = (ds.obs['day'] == float(t0)) & (ds.obs['covariate'] == covariate[0])
             p1_indices = (ds.obs['day'] == float(t1)) & (ds.obs['covariate'] == covariate[1])
 
-        p0 = ds[p0_indices, :]
-        p1 = ds[p1_indices, :]
+        return OTModel.compute_pair_transport_map(ds[p0_indices, :], ds[p1_indices, :], config, cache=cache)
+
+    @staticmethod
+    def compute_pair_transport_map(p0, p1, config, cache=None, extensible=False):
+        """
+        Computes the transport map between two sets of cells
+
+        Parameters
+        ----------
+        p0 : anndata.AnnData
+            The cells at the source timepoint.
+        p1 : anndata.AnnData
+            The cells at the destination timepoint. Must have the same genes as p0.
+        config : dict
+            Configuration to use for all parameters for the couplings :
+            - t0, t1
+            - lambda1, lambda2, epsilon, g
+        cache : wot.ot.ComputationCache, optional
+            Cache for the PCA coordinates and cost matrix. See compute_single_transport_map
+        extensible : bool, optional, default : False
+            Whether to store the dual potentials, the coordinates of the cells and the cost parameters
+            with the transport map, see wot.tmap.FactoredTransportMap.
+        """
+        config = dict(config)
+        t0 = config.pop('t0', None)
+        t1 = config.pop('t1', None)
+        if t0 is None or t1 is None:
+            raise ValueError("config must have both t0 and t1, indicating target timepoints")
+        config.pop('covariate', None)
 
         if 'cell_growth_rate' in p0.obs.columns:
             config['g'] = np.asarray(p0.obs['cell_growth_rate'].values)
@@ -308,21 +924,61 @@ class OTModel:
             config['qq'] = np.asarray(p1.obs['pp'].values)
 
         local_pca = config.pop('local_pca', None)
+        cache_key = None
+        cached = None
+        if cache is not None:
+            # entries hold the cost scale and PCA loadings since they are stored with the transport maps,
+            # the expression values are hashed so that changed matrices with the same ids are not mistaken
+            cache_key = cache.key(p0.obs.index.values, p1.obs.index.values, p0.var.index.values, p0.X, p1.X,
+                                  local_pca, OTModel.COST_SETTINGS, 'cost_scale', 'pca_loadings')
+            cached = cache.get(cache_key)
         eigenvals = None
-        if local_pca is not None and local_pca > 0:
-            # pca, mean = wot.ot.get_pca(local_pca, p0.X, p1.X)
-            # p0_x = wot.ot.pca_transform(pca, mean, p0.X)
-            # p1_x = wot.ot.pca_transform(pca, mean, p1.X)
-            p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0.X, p1.X, local_pca)
-            eigenvals = np.diag(pca.singular_values_)
+        if cached is not None:
+            C = cached['cost']
+            cost_scale = float(cached['cost_scale'])
+            if 'eigenvals' in cached:
+                p0_x, p1_x, eigenvals = cached['p0_x'], cached['p1_x'], cached['eigenvals']
+                mean, loadings = cached['pca_mean'], cached['pca_loadings']
+            else:
+                p0_x, p1_x = p0.X, p1.X
         else:
-            p0_x = p0.X
-            p1_x = p1.X
-
-        C = OTModel.compute_default_cost_matrix(p0_x, p1_x, eigenvals)
+            if local_pca is not None and local_pca > 0:
+                # pca, mean = wot.ot.get_pca(local_pca, p0.X, p1.X)
+                # p0_x = wot.ot.pca_transform(pca, mean, p0.X)
+                # p1_x = wot.ot.pca_transform(pca, mean, p1.X)
+                p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0.X, p1.X, local_pca)
+                eigenvals = pca.singular_values_
+                loadings = wot.ot.compute_pca_loadings(p0.X, p1.X, p0_x, p1_x, mean, eigenvals)
+            else:
+                p0_x = p0.X
+                p1_x = p1.X
+
+            C, cost_scale = OTModel.compute_default_cost_matrix(
+                p0_x, p1_x, np.diag(eigenvals) if eigenvals is not None else None, return_scale=True)
+            if cache is not None:
+                arrays = {'cost': C, 'cost_scale': cost_scale}
+                if eigenvals is not None:
+                    arrays.update(p0_x=p0_x, p1_x=p1_x, eigenvals=eigenvals, pca_mean=mean, pca_loadings=loadings)
+                cache.put(cache_key, **arrays)
         if config.get('g') is None:
             config['g'] = np.ones(C.shape[0])
         delta_days = t1 - t0
         config['g'] = config['g'] ** delta_days
-        tmap = wot.ot.transport_stable_learn_growth(C, **config)
-        return anndata.AnnData(tmap, p0.obs.copy(), p1.obs.copy())
+        tmap, f, g, epsilon = wot.ot.transport_stable_learn_growth(C, return_potentials=True, **config)
+        # tmap = exp((f_i + g_j - C_ij) / epsilon), with C computed from the coordinates, see wot.tmap.FactoredTransportMap
+        ds = anndata.AnnData(tmap, p0.obs.copy(), p1.obs.copy())
+        if not extensible:
+            return ds
+        ds.obs['potential'] = f
+        ds.var['potential'] = g
+        ds.obsm['X_ot'] = p0_x
+        ds.varm['X_ot'] = p1_x
+        # the parameters needed to place new cells in the transport map, see wot.tmap.FactoredTransportMap.extend
+        ds.uns['ot'] = {'epsilon': float(epsilon), 'cost_scale': float(cost_scale),
+                        'lambda1': float(config['lambda1']), 'lambda2': float(config['lambda2']),
+                        'mean_growth': float(tmap.sum() / (tmap.shape[0] * tmap.shape[1])),
+                        'features': np.asarray(p0.var.index.values, dtype=str)}
+        if eigenvals is not None:
+            ds.uns['ot'].update(eigenvals=np.asarray(eigenvals), pca_mean=np.asarray(mean),
+                                pca_loadings=np.asarray(loadings))
+        return ds
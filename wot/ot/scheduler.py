@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+import wot.io
+
+# Number of n x m float64 matrices alive at the peak of each solver:
+# cost matrix, kernel, previous growth iteration and stabilization temporaries
+SOLVER_MATRIX_COPIES = {'unbalanced': 5, 'duality_gap': 7}
+
+
+def estimate_transport_map_bytes(n0, n1, n_features, solver='unbalanced'):
+    """
+    Estimates the peak memory needed to compute a transport map.
+
+    Parameters
+    ----------
+    n0 : int
+        Number of cells at the source time point.
+    n1 : int
+        Number of cells at the destination time point.
+    n_features : int
+        Number of features (genes) of the expression matrix.
+    solver : str, optional, default : 'unbalanced'
+        The solver used, one of 'unbalanced' (transport_stable_learn_growth) or
+        'duality_gap' (transport_stablev_learn_growth_duality_gap).
+
+    Returns
+    -------
+    nbytes : int
+        The estimated peak number of bytes.
+    """
+    if solver not in SOLVER_MATRIX_COPIES:
+        raise ValueError("Unknown solver: {}".format(solver))
+    nbytes = SOLVER_MATRIX_COPIES[solver] * n0 * n1 * 8
+    # densified expression matrix of the pair, its centered copy and the PCA input
+    nbytes += 3 * (n0 + n1) * n_features * 8
+    return int(nbytes)
+
+
+def calibrate_solver(size=1000, iterations=100):
+    """
+    Measures the speed of the OT solver on this machine.
+
+    Returns
+    -------
+    seconds : float
+        The time taken per cost matrix element and scaling iteration.
+    """
+    rng = np.random.RandomState(0)
+    x = rng.rand(size, 10)
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, x)
+    start = time.time()
+    wot.ot.transport_stablev2(C, lambda1=1, lambda2=50, epsilon=0.05, scaling_iter=iterations // 2, g=np.ones(size),
+                              pp=None, qq=None, numInnerItermax=10, tau=10000, epsilon0=1,
+                              extra_iter=iterations - iterations // 2)
+    return (time.time() - start) / (size * size * iterations)
+
+
+def calibrate_pca(n_features, n_components, size=400):
+    """
+    Measures the speed of the local PCA on this machine.
+
+    Returns
+    -------
+    seconds : float
+        The time taken per cell, for the given number of features and components.
+    """
+    rng = np.random.RandomState(0)
+    n_features_calibration = min(n_features, 2000)
+    x = rng.rand(size, n_features_calibration)
+    start = time.time()
+    wot.ot.compute_pca(x[:size // 2], x[size // 2:], min(n_components, size // 2))
+    return (time.time() - start) / size * n_features / n_features_calibration
+
+
+def get_usable_cores():
+    """Returns the number of cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except Exception:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def run_with_blas_threads(blas_threads, fn, args):
+    """Calls fn(*args) with BLAS thread pools limited to blas_threads, if threadpoolctl is available"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return fn(*args)
+    with threadpool_limits(limits=blas_threads, user_api='blas'):
+        return fn(*args)
+
+
+class TransportMapScheduler:
+    """
+    Runs transport map computations in worker processes within core and memory budgets.
+
+    Tasks are started largest first. A task is only started while the estimated memory of all
+    running tasks stays within max_memory, and each worker gets an equal share of the cores
+    for its BLAS thread pool, so that workers do not oversubscribe the machine.
+
+    Parameters
+    ----------
+    max_workers : int
+        Maximum number of worker processes.
+    max_memory : int, optional
+        Memory budget in bytes for all running tasks. Unbounded if None.
+    blas_threads : int, optional
+        Number of BLAS threads per worker. Defaults to the usable cores divided by max_workers.
+    """
+
+    def __init__(self, max_workers, max_memory=None, blas_threads=None):
+        self.max_workers = max_workers
+        self.max_memory = max_memory
+        if blas_threads is None:
+            blas_threads = max(1, get_usable_cores() // max_workers)
+        self.blas_threads = blas_threads
+
+    def run(self, tasks):
+        """
+        Runs tasks, yielding their results as they complete.
+
+        Parameters
+        ----------
+        tasks : list of (key, int, callable, tuple)
+            The key identifying each task, its estimated peak memory, the function to run and its arguments.
+            The function and arguments must be picklable.
+
+        Yields
+        ------
+        key, result
+            The key and return value of each task, in completion order.
+
+        Raises
+        ------
+        Exception
+            Any exception raised by a task, once the tasks already running have completed.
+        """
+        pending = sorted(tasks, key=lambda task: task[1], reverse=True)
+        running = {}
+        memory_in_use = 0
+        error = None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(running) > 0 or (len(pending) > 0 and error is None):
+                while error is None and len(pending) > 0 and len(running) < self.max_workers:
+                    task = self.next_task(pending, memory_in_use, len(running) == 0)
+                    if task is None:
+                        break
+                    key, nbytes, fn, args = task
+                    wot.io.verbose("Scheduling {} ({:.1f} MB, {:.1f} MB in use)".format(
+                        key, nbytes / 2 ** 20, memory_in_use / 2 ** 20))
+                    future = executor.submit(run_with_blas_threads, self.blas_threads, fn, args)
+                    running[future] = (key, nbytes)
+                    memory_in_use += nbytes
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key, nbytes = running.pop(future)
+                    memory_in_use -= nbytes
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    elif error is None:
+                        yield key, future.result()
+        if error is not None:
+            raise error
+
+    def next_task(self, pending, memory_in_use, idle):
+        """Pops the largest pending task that fits in the memory budget, or any task if idle"""
+        for i in range(len(pending)):
+            nbytes = pending[i][1]
+            if self.max_memory is None or memory_in_use + nbytes <= self.max_memory:
+                return pending.pop(i)
+        if idle:
+            print("Warning : {} needs more than the memory budget. Running it alone".format(pending[0][0]))
+            return pending.pop(0)
+        return None
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+# datasets already attached in this process, by directory
+_attached = {}
+
+
+def _save_frame(df, directory, name):
+    """
+    Saves the index and columns of a DataFrame as .npy files. Returns the list of column names.
+
+    Categorical columns are saved as their codes and categories. Other non-numeric columns are converted to str.
+    """
+    np.save(os.path.join(directory, name + '_index.npy'), np.asarray(df.index.values, dtype=str))
+    columns = []
+    for i, column in enumerate(df.columns):
+        values = df[column].values
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            np.save(os.path.join(directory, '{}_{}_categories.npy'.format(name, i)),
+                    np.asarray(values.categories.values, dtype=str))
+            values = values.codes
+        elif values.dtype.kind not in 'biufc':
+            values = np.asarray(values, dtype=str)
+        np.save(os.path.join(directory, '{}_{}.npy'.format(name, i)), values)
+        columns.append(column)
+    return columns
+
+
+def _load_frame(directory, name, columns):
+    index = np.load(os.path.join(directory, name + '_index.npy'))
+    data = {}
+    for i, column in enumerate(columns):
+        values = np.load(os.path.join(directory, '{}_{}.npy'.format(name, i)), mmap_mode='r')
+        categories_path = os.path.join(directory, '{}_{}_categories.npy'.format(name, i))
+        if os.path.exists(categories_path):
+            values = pd.Categorical.from_codes(values, categories=np.load(categories_path))
+        data[column] = values
+    return pd.DataFrame(index=index, data=data, columns=columns)
+
+
+class SharedDataset:
+    """
+    A picklable handle to a dataset whose arrays are written once to memory-mapped files.
+
+    Worker processes attach to the files instead of receiving a pickled copy of the matrix,
+    so that all of them share the same pages.
+
+    Parameters
+    ----------
+    ds : anndata.AnnData
+        The dataset to share. Sparse matrices are shared in CSR format.
+    directory : str, optional
+        Where to create the memory-mapped files, in a new hidden directory. Defaults to the temporary directory,
+        which may be held in memory (tmpfs): prefer a directory on disk, such as the transport map directory.
+    """
+
+    def __init__(self, ds, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='.wot_shared_', dir=directory)
+        x = ds.X
+        self.shape = x.shape
+        self.sparse = scipy.sparse.isspmatrix(x)
+        if self.sparse:
+            x = x.tocsr()
+            for name in ['data', 'indices', 'indptr']:
+                np.save(os.path.join(self.directory, 'X_' + name + '.npy'), getattr(x, name))
+        else:
+            np.save(os.path.join(self.directory, 'X.npy'), np.ascontiguousarray(x))
+        self.obs_columns = _save_frame(ds.obs, self.directory, 'obs')
+        self.var_columns = _save_frame(ds.var, self.directory, 'var')
+
+    def attach(self):
+        """
+        Opens the shared dataset without copying the expression matrix.
+
+        Returns
+        -------
+        ds : anndata.AnnData
+            The dataset, backed by read-only memory-mapped arrays.
+        """
+        ds = _attached.get(self.directory)
+        if ds is not None:
+            return ds
+
+        def load(name):
+            return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+        if self.sparse:
+            x = scipy.sparse.csr_matrix((load('X_data'), load('X_indices'), load('X_indptr')), shape=self.shape,
+                                        copy=False)
+        else:
+            x = load('X')
+        ds = anndata.AnnData(x, _load_frame(self.directory, 'obs', self.obs_columns),
+                             _load_frame(self.directory, 'var', self.var_columns))
+        _attached[self.directory] = ds
+        return ds
+
+    def close(self):
+        """Removes the memory-mapped files. Processes that attached them keep their mapping."""
+        _attached.pop(self.directory, None)
+        shutil.rmtree(self.directory, ignore_errors=True)
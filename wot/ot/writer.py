@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import queue
+import threading
+import weakref
+
+# writers still open when the interpreter exits, e.g. after an iteration over transport maps was abandoned
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    # the transport maps already computed are written while the writer threads can still run
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+class TransportMapWriter:
+    """
+    Runs write jobs in a background thread, so that the next transport map is computed
+    while the previous one is written.
+
+    Jobs run in submission order. After a job fails, the remaining jobs are skipped and
+    the error is raised by the next call to submit or close.
+
+    Parameters
+    ----------
+    max_pending : int, optional, default : 1
+        Maximum number of jobs waiting to run. submit blocks beyond that,
+        which bounds the memory held by transport maps waiting to be written.
+    """
+
+    def __init__(self, max_pending=1):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='wot-tmap-writer', daemon=True)
+        self.thread.start()
+        _open_writers.add(self)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            fn, args = job
+            if self.error is None:
+                try:
+                    fn(*args)
+                except BaseException as e:
+                    self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def submit(self, fn, *args):
+        """
+        Queues fn(*args), waiting while max_pending jobs are already queued.
+
+        Raises
+        ------
+        Exception
+            The error of a previous job, if any failed.
+        """
+        self._raise_error()
+        self.queue.put((fn, args))
+
+    def close(self):
+        """
+        Waits for all queued jobs to complete.
+
+        Raises
+        ------
+        Exception
+            The error of a job, if any failed.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        _open_writers.discard(self)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # wait for the maps already computed, without masking the original error
+            try:
+                self.close()
+            except Exception:
+                pass
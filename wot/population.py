@@ -1,26 +1,127 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import scipy.sparse
 
 
 class Population:
     """
     A Population is a measure over the the cells at given timepoint.
 
+    The measure is stored either densely, or sparsely as the indices of the cells it is supported on
+    and their weights. Sparse populations (e.g. small cell sets) are stacked as a CSR matrix
+    when pushed forward or pulled back.
+
     Parameters
     ----------
     time : int or float
         The time at which the cells where measured.
-    p : 1-D array-like
+    p : 1-D array-like, optional
         Measure over the cells at the given timepoint.
+    indices : 1-D array-like, optional
+        Indices of the cells the measure is supported on, instead of p.
+    weights : 1-D array-like, optional
+        Measure of the cells at indices. Uniform if None.
+    size : int, optional
+        Number of cells at the given timepoint, required with indices.
     """
 
-    def __init__(self, time, p):
+    # populations supported on at most this fraction of their cells are stored sparsely
+    SPARSE_DENSITY = 0.1
+
+    def __init__(self, time, p=None, indices=None, weights=None, size=None):
         self.time = time
-        self.p = np.asarray(p, dtype=np.float64)
+        self._p = None
+        self.indices = None
+        self.weights = None
+        self.size = None
+        if indices is not None:
+            if size is None:
+                raise ValueError("size is required for sparse populations")
+            indices = np.asarray(indices, dtype=np.int64)
+            weights = np.ones(len(indices)) if weights is None else np.asarray(weights, dtype=np.float64)
+            order = np.argsort(indices)
+            self.indices, self.weights, self.size = indices[order], weights[order], int(size)
+        elif p is not None:
+            self.p = p
+        else:
+            raise ValueError("Either p or indices is required")
+
+    @property
+    def is_sparse(self):
+        return self.indices is not None
+
+    @property
+    def p(self):
+        """The measure as a dense array"""
+        if self.is_sparse:
+            p = np.zeros(self.size, dtype=np.float64)
+            p[self.indices] = self.weights
+            return p
+        return self._p
+
+    @p.setter
+    def p(self, p):
+        self._p = np.asarray(p, dtype=np.float64)
+        self.indices, self.weights, self.size = None, None, None
+
+    def __len__(self):
+        return self.size if self.is_sparse else len(self._p)
 
     def normalize(self):
         """
         Make the measure sum to 1, i.e. be a probability distribution over cells.
         """
-        self.p = self.p / np.sum(self.p)
+        if self.is_sparse:
+            self.weights = self.weights / np.sum(self.weights)
+        else:
+            self.p = self.p / np.sum(self.p)
+
+    @staticmethod
+    def stack(populations):
+        """
+        Stacks the measures of populations over the same cells.
+
+        Returns
+        -------
+        p : scipy.sparse.csr_matrix or ndarray
+            The measures on rows, as a CSR matrix if all populations are sparse.
+        """
+        if all(pop.is_sparse for pop in populations):
+            indptr = np.concatenate(([0], np.cumsum([len(pop.indices) for pop in populations])))
+            return scipy.sparse.csr_matrix((np.concatenate([pop.weights for pop in populations]),
+                                            np.concatenate([pop.indices for pop in populations]), indptr),
+                                           shape=(len(populations), populations[0].size))
+        return np.vstack([pop.p for pop in populations])
+
+    @staticmethod
+    def from_matrix(time, p):
+        """
+        Creates populations from measures on rows, stored sparsely if their support is small enough.
+
+        Parameters
+        ----------
+        time : int or float
+            The time of the populations.
+        p : ndarray or scipy.sparse.spmatrix
+            The measures on rows.
+
+        Returns
+        -------
+        populations : list of wot.Population
+            One population per row.
+        """
+        p = scipy.sparse.csr_matrix(p) if scipy.sparse.issparse(p) else np.asarray(p)
+        populations = []
+        for k in range(p.shape[0]):
+            if scipy.sparse.issparse(p):
+                row = p[k]
+                indices, weights = row.indices, row.data
+            else:
+                indices = np.flatnonzero(p[k])
+                weights = p[k, indices]
+            if len(indices) <= Population.SPARSE_DENSITY * p.shape[1]:
+                populations.append(Population(time, indices=indices, weights=weights, size=p.shape[1]))
+            else:
+                populations.append(Population(time, p[k].toarray()[0] if scipy.sparse.issparse(p) else p[k]))
+        return populations
@@ -1,7 +1,11 @@
 from .chaining import *
+from .factored_transport_map import *
 from .full_trajectory import *
+from .propagation_engine import *
 from .trajectory import *
 from .trajectory_trends import *
+from .transport_map_cache import *
+from .transport_map_catalog import *
 from .transport_map_model import *
 from .transport_map_summary import *
 from .transport_map_util import *
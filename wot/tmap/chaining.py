@@ -1,14 +1,53 @@
+import numpy as np
+
+import wot.io
 import wot.tmap
 
 
-def chain_transport_maps(ot_model, pairs_list):
+def matrix_chain_order(sizes, known=()):
+    """
+    Finds the cheapest order to multiply a chain of matrices, by dynamic programming.
+
+    Parameters
+    ----------
+    sizes : list of int
+        The k + 1 dimensions of the k matrices: matrix i has shape (sizes[i], sizes[i + 1]).
+    known : collection of (int, int), optional
+        Products of matrices i to j - 1, as (i, j), that are already available and cost nothing.
+
+    Returns
+    -------
+    split : dict of (int, int): int
+        For each product (i, j) of at least two matrices, the index m such that it is best computed as
+        the product of (i, m) and (m, j).
+    cost : int
+        Number of scalar multiplications of the product of all matrices.
     """
-    Chains the transport maps corresponding to the list of pairs for the OTModel.
+    k = len(sizes) - 1
+    cost = {(i, i + 1): 0 for i in range(k)}
+    split = {}
+    for length in range(2, k + 1):
+        for i in range(k - length + 1):
+            j = i + length
+            split[(i, j)] = min(range(i + 1, j),
+                                key=lambda m: cost[(i, m)] + cost[(m, j)] + sizes[i] * sizes[m] * sizes[j])
+            m = split[(i, j)]
+            cost[(i, j)] = 0 if (i, j) in known else cost[(i, m)] + cost[(m, j)] + sizes[i] * sizes[m] * sizes[j]
+    return split, cost[(0, k)]
+
+
+def chain_transport_maps(tmap_model, pairs_list):
+    """
+    Chains the transport maps corresponding to the list of pairs for the TransportMapModel.
+
+    The transport maps are multiplied in the cheapest order given the number of cells at each timepoint.
+    Compositions are memoized in the cache of the model, keyed by their day pairs, and compositions
+    already memoized for a part of pairs_list (e.g. a shared prefix or suffix) are reused.
 
     Parameters
     ----------
-    ot_model : wot.OTModel
-        The OTModel whose transport maps are to be chained.
+    tmap_model : wot.tmap.TransportMapModel
+        The model whose transport maps are to be chained. Transport maps are loaded through its cache.
     pairs_list : list of (float, float)
         The list of day pairs correspondig to the transport maps to chain.
 
@@ -35,11 +74,25 @@ def chain_transport_maps(ot_model, pairs_list):
         if a >= b:
             raise ValueError("({}, {}) is not a valid transport map : it goes backwards in time".format(a, b))
 
-    tmap_0 = wot.tmap.load_transport_map(ot_model, *pairs_list.pop(0))
-    while len(pairs_list) > 0:
-        tmap_1 = wot.tmap.load_transport_map(ot_model, *pairs_list.pop(0))
-        tmap_0 = wot.tmap.glue_transport_maps(tmap_0, tmap_1)
-    return tmap_0
+    pairs_list = [tuple(pair) for pair in pairs_list]
+    days = tmap_model.meta['day'].values
+    sizes = [np.sum(days == t) for t in [pairs_list[0][0]] + [b for a, b in pairs_list]]
+    known = {(i, j) for i in range(len(pairs_list)) for j in range(i + 2, len(pairs_list) + 1)
+             if tuple(pairs_list[i:j]) in tmap_model.cache}
+    split, _ = matrix_chain_order(sizes, known)
+
+    def compose(i, j):
+        if j - i == 1:
+            return tmap_model.get_transport_map(*pairs_list[i])
+        key = tuple(pairs_list[i:j])
+        tmap = tmap_model.cache.get(key) if (i, j) in known else None
+        if tmap is None:
+            m = split[(i, j)]
+            tmap = wot.tmap.glue_transport_maps(compose(i, m), compose(m, j))
+            tmap_model.cache.put(key, tmap)
+        return tmap
+
+    return compose(0, len(pairs_list))
 
 
 def find_path(t0, t1, available_pairs, timepoints):
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.special
+import sklearn.metrics
+
+import wot.ot
+
+
+class FactoredTransportMap:
+    """
+    A transport map evaluated on the fly from its dual potentials and the coordinates of its cells.
+
+    The entries of the transport map are T_ij = exp((f_i + g_j - C_ij) / epsilon), where f and g are
+    the potentials of the source and destination cells, and C_ij = |(x_i - y_j) * eigenvals|^2 / cost_scale
+    is the cost computed from their local PCA coordinates x and y.
+    This takes O((n + m) d) storage instead of O(n m). Products with populations are evaluated
+    by tiles of rows, so that the dense transport map is never held in memory.
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        A transport map computed by wot.ot.OTModel, possibly written in the factored format:
+        with obs and var 'potential', obsm and varm 'X_ot', and uns 'ot'.
+    tile_size : int, optional, default : 2 ** 22
+        Number of entries of the transport map evaluated at once.
+    """
+
+    def __init__(self, tmap, tile_size=2 ** 22):
+        if not FactoredTransportMap.is_factorable(tmap):
+            raise ValueError("Transport map has no potentials and coordinates")
+        self.obs = tmap.obs
+        self.var = tmap.var
+        self.params = dict(tmap.uns['ot'])
+        self.params.pop('factored', None)
+        self.tile_size = tile_size
+        x, y = tmap.obsm['X_ot'], tmap.varm['X_ot']
+        self.x = x.toarray() if scipy.sparse.issparse(x) else np.asarray(x)
+        self.y = y.toarray() if scipy.sparse.issparse(y) else np.asarray(y)
+        eigenvals = np.asarray(self.params['eigenvals']) if 'eigenvals' in self.params else 1
+        # scales coordinates so that the cost is their squared euclidean distance
+        self.scale = eigenvals / np.sqrt(float(self.params['cost_scale']))
+        self.epsilon = float(self.params['epsilon'])
+
+    @staticmethod
+    def is_factorable(tmap):
+        """Whether the transport map has the potentials and coordinates to be evaluated on the fly"""
+        return 'ot' in tmap.uns and 'X_ot' in tmap.obsm and 'potential' in tmap.obs.columns
+
+    @staticmethod
+    def is_factored(tmap):
+        """Whether the transport map was written in the factored format, with no entries"""
+        return 'ot' in tmap.uns and bool(tmap.uns['ot'].get('factored', False))
+
+    @staticmethod
+    def factor(tmap):
+        """
+        Returns the transport map in the factored format, with an empty matrix.
+
+        Parameters
+        ----------
+        tmap : anndata.AnnData
+            A transport map computed by wot.ot.OTModel.
+
+        Returns
+        -------
+        factored : anndata.AnnData
+            The potentials and coordinates of the transport map, to be written.
+        """
+        if not FactoredTransportMap.is_factorable(tmap):
+            raise ValueError("Transport map has no potentials and coordinates")
+        factored = anndata.AnnData(scipy.sparse.csr_matrix(tmap.shape), tmap.obs.copy(), tmap.var.copy())
+        factored.obsm['X_ot'] = tmap.obsm['X_ot']
+        factored.varm['X_ot'] = tmap.varm['X_ot']
+        factored.uns['ot'] = {**tmap.uns['ot'], 'factored': True}
+        return factored
+
+    @property
+    def shape(self):
+        return self.x.shape[0], self.y.shape[0]
+
+    @property
+    def f(self):
+        return np.asarray(self.obs['potential'].values, dtype=np.float64)
+
+    @property
+    def g(self):
+        return np.asarray(self.var['potential'].values, dtype=np.float64)
+
+    def tiles(self):
+        """
+        Evaluates the transport map by tiles of rows.
+
+        Yields
+        ------
+        rows, tile : slice, ndarray
+            The rows of each tile and their entries.
+        """
+        f, g = self.f, self.g
+        y = self.y * self.scale
+        step = max(1, self.tile_size // max(1, self.shape[1]))
+        for start in range(0, self.shape[0], step):
+            rows = slice(start, min(start + step, self.shape[0]))
+            cost = sklearn.metrics.pairwise.pairwise_distances(self.x[rows] * self.scale, y, metric='sqeuclidean')
+            yield rows, np.exp((f[rows, np.newaxis] + g[np.newaxis, :] - cost) / self.epsilon)
+
+    def push_forward(self, p):
+        """
+        Computes p @ T.
+
+        Parameters
+        ----------
+        p : ndarray
+            Measures over the source cells, of shape (n,) or (k, n).
+
+        Returns
+        -------
+        result : ndarray
+            The measures pushed through the transport map, of shape (m,) or (k, m).
+        """
+        p = np.asarray(p)
+        result = np.zeros(p.shape[:-1] + (self.shape[1],))
+        for rows, tile in self.tiles():
+            result += p[..., rows] @ tile
+        return result
+
+    def pull_back(self, p):
+        """
+        Computes T @ p.T, transposed.
+
+        Parameters
+        ----------
+        p : ndarray
+            Measures over the destination cells, of shape (m,) or (k, m).
+
+        Returns
+        -------
+        result : ndarray
+            The measures pulled back through the transport map, of shape (n,) or (k, n).
+        """
+        p = np.asarray(p)
+        result = np.zeros(p.shape[:-1] + (self.shape[0],))
+        for rows, tile in self.tiles():
+            result[..., rows] = p @ tile.T
+        return result
+
+    @property
+    def X(self):
+        """The dense transport map"""
+        x = np.empty(self.shape)
+        for rows, tile in self.tiles():
+            x[rows] = tile
+        return x
+
+    def to_anndata(self, factored=False):
+        """
+        Returns the transport map as an anndata.AnnData.
+
+        Parameters
+        ----------
+        factored : bool, optional, default : False
+            Return the factored format, see factor, rather than the dense transport map.
+        """
+        ds = anndata.AnnData(scipy.sparse.csr_matrix(self.shape) if factored else self.X,
+                             self.obs.copy(), self.var.copy())
+        ds.obsm['X_ot'] = self.x
+        ds.varm['X_ot'] = self.y
+        ds.uns['ot'] = {**self.params, 'factored': factored}
+        return ds
+
+    def project(self, ds):
+        """
+        Computes the coordinates of cells in the space of the transport map, with its local PCA.
+
+        Parameters
+        ----------
+        ds : anndata.AnnData
+            The cells, with at least the genes used to compute the transport map.
+
+        Returns
+        -------
+        coordinates : ndarray
+            The coordinates of the cells, comparable to obsm and varm 'X_ot'.
+        """
+        if 'features' not in self.params:
+            raise ValueError("Transport map has no features to project cells with")
+        features = np.asarray(self.params['features']).astype(str)
+        indices = ds.var.index.get_indexer(features)
+        if (indices < 0).any():
+            raise ValueError("Genes missing from cells : {}".format(list(features[indices < 0][:10])))
+        x = ds.X[:, indices]
+        if 'pca_loadings' in self.params:
+            return wot.ot.pca_project(x, np.asarray(self.params['pca_mean']), np.asarray(self.params['pca_loadings']),
+                                      np.asarray(self.params['eigenvals']))
+        return x.toarray() if scipy.sparse.issparse(x) else np.asarray(x)
+
+    def compute_potentials(self, coordinates, destination=False, growth=None):
+        """
+        Computes the potentials that new cells would have had in the solution, from the potentials of the other side.
+
+        For a new source cell i with growth p_i, this is the fixed point of the scaling iteration
+        f_i = -(lambda1 epsilon / (lambda1 + epsilon)) (log(sum_j exp((g_j - C_ij) / epsilon) / m) - log(p_i)),
+        a softmin over the destination cells in O(m d). New destination cells are symmetric, with lambda2.
+
+        Parameters
+        ----------
+        coordinates : ndarray
+            Coordinates of the new cells, see project.
+        destination : bool, optional, default : False
+            Whether the cells are destination (t1) cells rather than source (t0) cells.
+        growth : ndarray, optional
+            Growth of the new cells over the day pair, i.e. their marginal.
+            Defaults to the average growth of the cells of the transport map.
+
+        Returns
+        -------
+        potentials : ndarray
+            The potentials of the new cells.
+        """
+        other, other_potentials = (self.x, self.f) if destination else (self.y, self.g)
+        reg = float(self.params['lambda2' if destination else 'lambda1'])
+        if growth is None:
+            growth = float(self.params['mean_growth'])
+        potentials = np.empty(coordinates.shape[0])
+        step = max(1, self.tile_size // max(1, other.shape[0]))
+        other = other * self.scale
+        for start in range(0, coordinates.shape[0], step):
+            rows = slice(start, min(start + step, coordinates.shape[0]))
+            cost = sklearn.metrics.pairwise.pairwise_distances(coordinates[rows] * self.scale, other,
+                                                               metric='sqeuclidean')
+            potentials[rows] = scipy.special.logsumexp((other_potentials[np.newaxis, :] - cost) / self.epsilon,
+                                                       axis=1) - np.log(other.shape[0])
+        return -(reg * self.epsilon / (reg + self.epsilon)) * (potentials - np.log(growth))
+
+    def extend(self, source=None, destination=None, source_growth=None, destination_growth=None):
+        """
+        Places new cells in the transport map without solving it again.
+
+        The potentials of the existing cells are kept, and those of the new cells are computed from them,
+        see compute_potentials. The rows of new source cells and the columns of new destination cells
+        are then given by the usual formula.
+
+        Parameters
+        ----------
+        source : anndata.AnnData, optional
+            New cells at the source day, with at least the genes used to compute the transport map.
+        destination : anndata.AnnData, optional
+            New cells at the destination day.
+        source_growth : ndarray, optional
+            Growth of the new source cells over the day pair. See compute_potentials
+        destination_growth : ndarray, optional
+            Marginal of the new destination cells. See compute_potentials
+
+        Returns
+        -------
+        tmap : wot.tmap.FactoredTransportMap
+            The transport map, with the new source cells as last rows and the new destination cells as last columns.
+        """
+        extended = FactoredTransportMap.__new__(FactoredTransportMap)
+        extended.__dict__.update(self.__dict__)
+        for cells, growth, is_destination in ((source, source_growth, False),
+                                              (destination, destination_growth, True)):
+            if cells is None:
+                continue
+            coordinates = self.project(cells)
+            meta = pd.DataFrame(index=cells.obs.index,
+                                data={'potential': self.compute_potentials(coordinates, is_destination, growth)})
+            existing = self.var if is_destination else self.obs
+            if 'day' in existing.columns and len(existing) > 0:
+                meta['day'] = existing['day'].values[0]
+            if is_destination:
+                extended.var = pd.concat((self.var, meta), sort=False)
+                extended.y = np.vstack((self.y, coordinates))
+            else:
+                extended.obs = pd.concat((self.obs, meta), sort=False)
+                extended.x = np.vstack((self.x, coordinates))
+        return extended
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+
+import numpy as np
+import scipy.sparse
+
+import wot.tmap
+from wot.population import Population
+
+
+class PropagationEngine:
+    """
+    Computes the ancestors and descendants of populations at every timepoint, in a single backward sweep
+    and a single forward sweep through the transport maps, and feeds them to reducers.
+
+    Reducers are functions reducer(t, p) called with each timepoint t and the measures p of all populations
+    over the cells at t, as an array of shape (number of populations, number of cells at t). Registering
+    several reducers (e.g. trajectories, census and trends) costs a single pass over the transport maps.
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The model whose transport maps are swept.
+    concurrent : bool, optional, default : True
+        Whether the backward and forward sweeps run at the same time, in two threads.
+        Reducers must then be safe to call from several threads.
+    """
+
+    def __init__(self, tmap_model, concurrent=True):
+        self.tmap_model = tmap_model
+        self.concurrent = concurrent
+        self.reducers = {}
+
+    def add_reducer(self, name, reducer):
+        """
+        Registers a reducer.
+
+        Parameters
+        ----------
+        name : str
+            Name of the reducer, indexing the results of run.
+        reducer : callable
+            Function of the timepoint and the measures of all populations at that timepoint.
+        """
+        self.reducers[name] = reducer
+        return self
+
+    def _sweep(self, populations, forward):
+        model = self.tmap_model
+        results = []
+        while model.can_push_forward(*populations) if forward else model.can_pull_back(*populations):
+            populations = model.push_forward(*populations, as_list=True) if forward \
+                else model.pull_back(*populations, as_list=True)
+            results.append(self._reduce(populations))
+        return results
+
+    def _reduce(self, populations):
+        t = wot.tmap.unique_timepoint(*populations)
+        p = Population.stack(populations)
+        # reducers are given dense measures
+        p = p.toarray() if scipy.sparse.issparse(p) else p
+        return t, {name: reducer(t, p) for name, reducer in self.reducers.items()}
+
+    def run(self, *populations):
+        """
+        Sweeps the transport maps from the populations to the first and to the last timepoint.
+
+        Parameters
+        ----------
+        *populations : wot.Population
+            The populations, all at the same timepoint.
+
+        Returns
+        -------
+        timepoints : list
+            The timepoints, in increasing order.
+        results : dict of str: list
+            For each reducer, its values at each timepoint.
+        """
+        start = self._reduce(populations)
+        if self.concurrent:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='wot-sweep') as executor:
+                backward = executor.submit(self._sweep, populations, False)
+                forward = executor.submit(self._sweep, populations, True)
+                backward, forward = backward.result(), forward.result()
+        else:
+            backward, forward = self._sweep(populations, False), self._sweep(populations, True)
+        steps = backward[::-1] + [start] + forward
+        return [t for t, _ in steps], {name: [values[name] for _, values in steps] for name in self.reducers}
+
+
+def _normalize_rows(p):
+    sums = p.sum(axis=1, keepdims=True)
+    return p / np.where(sums == 0, 1, sums)
+
+
+def trajectory_reducer():
+    """Returns a reducer keeping the measures of the populations, with cells on rows"""
+    return lambda t, p: p.T
+
+
+def census_reducer(tmap_model, cell_set_matrix):
+    """
+    Returns a reducer computing the census of the populations, see wot.tmap.TransportMapModel.population_census.
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The model the populations are computed with.
+    cell_set_matrix : anndata.AnnData
+        Dataset of 0s and 1s denoting membership in each cell set. Cells as rows, cell sets as columns.
+    """
+    indicators = cell_set_matrix.X
+
+    def reduce(t, p):
+        ids = tmap_model.meta.index[tmap_model.meta['day'].values == t]
+        indexer = cell_set_matrix.obs.index.get_indexer_for(ids)
+        present = indexer != -1
+        census = _normalize_rows(p)[:, present] @ indicators[indexer[present]]
+        return np.asarray(census, dtype=np.float64)
+
+    return reduce
+
+
+def trends_reducer(tmap_model, ds):
+    """
+    Returns a reducer computing the mean and variance of each feature over the populations.
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The model the populations are computed with.
+    ds : anndata.AnnData
+        Dataset of the values, such as gene expression. Cells missing from ds are left out.
+
+    Returns
+    -------
+    reducer : callable
+        The reducer, returning the means and variances as two arrays of shape (number of populations, features).
+    """
+
+    def reduce(t, p):
+        ids = tmap_model.meta.index[tmap_model.meta['day'].values == t]
+        indexer = ds.obs.index.get_indexer_for(ids)
+        present = indexer != -1
+        weights = _normalize_rows(p[:, present])
+        x = ds.X[indexer[present]]
+        x_squared = x.multiply(x) if scipy.sparse.issparse(x) else x ** 2
+        mean = np.asarray((x.T @ weights.T).T)
+        variance = np.asarray((x_squared.T @ weights.T).T) - mean ** 2
+        return mean, np.maximum(variance, 0)
+
+    return reduce
@@ -6,6 +6,7 @@ import pandas as pd
 import scipy.stats
 
 import wot.io
+import wot.tmap
 
 
 class Trajectory:
@@ -82,12 +83,16 @@ class Trajectory:
         Args:
             transport_maps (list) A list of transport maps
             time_to_cell_sets (dict): Maps time to cell sets. A cell set is a dict containing "name" and "set"
-            cache_transport_maps (bool): Whether to cache the transport maps in memory
+            cache_transport_maps (bool, int or wot.tmap.TransportMapCache): Whether to cache the transport maps in
+                memory, True to keep all of them, an int to keep the most recently used ones within that many bytes,
+                or a cache shared with other trajectories
 
         Returns:
             List of trajectories. A trajectory is a dict containing cell_set, p, entropy, normalized_entropy, and cell_ids
         """
 
+        if not isinstance(cache_transport_maps, bool):
+            cache_transport_maps = wot.tmap.TransportMapCache.create(cache_transport_maps)
         trajectory_results = []
         progress = 0
         progress_step = 1 / len(time_to_cell_sets)
@@ -104,6 +109,19 @@ class Trajectory:
 
         return trajectory_results
 
+    @staticmethod
+    def __load_transport_map(tmap_dict, cache_transport_maps):
+        tmap = tmap_dict.get('ds')
+        if tmap is not None:
+            return tmap
+        if cache_transport_maps is True:
+            tmap = wot.io.read_dataset(tmap_dict['path'])
+            tmap_dict['ds'] = tmap
+            return tmap
+        if cache_transport_maps is False:
+            return wot.io.read_dataset(tmap_dict['path'])
+        return cache_transport_maps.get_or_load(tmap_dict['path'], lambda: wot.io.read_dataset(tmap_dict['path']))
+
     @staticmethod
     def __trajectory_for_cell_sets_at_time_t(cell_sets, transport_maps, time, cache_transport_maps=True,
                                              print_progress=(False, 0, 0)):
@@ -113,7 +131,7 @@ class Trajectory:
             cell_sets (list): A list of dicts containing "name" and "set"
             transport_maps (llist) A list of transport maps
             time (float): The time at which the cell sets are defined
-            cache_transport_maps (bool): Whether to cache the transport maps in memory
+            cache_transport_maps (bool or wot.tmap.TransportMapCache): Whether to cache the transport maps in memory
         """
 
         transport_map_t1_index = -1
@@ -128,18 +146,14 @@ class Trajectory:
         use_t1 = transport_map_t1_index != -1
         tmap_index = transport_map_t1_index if use_t1 else transport_map_t2_index
         tmap_dict_at_t = transport_maps[tmap_index]
-        tmap_at_t = tmap_dict_at_t.get('ds')
-        if tmap_at_t is None:
-            tmap_at_t = wot.io.read_dataset(tmap_dict_at_t['path'])
-            if cache_transport_maps:
-                tmap_dict_at_t['ds'] = tmap_at_t
+        tmap_at_t = Trajectory.__load_transport_map(tmap_dict_at_t, cache_transport_maps)
         results = []
         pvec_array_at_t = []
         for cell_set_index in range(len(cell_sets)):
             cell_ids_in_set = cell_sets[cell_set_index]['set']
             membership = tmap_at_t.obs.index.isin(cell_ids_in_set) if use_t1 else tmap_at_t.var.index.isin(
                 cell_ids_in_set)
-            membership = membership.astype(np.float)
+            membership = membership.astype(float)
             membership /= membership.sum()
             pvec_array_at_t.append(membership)
             entropy = np.exp(scipy.stats.entropy(membership))
@@ -171,11 +185,7 @@ class Trajectory:
                     wot.io.output_progress(p)
                     progress_count += 1
                 tmap_dict = transport_maps[transport_index]
-                tmap_ds = tmap_dict.get('ds')
-                if tmap_ds is None:
-                    tmap_ds = wot.io.read_dataset(tmap_dict['path'])
-                    if cache_transport_maps:
-                        tmap_dict['ds'] = tmap_ds
+                tmap_ds = Trajectory.__load_transport_map(tmap_dict, cache_transport_maps)
 
                 new_pvec_array = []
                 for cell_set_index in range(len(cell_sets)):
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+import anndata
+import h5py
+import numpy as np
+import scipy.sparse
+
+import wot.tmap
+
+
+def get_transport_map_bytes(tmap):
+    """
+    Estimates the memory held by a transport map.
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData or wot.tmap.FactoredTransportMap
+        The transport map.
+
+    Returns
+    -------
+    nbytes : int
+        Bytes held by the entries, or by the potentials and coordinates of a factored transport map.
+    """
+
+    def array_bytes(x):
+        if scipy.sparse.issparse(x):
+            return sum(getattr(x, a).nbytes for a in ('data', 'indices', 'indptr', 'row', 'col') if hasattr(x, a))
+        return np.asarray(x).nbytes
+
+    if isinstance(tmap, anndata.AnnData):
+        nbytes = array_bytes(tmap.X)
+        for m in (tmap.obsm, tmap.varm):
+            for k in m.keys():
+                nbytes += array_bytes(m[k])
+    else:
+        nbytes = tmap.x.nbytes + tmap.y.nbytes
+    return int(nbytes + 8 * (tmap.shape[0] + tmap.shape[1]))
+
+
+def estimate_transport_map_file_bytes(path):
+    """
+    Estimates the memory held by a transport map once read, from the header of its file.
+
+    Parameters
+    ----------
+    path : str
+        Path to an h5ad or loom transport map.
+
+    Returns
+    -------
+    nbytes : int
+        Estimate of get_transport_map_bytes for the transport map read from path.
+    """
+
+    def array_bytes(x):
+        if isinstance(x, h5py.Group):
+            return sum(x[a].size * x[a].dtype.itemsize for a in ('data', 'indices', 'indptr') if a in x)
+        return x.size * x.dtype.itemsize
+
+    shape = wot.tmap.read_transport_map_header(path, obs_ids=False, var_ids=False)[0]
+    with h5py.File(path, 'r') as f:
+        if path.lower().endswith('.loom'):
+            nbytes = array_bytes(f['/matrix'])
+        else:
+            nbytes = array_bytes(f['/X'])
+            for m in ('/obsm', '/varm'):
+                if m in f:
+                    nbytes += sum(array_bytes(f[m][k]) for k in f[m].keys())
+    return int(nbytes + 8 * (shape[0] + shape[1]))
+
+
+class TransportMapCache:
+    """
+    In-memory least recently used cache of transport maps, bounded in bytes.
+    Transport maps can be added from several threads, e.g. while they are prefetched.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum memory held by cached transport maps. Least recently used transport maps are evicted beyond that,
+        and transport maps larger than max_bytes are not cached. If None, the cache is unbounded.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups that found their transport map.
+    misses : int
+        Number of lookups that did not.
+    nbytes : int
+        Memory held by the cached transport maps.
+    reserved : dict
+        Memory set aside for transport maps being read, by key, see reserve. Counted against max_bytes.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.nbytes = 0
+        self.reserved = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        """Whether the cache can hold transport maps"""
+        return self.max_bytes is None or self.max_bytes > 0
+
+    @staticmethod
+    def create(cache):
+        """
+        Creates a cache from the cache argument of wot.tmap.TransportMapModel.
+
+        Parameters
+        ----------
+        cache : bool, int or wot.tmap.TransportMapCache
+            True for an unbounded cache, False for none, an int for a budget in bytes, or an existing cache.
+
+        Returns
+        -------
+        cache : wot.tmap.TransportMapCache
+            The cache. Disabled caches still count misses.
+        """
+        if isinstance(cache, TransportMapCache):
+            return cache
+        if cache is None or cache is False:
+            return TransportMapCache(0)
+        if cache is True:
+            return TransportMapCache()
+        return TransportMapCache(int(cache))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        """Returns the keys of the cached transport maps, from least to most recently used"""
+        with self.lock:
+            return list(self.entries.keys())
+
+    def get(self, key):
+        """
+        Looks up a transport map, making it the most recently used.
+
+        Returns
+        -------
+        tmap : anndata.AnnData or wot.tmap.FactoredTransportMap
+            The cached transport map, or None if it is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, tmap):
+        """
+        Caches a transport map, evicting the least recently used ones to stay within max_bytes.
+
+        Returns
+        -------
+        cached : bool
+            Whether the transport map was cached, i.e. fits in max_bytes.
+        """
+        nbytes = get_transport_map_bytes(tmap)
+        with self.lock:
+            self.pop(key)
+            if not self.make_room(nbytes):
+                return False
+            self.entries[key] = (tmap, nbytes)
+            self.nbytes += nbytes
+            return True
+
+    def make_room(self, nbytes):
+        """Evicts the least recently used transport maps until nbytes more fit, if they can"""
+        with self.lock:
+            if self.max_bytes is None:
+                return True
+            if nbytes + sum(self.reserved.values()) > self.max_bytes:
+                return False
+            while self.nbytes + sum(self.reserved.values()) + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+            return True
+
+    def reserve(self, key, nbytes):
+        """
+        Sets memory aside for a transport map being read, e.g. prefetched, evicting the least recently used
+        transport maps to stay within max_bytes. Released by release, before the transport map is put.
+
+        Returns
+        -------
+        reserved : bool
+            Whether the memory was set aside, i.e. fits in max_bytes with the other reservations.
+        """
+        with self.lock:
+            self.release(key)
+            if not self.make_room(nbytes):
+                return False
+            self.reserved[key] = nbytes
+            return True
+
+    def release(self, key):
+        """Releases the memory reserved for a transport map, if any"""
+        with self.lock:
+            self.reserved.pop(key, None)
+
+    def get_or_load(self, key, load):
+        """
+        Looks up a transport map, calling load() and caching its result on a miss.
+
+        Returns
+        -------
+        tmap : anndata.AnnData or wot.tmap.FactoredTransportMap
+            The transport map.
+        """
+        tmap = self.get(key)
+        if tmap is None:
+            tmap = load()
+            self.put(key, tmap)
+        return tmap
+
+    def pop(self, key):
+        """Removes a transport map from the cache, if present"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def clear(self):
+        """Removes all transport maps. Counters are kept"""
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Returns the number of hits, misses, cached transport maps, cached and reserved bytes, as a dict"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'nbytes': self.nbytes,
+                    'reserved': sum(self.reserved.values()), 'max_bytes': self.max_bytes}
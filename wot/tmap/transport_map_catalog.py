@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import os
+import re
+import tempfile
+
+import h5py
+import numpy as np
+
+import wot.io
+import wot.ot
+
+
+class TransportMapCatalog:
+    """
+    Index of the transport maps of a directory, stored in a single HDF5 file next to them.
+
+    The catalog records the day pairs, file names, shapes, dtypes, sizes and modification times
+    of the transport maps, and the ids of the cells at each timepoint, so that a
+    wot.tmap.TransportMapModel is created in one read instead of opening every transport map.
+    It is updated as transport maps are computed, and rebuilt when transport map files
+    are added, removed or modified.
+
+    Parameters
+    ----------
+    tmap_out : str
+        Path and prefix of the transport maps, e.g. 'tmaps/serum'.
+    with_covariates : bool, optional, default : False
+        Whether the catalog indexes the covariate restricted transport maps, in their own catalog file.
+    max_threads : int, optional, default : 8
+        Number of transport map files whose headers are read at once when the catalog is rebuilt.
+
+    Attributes
+    ----------
+    entries : dict of str: dict
+        Maps transport map file names to their 'key', 'shape', 'dtype', 'size' and 'mtime'.
+    ids : dict of float: ndarray
+        Ids of the cells at each timepoint.
+    """
+
+    VERSION = 1
+
+    def __init__(self, tmap_out, with_covariates=False, max_threads=8):
+        tmap_dir, tmap_prefix = os.path.split(tmap_out)
+        self.tmap_dir = tmap_dir or '.'
+        self.tmap_prefix = tmap_prefix or 'tmaps'
+        self.with_covariates = with_covariates
+        self.max_threads = max_threads
+        self.path = os.path.join(self.tmap_dir,
+                                 self.tmap_prefix + ('_cv_catalog.h5' if with_covariates else '_catalog.h5'))
+        cv = '_cv([0-9]+)_cv([0-9]+)' if with_covariates else ''
+        self.pattern = re.compile(re.escape(self.tmap_prefix) + '_([0-9]+\\.[0-9]+)_([0-9]+\\.[0-9]+)' + cv
+                                  + '\\.(h5ad|loom)$')
+        self.entries = {}
+        self.ids = {}
+
+    def parse_name(self, name):
+        """
+        Returns the key of a transport map file name, (t0, t1) or (t0, t1, cv0, cv1) with covariates,
+        or None if it is not the name of a transport map of the catalog.
+        """
+        m = self.pattern.match(name)
+        if m is None:
+            return None
+        key = (float(m.group(1)), float(m.group(2)))
+        if self.with_covariates:
+            key += (int(m.group(3)), int(m.group(4)))
+        return key
+
+    def list_transport_maps(self):
+        """Returns the names of the transport map files of the directory, with their keys"""
+        names = {}
+        for name in os.listdir(self.tmap_dir):
+            key = self.parse_name(name)
+            if key is not None and os.path.isfile(os.path.join(self.tmap_dir, name)):
+                names[name] = key
+        return names
+
+    def get_file_stats(self, name):
+        stat = os.stat(os.path.join(self.tmap_dir, name))
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        """
+        Reads the catalog, rebuilding it first if it is missing or out of date.
+
+        Returns
+        -------
+        catalog : wot.tmap.TransportMapCatalog
+            self
+        """
+        if self.read() and self.is_current():
+            return self
+        wot.io.verbose("Indexing transport maps in", self.tmap_dir)
+        self.scan()
+        try:
+            self.write()
+        except OSError as e:
+            # e.g. read-only directories, the catalog is then rebuilt every time
+            print("Warning : unable to write transport map catalog {} : {}".format(self.path, e))
+        return self
+
+    def is_current(self):
+        """Whether the catalog lists exactly the transport map files of the directory, unmodified"""
+        names = self.list_transport_maps()
+        if set(names) != set(self.entries):
+            return False
+        try:
+            return all(self.get_file_stats(name) == (entry['size'], entry['mtime'])
+                       for name, entry in self.entries.items())
+        except OSError:
+            return False
+
+    def read(self):
+        """
+        Reads the catalog file.
+
+        Returns
+        -------
+        found : bool
+            Whether the catalog file exists and could be read.
+        """
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with h5py.File(self.path, 'r') as f:
+                if f.attrs.get('version') != TransportMapCatalog.VERSION:
+                    return False
+                names = f['names'].asstr()[()]
+                keys = f['keys'][()]
+                shapes = f['shapes'][()]
+                dtypes = f['dtypes'].asstr()[()]
+                sizes = f['sizes'][()]
+                mtimes = f['mtimes'][()]
+                timepoints = f['timepoints'][()]
+                counts = f['counts'][()]
+                ids = f['ids'].asstr()[()]
+        except (OSError, KeyError) as e:
+            print("Warning : unable to read transport map catalog {} : {}".format(self.path, e))
+            return False
+        self.entries = {}
+        for i in range(len(names)):
+            key = (float(keys[i, 0]), float(keys[i, 1]))
+            if self.with_covariates:
+                key += (int(keys[i, 2]), int(keys[i, 3]))
+            self.entries[names[i]] = {'key': key, 'shape': tuple(int(n) for n in shapes[i]), 'dtype': dtypes[i],
+                                      'size': int(sizes[i]), 'mtime': int(mtimes[i])}
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.ids = {float(t): ids[offsets[i]:offsets[i + 1]] for i, t in enumerate(timepoints)}
+        return True
+
+    def write(self):
+        """Writes the catalog file, replacing it atomically"""
+        names = sorted(self.entries)
+        timepoints = sorted(self.ids)
+        keys = np.full((len(names), 4), -1, dtype=np.float64)
+        for i, name in enumerate(names):
+            key = self.entries[name]['key']
+            keys[i, :len(key)] = key
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmap_dir, prefix='.catalog_')
+        os.close(fd)
+        try:
+            with h5py.File(tmp_path, 'w') as f:
+                f.attrs['version'] = TransportMapCatalog.VERSION
+                f['names'] = np.array(names, dtype=h5py.string_dtype())
+                f['keys'] = keys
+                f['shapes'] = np.array([self.entries[name]['shape'] for name in names], dtype=np.int64).reshape(-1, 2)
+                f['dtypes'] = np.array([self.entries[name]['dtype'] for name in names], dtype=h5py.string_dtype())
+                f['sizes'] = np.array([self.entries[name]['size'] for name in names], dtype=np.int64)
+                f['mtimes'] = np.array([self.entries[name]['mtime'] for name in names], dtype=np.int64)
+                f['timepoints'] = np.array(timepoints, dtype=np.float64)
+                f['counts'] = np.array([len(self.ids[t]) for t in timepoints], dtype=np.int64)
+                f['ids'] = np.array(np.concatenate([self.ids[t] for t in timepoints]) if timepoints else [],
+                                    dtype=h5py.string_dtype())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def scan(self):
+        """
+        Rebuilds the catalog from the headers of the transport map files, read in parallel threads.
+        """
+        names = self.list_transport_maps()
+        # the ids of each timepoint are read from the first transport map that has it
+        ids_from = {}
+        for name in sorted(names, key=lambda name: names[name]):
+            for side, t in enumerate(names[name][:2]):
+                ids_from.setdefault(t, (name, side))
+
+        def scan_file(name):
+            stats = self.get_file_stats(name)
+            header = read_transport_map_header(os.path.join(self.tmap_dir, name),
+                                               obs_ids=ids_from[names[name][0]] == (name, 0),
+                                               var_ids=ids_from[names[name][1]] == (name, 1))
+            return name, stats, header
+
+        self.entries = {}
+        self.ids = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_threads, len(names))),
+                                                   thread_name_prefix='wot-catalog') as executor:
+            for name, (size, mtime), (shape, dtype, obs_ids, var_ids) in executor.map(scan_file, names):
+                key = names[name]
+                self.entries[name] = {'key': key, 'shape': shape, 'dtype': dtype, 'size': size, 'mtime': mtime}
+                for t, ids in zip(key[:2], (obs_ids, var_ids)):
+                    if ids is not None:
+                        self.ids[t] = ids
+
+    def add(self, path, tmap):
+        """
+        Records a transport map that was just written. Safe to call from concurrent processes.
+
+        Parameters
+        ----------
+        path : str
+            Path of the transport map file.
+        tmap : anndata.AnnData
+            The transport map, as written.
+        """
+        name = os.path.basename(path)
+        key = self.parse_name(name)
+        if key is None:
+            return
+        with wot.ot.FileLock(self.path + '.lock'):
+            if not self.read():
+                self.entries, self.ids = {}, {}
+            size, mtime = self.get_file_stats(name)
+            self.entries[name] = {'key': key, 'shape': tuple(tmap.shape), 'dtype': str(tmap.X.dtype), 'size': size,
+                                  'mtime': mtime}
+            self.ids[key[0]] = np.asarray(tmap.obs.index.values, dtype=str)
+            self.ids[key[1]] = np.asarray(tmap.var.index.values, dtype=str)
+            self.write()
+
+
+def read_transport_map_header(path, obs_ids=True, var_ids=True):
+    """
+    Reads the shape, dtype and cell ids of a transport map file, without its entries.
+
+    Parameters
+    ----------
+    path : str
+        Path to an h5ad or loom transport map.
+    obs_ids : bool, optional, default : True
+        Whether to read the ids of the source cells.
+    var_ids : bool, optional, default : True
+        Whether to read the ids of the destination cells.
+
+    Returns
+    -------
+    shape : tuple
+        Shape of the transport map.
+    dtype : str
+        Type of its entries.
+    obs_ids, var_ids : ndarray or None
+        Ids of the source and destination cells, or None if they were not read.
+    """
+    with h5py.File(path, 'r') as f:
+        if path.endswith('.loom'):
+            x = f['/matrix']
+            shape, dtype = x.shape, x.dtype
+            obs = f['/row_attrs/id'][()].astype(str) if obs_ids else None
+            var = f['/col_attrs/id'][()].astype(str) if var_ids else None
+        else:
+            x = f['/X']
+            if isinstance(x, h5py.Group):
+                shape = x.attrs['shape'] if 'shape' in x.attrs else x.attrs['h5sparse_shape']
+                dtype = x['data'].dtype
+            else:
+                shape, dtype = x.shape, x.dtype
+            obs = wot.io.read_h5ad_index(f['/obs']) if obs_ids else None
+            var = wot.io.read_h5ad_index(f['/var']) if var_ids else None
+    return tuple(int(n) for n in shape), str(dtype), obs, var
@@ -1,15 +1,23 @@
+import concurrent.futures
 import os
+import threading
 
 import anndata
 import h5py
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 import wot.io
 import wot.tmap
 from wot.population import Population
 
 
+def _to_dense(p):
+    # products of sparse populations with sparse transport maps are sparse, their support has spread by then
+    return p.toarray() if scipy.sparse.issparse(p) else np.asarray(p)
+
+
 class TransportMapModel:
     """
        Creates a transport map model for operating on pre-computed transport maps
@@ -24,12 +32,28 @@ class TransportMapModel:
            Sorted list of cell timepoints
         day_pairs : list
             List of (t1,t2)
+        cache : bool, int or wot.tmap.TransportMapCache, optional, default : False
+            Keeps the transport maps read from files in memory: True to keep all of them, an int to keep the most
+            recently used ones within that many bytes, or a cache shared with other models.
+        prefetch : bool, optional
+            Whether push_forward and pull_back read the next transport map in the direction of travel
+            in a background thread, while the current one is applied. Defaults to whether cache keeps transport maps.
+        partial_read_fraction : float, optional, default : 0.1
+            Populations supported on at most this fraction of their cells are pushed forward (pulled back) through
+            the rows (columns) of those cells only, read from transport map files that are not in memory.
        """
 
-    def __init__(self, tmaps, meta, timepoints=None, day_pairs=None, cache=False):
+    def __init__(self, tmaps, meta, timepoints=None, day_pairs=None, cache=False, prefetch=None,
+                 partial_read_fraction=0.1):
         self.tmaps = tmaps
         self.meta = meta
-        self.cache = cache
+        self.cache = wot.tmap.TransportMapCache.create(cache)
+        self.prefetch = self.cache.enabled if prefetch is None else prefetch
+        self.partial_read_fraction = partial_read_fraction
+        self.prefetch_hits = 0
+        self._prefetcher = None
+        self._prefetching = {}
+        self._prefetch_lock = threading.Lock()
         if timepoints is None:
             timepoints = sorted(meta['day'].unique())
         self.timepoints = timepoints
@@ -55,44 +79,10 @@ class TransportMapModel:
             Rows : all cells, Columns : populations index. At point (i, j) : the probability that cell i is an
             ancestor/descendant of population j
         """
-        trajectories = []
-        populations = population_dict.values()
         population_names = list(population_dict.keys())
-        initial_populations = populations
-
-        # timepoints = []
-
-        def update(head, populations):
-            idx = 0 if head else len(trajectories)
-            # timepoints.insert(idx, wot.tmap.unique_timepoint(*populations))
-            trajectories.insert(idx, np.array([pop.p for pop in populations]).T)
-
-        update(True, populations)
-        while self.can_pull_back(*populations):
-            populations = self.pull_back(*populations, as_list=True)
-            update(True, populations)
-        populations = initial_populations
-        while self.can_push_forward(*populations):
-            populations = self.push_forward(*populations, as_list=True)
-            update(False, populations)
-
-        # # list of trajectories. Each trajectory is a list of wot.Datasets split by time
-        # name_to_list = {}
-        # start = 0
-        # for j in range(len(population_names)):
-        #     name_to_list[population_names[j]] = []
-        # for i in range(len(timepoints)):
-        #     t = timepoints[i]
-        #     probs = trajectories[i]
-        #     ncells = probs.shape[0]
-        #     obs = self.matrix.obs.iloc[np.arange(start, start + ncells)].copy()
-        #     obs['day'] = t
-        #
-        #     for j in range(probs.shape[1]):
-        #         name_to_list[population_names[j]].append(
-        #             anndata.AnnData(X=probs[:, j], obs=obs, var=pd.DataFrame(index=[population_names[j]])))
-        #     start += ncells
-        # return list(name_to_list.values())
+        engine = wot.tmap.PropagationEngine(self).add_reducer('trajectory', wot.tmap.trajectory_reducer())
+        _, results = engine.run(*population_dict.values())
+        trajectories = results['trajectory']
         return anndata.AnnData(X=np.concatenate(trajectories), obs=self.meta,
                                var=pd.DataFrame(index=population_names))
 
@@ -111,8 +101,8 @@ class TransportMapModel:
 
         Returns
         -------
-        tmap : anndata.AnnData
-            The transport map from t0 to t1
+        tmap : anndata.AnnData or wot.tmap.FactoredTransportMap
+            The transport map from t0 to t1. Transport maps written in the factored format are evaluated on the fly.
         """
         if t0 not in self.timepoints or t1 not in self.timepoints:
             raise ValueError("Timepoints {}, {} not found".format(t0, t1))
@@ -130,17 +120,153 @@ class TransportMapModel:
                 cv0, cv1 = covariate
                 key = (t0, t1, cv0, cv1)
             ds_or_path = self.tmaps.get(key)
-            if type(ds_or_path) is anndata.AnnData:
+            if isinstance(ds_or_path, wot.tmap.FactoredTransportMap):
                 return ds_or_path
-            ds = wot.io.read_dataset(ds_or_path)
-            if self.cache:
-                self.tmaps[key] = ds
-            return ds
+            if type(ds_or_path) is anndata.AnnData:
+                ds = ds_or_path
+                if wot.tmap.FactoredTransportMap.is_factored(ds):
+                    ds = wot.tmap.FactoredTransportMap(ds)
+                    self.tmaps[key] = ds
+                return ds
+            with self._prefetch_lock:
+                future = self._prefetching.pop(key, None)
+            if future is not None:
+                try:
+                    ds = future.result()
+                finally:
+                    self.cache.release(key)
+                with self.cache.lock:
+                    self.prefetch_hits += 1
+                self.cache.put(key, ds)
+                return ds
+            return self.cache.get_or_load(key, lambda: self.read_transport_map(ds_or_path))
 
         else:
             path = wot.tmap.find_path(t0, t1, self.day_pairs, self.timepoints)
             return wot.tmap.chain_transport_maps(self, path)
 
+    def read_transport_map_part(self, t0, t1, rows=None, columns=None):
+        """
+        Reads some rows or columns of a transport map file, if the transport map is not in memory.
+
+        Parameters
+        ----------
+        t0 : int or float
+            Source timepoint of the transport map.
+        t1 : int of float
+            Destination timepoint of the transport map.
+        rows : ndarray, optional
+            Sorted indices of the rows to read.
+        columns : ndarray, optional
+            Sorted indices of the columns to read.
+
+        Returns
+        -------
+        x : ndarray
+            The selected entries, or None if the transport map is in memory or its file has no dense matrix.
+        """
+        key = (t0, t1)
+        path = self.tmaps.get(key)
+        with self._prefetch_lock:
+            prefetching = key in self._prefetching
+        if not isinstance(path, str) or not path.lower().endswith(('.h5ad', '.loom')) or prefetching \
+                or key in self.cache:
+            return None
+        return wot.io.read_h5_submatrix(path, rows=rows, columns=columns)
+
+    def get_composed_transport_map(self, path):
+        """
+        Returns the composition of the transport maps along path if it is memoized, see wot.tmap.chain_transport_maps.
+
+        Parameters
+        ----------
+        path : list of (float, float)
+            Consecutive day pairs, such as returned by wot.tmap.find_path.
+
+        Returns
+        -------
+        tmap : anndata.AnnData
+            The composed transport map, or None if path has less than two day pairs or is not memoized.
+        """
+        key = tuple(path)
+        if len(key) < 2 or key not in self.cache:
+            return None
+        return self.cache.get(key)
+
+    def get_partial_support(self, p):
+        """Returns the indices of the cells where any of the measures p is non zero, if partial reads apply"""
+        if scipy.sparse.issparse(p):
+            support = np.unique(p.indices[p.data != 0])
+        else:
+            support = np.flatnonzero(np.any(p != 0, axis=0))
+        if 0 < len(support) <= self.partial_read_fraction * p.shape[1]:
+            return support
+        return None
+
+    def prefetch_transport_map(self, t0, t1):
+        """
+        Starts reading the transport map from t0 to t1 in a background thread, if it is not in memory yet.
+
+        get_transport_map then waits for the read rather than starting another one, and counts it in prefetch_hits.
+        Only the two most recently requested transport maps are kept waiting (one per direction when sweeping
+        both ways at once, see wot.tmap.PropagationEngine). Their estimated size is reserved in the cache while
+        they are read and wait, so that prefetching stays within the cache budget: transport maps that do not fit
+        are not prefetched.
+
+        Parameters
+        ----------
+        t0 : int or float
+            Source timepoint of the transport map.
+        t1 : int of float
+            Destination timepoint of the transport map.
+        """
+        key = (t0, t1)
+        path = self.tmaps.get(key)
+        if not isinstance(path, str) or key in self.cache:
+            return
+        with self._prefetch_lock:
+            if key in self._prefetching:
+                return
+            while len(self._prefetching) >= 2:
+                self._cancel_prefetch(next(iter(self._prefetching)))
+            if not self.cache.reserve(key, wot.tmap.estimate_transport_map_file_bytes(path)):
+                return
+            if self._prefetcher is None:
+                self._prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                                         thread_name_prefix='wot-tmap-prefetch')
+            self._prefetching[key] = self._prefetcher.submit(TransportMapModel.read_transport_map, path)
+
+    def close(self):
+        """Stops the prefetching threads and drops the transport maps they read"""
+        with self._prefetch_lock:
+            for key in list(self._prefetching):
+                self._cancel_prefetch(key)
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=True)
+            self._prefetcher = None
+
+    def _cancel_prefetch(self, key):
+        """Drops a prefetched transport map and releases its reservation. Called with the prefetch lock held"""
+        future = self._prefetching.pop(key, None)
+        if future is not None:
+            future.cancel()
+            self.cache.release(key)
+
+    @staticmethod
+    def read_transport_map(path):
+        """
+        Reads a transport map file.
+
+        Returns
+        -------
+        tmap : anndata.AnnData or wot.tmap.FactoredTransportMap
+            The transport map. Transport maps written in the factored format are evaluated on the fly.
+        """
+        ds = wot.io.read_dataset(path)
+        if wot.tmap.FactoredTransportMap.is_factored(ds):
+            ds = wot.tmap.FactoredTransportMap(ds)
+        return ds
+
     def can_push_forward(self, *populations):
         """
         Checks if the populations can be pushed forward.
@@ -234,17 +360,36 @@ class TransportMapModel:
         if i > j:
             raise ValueError("Destination timepoint is before source. Unable to push forward")
 
-        p = np.vstack([pop.p for pop in populations])
-        while i < j:
-            t0 = self.timepoints[i]
-            t1 = self.timepoints[i + 1]
-            tmap = self.get_transport_map(t0, t1)
-            p = p @ tmap.X
+        # sparse populations are stacked as a CSR matrix, the first product is then sparse x dense
+        p = Population.stack(populations)
+        path = wot.tmap.find_path(self.timepoints[i], self.timepoints[j], self.day_pairs, self.timepoints) \
+            if i < j else []
+        composed = self.get_composed_transport_map(path)
+        if composed is not None:
+            # a single product with the memoized composition rather than one per transport map
+            path = []
+            p = _to_dense(p @ composed.X)
+            if normalize:
+                p = (p.T / np.sum(p, axis=1)).T
+        for k, (t0, t1) in enumerate(path):
+            support = self.get_partial_support(p)
+            rows = self.read_transport_map_part(t0, t1, rows=support) if support is not None else None
+            tmap = self.get_transport_map(t0, t1) if rows is None else None
+            if self.prefetch and k + 1 < len(path):
+                self.prefetch_transport_map(*path[k + 1])
+            elif self.prefetch and j + 1 < len(self.timepoints):
+                self.prefetch_transport_map(t1, self.timepoints[j + 1])
+            if rows is not None:
+                p = _to_dense(p[:, support] @ rows)
+            else:
+                p = tmap.push_forward(_to_dense(p)) if isinstance(tmap, wot.tmap.FactoredTransportMap) \
+                    else _to_dense(p @ tmap.X)
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
-            i += 1
+        i = j
 
-        result = [Population(self.timepoints[i], p[k, :]) for k in range(p.shape[0])]
+        # populations stay sparse until their support spreads
+        result = Population.from_matrix(self.timepoints[i], p)
         if len(result) == 1 and not as_list:
             return result[0]
         else:
@@ -300,17 +445,36 @@ class TransportMapModel:
         if i < j:
             raise ValueError("Destination timepoint is after source. Unable to pull back")
 
-        p = np.vstack([pop.p for pop in populations])
-        while i > j:
-            t1 = self.timepoints[i]
-            t0 = self.timepoints[i - 1]
-            tmap = self.get_transport_map(t0, t1)
-            p = (tmap.X @ p.T).T
+        # sparse populations are stacked as a CSR matrix, the first product is then sparse x dense
+        p = Population.stack(populations)
+        path = wot.tmap.find_path(self.timepoints[j], self.timepoints[i], self.day_pairs, self.timepoints) \
+            if j < i else []
+        composed = self.get_composed_transport_map(path)
+        if composed is not None:
+            path = []
+            p = _to_dense(p @ composed.X.T)
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
-            i -= 1
+        path = path[::-1]
+        for k, (t0, t1) in enumerate(path):
+            support = self.get_partial_support(p)
+            columns = self.read_transport_map_part(t0, t1, columns=support) if support is not None else None
+            tmap = self.get_transport_map(t0, t1) if columns is None else None
+            if self.prefetch and k + 1 < len(path):
+                self.prefetch_transport_map(*path[k + 1])
+            elif self.prefetch and j >= 1:
+                self.prefetch_transport_map(self.timepoints[j - 1], t0)
+            if columns is not None:
+                p = _to_dense(p[:, support] @ columns.T)
+            else:
+                p = tmap.pull_back(_to_dense(p)) if isinstance(tmap, wot.tmap.FactoredTransportMap) \
+                    else _to_dense(p @ tmap.X.T)
+            if normalize:
+                p = (p.T / np.sum(p, axis=1)).T
+        i = j
 
-        result = [Population(self.timepoints[i], p[k, :]) for k in range(p.shape[0])]
+        # populations stay sparse until their support spreads
+        result = Population.from_matrix(self.timepoints[i], p)
         if len(result) == 1 and not as_list:
             return result[0]
         else:
@@ -404,6 +568,60 @@ class TransportMapModel:
         """
         return self.push_forward(*populations, to_time=at_time, as_list=as_list)
 
+    def extend(self, ds, at_time, growth_rates=None):
+        """
+        Places new cells observed at a timepoint in the adjacent transport maps, without computing them again.
+
+        The new cells are appended as rows of the transport map from at_time and as columns of the transport map
+        to at_time, see wot.tmap.FactoredTransportMap.extend. The transport maps must have been computed with
+        their potentials, see the extensible argument of wot.ot.OTModel. The extended transport maps are kept in memory.
+
+        Parameters
+        ----------
+        ds : anndata.AnnData
+            The new cells, with at least the genes used to compute the transport maps.
+        at_time : float
+            The timepoint of the new cells.
+        growth_rates : ndarray, optional
+            Growth rates of the new cells per day, as 'cell_growth_rate' when computing transport maps.
+            Defaults to the average growth of the cells of the transport map from at_time.
+
+        Returns
+        -------
+        tmaps : dict of (float, float): wot.tmap.FactoredTransportMap
+            The extended transport maps, by day pair.
+        """
+        at_time = float(at_time)
+        if at_time not in self.timepoints:
+            raise ValueError("Timepoint {} not found".format(at_time))
+        if ds.obs.index.isin(self.meta.index).any():
+            raise ValueError("Cells are already in the transport maps")
+        extended = {}
+        for t0, t1 in sorted(self.day_pairs):
+            if at_time != t0 and at_time != t1:
+                continue
+            tmap = self.get_transport_map(t0, t1)
+            if not isinstance(tmap, wot.tmap.FactoredTransportMap):
+                tmap = wot.tmap.FactoredTransportMap(tmap)
+            if at_time == t0:
+                growth = np.asarray(growth_rates) ** (t1 - t0) if growth_rates is not None else None
+                tmap = tmap.extend(source=ds, source_growth=growth)
+            else:
+                tmap = tmap.extend(destination=ds)
+            self.tmaps[(t0, t1)] = tmap
+            # including the compositions of this transport map with others
+            for key in self.cache.keys():
+                if key == (t0, t1) or (t0, t1) in key:
+                    self.cache.pop(key)
+            with self._prefetch_lock:
+                self._cancel_prefetch((t0, t1))
+            extended[(t0, t1)] = tmap
+        # the new cells follow the other cells of their day, as in the transport maps
+        days = self.meta['day'].values
+        self.meta = pd.concat((self.meta[days <= at_time], pd.DataFrame(index=ds.obs.index, data={'day': at_time}),
+                               self.meta[days > at_time]), sort=False)
+        return extended
+
     def population_from_ids(self, *ids, at_time):
         """
         Constructs a population uniformly distributed among the ids given as input.
@@ -449,9 +667,9 @@ class TransportMapModel:
             cell_indices = cell_indices[cell_indices > -1]
             if len(cell_indices) is 0:
                 return None
-            p = np.zeros(len(df), dtype=np.float64)
-            p[cell_indices] = 1.0
-            return Population(day, p / np.sum(p))
+            cell_indices = np.unique(cell_indices)
+            return Population(day, indices=cell_indices, weights=np.full(len(cell_indices), 1 / len(cell_indices)),
+                              size=len(df))
 
         result = [get_population(ids_el) for ids_el in ids]
         return result
@@ -494,29 +712,93 @@ class TransportMapModel:
         *populations : wot.Population
             The target populations
         """
-        initial_populations = populations
-        timepoints = []
-        census = []
-
-        def update(head, populations):
-            x = 0 if head else len(census)
-            timepoints.insert(x, wot.tmap.unique_timepoint(*populations))
-            census.insert(x, self.population_census(cset_matrix, *populations))
-
-        update(True, populations)
-        while self.can_pull_back(*populations):
-            populations = self.pull_back(*populations, as_list=True)
-            update(True, populations)
-        populations = initial_populations
-        while self.can_push_forward(*populations):
-            populations = self.push_forward(*populations, as_list=True)
-            update(False, populations)
+        engine = wot.tmap.PropagationEngine(self).add_reducer('census',
+                                                              wot.tmap.census_reducer(self, cset_matrix))
+        timepoints, results = engine.run(*populations)
+        census = results['census']
         census = np.asarray(census)
         if census.ndim == 3:
             # rearrange dimensions when more than one population is passed
             census = np.asarray([census[:, i, :] for i in range(census.shape[1])])
         return timepoints, census
 
+    def compute_fate_matrix(self, cell_sets, at_time, out=None, normalize=True):
+        """
+        Computes, for every cell up to at_time, the probability that its descendants at at_time are in each cell set.
+
+        The indicator matrix of the cell sets at at_time is pulled back through each transport map once,
+        as a single matrix product per step, together with a column of ones giving the total mass of the
+        descendants of each cell: the fates at t are (T_t ... T_k 1_S) / (T_t ... T_k 1) for each cell set S.
+
+        Parameters
+        ----------
+        cell_sets : dict of str: list of str
+            The terminal cell sets, by name.
+        at_time : float
+            The timepoint of the terminal cell sets.
+        out : str, optional
+            Path of an h5ad file to write the fate matrix to, one timepoint at a time, rather than returning it.
+        normalize : bool, optional, default : True
+            Whether the probabilities of each cell are divided by their sum, i.e. conditioned on ending
+            in one of the cell sets.
+
+        Returns
+        -------
+        fates : anndata.AnnData
+            Cells up to at_time on rows, in the order of meta, and cell sets on columns.
+            None if written to out.
+        """
+        at_time = float(at_time)
+        if at_time not in self.timepoints:
+            raise ValueError("Timepoint {} not found".format(at_time))
+        names = list(cell_sets.keys())
+        days = self.meta['day'].values
+        obs = self.meta[days <= at_time].copy()
+        ids = self.meta.index[days == at_time]
+        members = []
+        for name in names:
+            members.append(np.flatnonzero(ids.isin(cell_sets[name])))
+            if len(members[-1]) == 0:
+                print("Warning : no cells of {} at time {}".format(name, at_time))
+        # indicator of the cell sets at at_time, cells on rows
+        fates = scipy.sparse.csr_matrix(
+            (np.ones(sum(len(m) for m in members)),
+             (np.concatenate(members).astype(np.int64) if len(members) > 0 else np.zeros(0, dtype=np.int64),
+              np.repeat(np.arange(len(names)), [len(m) for m in members]))),
+            shape=(len(ids), len(names)))
+        x = np.zeros((len(obs), len(names))) if out is None else None
+
+        def emit(t, f):
+            if normalize:
+                sums = f.sum(axis=1, keepdims=True)
+                f = f / np.where(sums == 0, 1, sums)
+            rows = np.flatnonzero(obs['day'].values == t)
+            if len(rows) == 0:
+                return
+            if rows[-1] - rows[0] + 1 == len(rows):
+                rows = slice(rows[0], rows[-1] + 1)
+            if out is None:
+                x[rows] = f
+            else:
+                with h5py.File(out, 'a') as h5:
+                    h5['X'][rows] = f
+            wot.io.verbose("Computed fates of {} cells at time {}".format(f.shape[0], t))
+
+        if out is not None:
+            wot.io.create_h5ad(out, anndata.AnnData(obs=obs, var=pd.DataFrame(index=names)),
+                               chunks=(min(len(obs), 4096), len(names)))
+        emit(at_time, fates.toarray())
+        populations = Population.from_matrix(at_time, fates.T) + [Population(at_time, np.ones(len(ids)))]
+        while self.can_pull_back(*populations):
+            populations = self.pull_back(*populations, normalize=False, as_list=True)
+            p = np.vstack([pop.p for pop in populations])
+            # a common scale keeps the masses in range without changing the fates
+            p /= max(p.max(), np.finfo(p.dtype).tiny)
+            emit(populations[0].time, (p[:-1] / np.where(p[-1] == 0, 1, p[-1])).T)
+            populations = [Population(pop.time, row) for pop, row in zip(populations, p)]
+        if out is None:
+            return anndata.AnnData(x, obs, pd.DataFrame(index=names))
+
     def population_census(self, cell_set_matrix, *populations):
         """
         Get a census for a population with respect to a given cell set matrix
@@ -593,7 +875,32 @@ class TransportMapModel:
         return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs)
 
     @staticmethod
-    def from_directory(tmap_out, with_covariates=False, cache=False):
+    def from_transport_maps(tmaps):
+        """
+        Creates a wot.TransportMapModel from transport maps in memory.
+
+        Parameters
+        ----------
+        tmaps : dict of (float, float): anndata.AnnData
+            Maps day pairs to transport maps, such as the ones yielded by wot.ot.OTModel.iter_transport_maps
+
+        Returns
+        -------
+        tmap_model : wot.TransportMapModel
+            The TransportMapModel, reading no file.
+        """
+        if len(tmaps) == 0:
+            raise ValueError('No transport maps')
+        timepoint_to_ids = {}
+        for (t0, t1), tmap in tmaps.items():
+            timepoint_to_ids.setdefault(t0, tmap.obs.index.values)
+            timepoint_to_ids.setdefault(t1, tmap.var.index.values)
+        timepoints = sorted(timepoint_to_ids)
+        meta = pd.concat([pd.DataFrame(index=timepoint_to_ids[t], data={'day': t}) for t in timepoints], copy=False)
+        return TransportMapModel(tmaps=dict(tmaps), meta=meta, timepoints=timepoints, day_pairs=set(tmaps))
+
+    @staticmethod
+    def from_directory(tmap_out, with_covariates=False, cache=False, prefetch=None):
         """
         Creates a wot.TransportMapModel from an output directory.
 
@@ -601,76 +908,19 @@ class TransportMapModel:
         ----------
         :param tmap_out:
         :param with_covariates:
+        :param cache: see wot.tmap.TransportMapModel
+        :param prefetch: see wot.tmap.TransportMapModel
         :return: TransportMapModel instance
         """
-        tmap_dir, tmap_prefix = os.path.split(tmap_out)
-        tmap_dir = tmap_dir or '.'
-        tmap_prefix = tmap_prefix or "tmaps"
-        tmaps = {}
-        import re
-        files = os.listdir(tmap_dir)
-        pattern = None
-        if with_covariates:
-            pattern = re.compile(
-                tmap_prefix + '_([0-9]+\.[0-9])+_([0-9]+\.[0-9]+)_cv([0-9]+)_cv([0-9]+)[\.h5ad|\.loom]')
-        else:
-            pattern = re.compile(tmap_prefix + '_([0-9]+\.[0-9]+)_([0-9]+\.[0-9])+[\.h5ad|\.loom]')
-        for f in files:
-            path = os.path.join(tmap_dir, f)
-            if os.path.isfile(path):
-                m = pattern.match(f)
-                if m is not None:
-                    try:
-                        t1 = float(m.group(1))
-                        t2 = float(m.group(2))
-                        if with_covariates:
-                            cv1 = int(m.group(3))
-                            cv2 = int(m.group(4))
-                            tmaps[(t1, t2, cv1, cv2)] = path
-                        else:
-                            tmaps[(t1, t2)] = path
-                    except ValueError:
-                        print('Unable to find day pair for ' + f)
-                        pass
-
+        # the catalog lists the transport maps and their cells, so that they are not opened here
+        catalog = wot.tmap.TransportMapCatalog(tmap_out, with_covariates=with_covariates).load()
+        tmaps = {entry['key']: os.path.join(catalog.tmap_dir, name) for name, entry in catalog.entries.items()}
         if len(tmaps) is 0:
-            raise ValueError('No transport maps found in ' + tmap_dir + ' with prefix ' + tmap_prefix)
-        day_pairs = set()
-        unique_timepoints = set()
-        timepoint_to_ids = {}
-        for key in tmaps:
-            t0 = key[0]
-            t1 = key[1]
-            day_pairs.add((t0, t1))
-            unique_timepoints.add(t0)
-            unique_timepoints.add(t1)
-            load_t0 = timepoint_to_ids.get(t0) is None
-            load_t1 = timepoint_to_ids.get(t1) is None
-            if load_t0 or load_t1:
-                path = tmaps[key]
-                f = h5py.File(path, 'r')
-                if load_t0:
-                    if path.endswith('loom'):
-                        ids = f['/row_attrs/id'][()].astype(str)
-                    else:
-                        ids = f['/obs']['index'][()].astype(str)
-                    df = pd.DataFrame(index=ids, data={'day': t0})
-                    timepoint_to_ids[t0] = df
-                if load_t1:
-                    if path.endswith('loom'):
-                        ids = f['/col_attrs/id'][()].astype(str)
-                    else:
-                        ids = f['/var']['index'][()].astype(str)
-                    df = pd.DataFrame(index=ids, data={'day': t1})
-                    timepoint_to_ids[t1] = df
-                f.close()
-        meta = None
-        timepoints = sorted(unique_timepoints)
-        for t in timepoints:
-            df = timepoint_to_ids[t]
-            if meta is None:
-                meta = df
-            else:
-                meta = pd.concat((meta, df), copy=False)
-
-        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs, cache=cache)
+            raise ValueError('No transport maps found in ' + catalog.tmap_dir + ' with prefix ' + catalog.tmap_prefix)
+        day_pairs = set(key[:2] for key in tmaps)
+        timepoints = sorted(set(t for day_pair in day_pairs for t in day_pair))
+        ids = [catalog.ids[t] for t in timepoints]
+        meta = pd.DataFrame(index=np.concatenate(ids), data={'day': np.repeat(timepoints, [len(x) for x in ids])})
+
+        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs, cache=cache,
+                                 prefetch=prefetch)
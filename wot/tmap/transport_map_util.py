@@ -106,7 +106,7 @@ def compute_trajectory_trends_from_trajectory(trajectory_ds, ds):
     return results
 
 
-def compute_trajectory_trends(tmap_model, *populations):
+def compute_trajectory_trends(tmap_model, *populations, ds):
     """
     Computes the mean and variance of each gene over time for the given populations
 
@@ -116,6 +116,8 @@ def compute_trajectory_trends(tmap_model, *populations):
         The TransportMapModel used to find ancestors and descendants of the population
     *populations : wot.Population
         The target populations
+    ds : anndata.AnnData
+        Dataset used to compute mean and variance, with cells of the transport maps on rows
 
     Returns
     -------
@@ -130,25 +132,10 @@ def compute_trajectory_trends(tmap_model, *populations):
     -----
     If only one population is given, means and variances will have two dimensions, otherwise three
     """
-    initial_populations = populations
-    timepoints = []
-    traj, variances = [], []
-
-    def update(head, populations):
-        x = 0 if head else len(traj)
-        m, v = tmap_model.population_mean_and_variance(*populations)
-        timepoints.insert(x, wot.tmap.unique_timepoint(*populations))
-        traj.insert(x, m)
-        variances.insert(x, v)
-
-    update(True, populations)
-    while tmap_model.can_pull_back(*populations):
-        populations = tmap_model.pull_back(*populations, as_list=True)
-        update(True, populations)
-    populations = initial_populations
-    while tmap_model.can_push_forward(*populations):
-        populations = tmap_model.push_forward(*populations, as_list=True)
-        update(False, populations)
+    engine = wot.tmap.PropagationEngine(tmap_model).add_reducer('trends', wot.tmap.trends_reducer(tmap_model, ds))
+    timepoints, results = engine.run(*populations)
+    traj = [m for m, v in results['trends']]
+    variances = [v for m, v in results['trends']]
 
     def unpack(arr):
         arr = np.asarray(arr)
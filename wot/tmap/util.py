@@ -1,3 +1,4 @@
+import anndata
 import numpy as np
 
 import wot.io